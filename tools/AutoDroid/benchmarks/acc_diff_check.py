@@ -0,0 +1,236 @@
+# Run accessibility diffs through DroidBotAppConn.handle_message and check the canonical tree:
+# path copying (earlier events unchanged, clean subtrees shared), a sequence gap and an unknown node id
+# (both desync and request a snapshot), then check that a state built from a diff with a base state has the
+# same view strings and hashes as one built from scratch, and compare the time to build them and to compute
+# their view strings and subtree hashes.
+# Usage: python -m benchmarks.acc_diff_check [--state state.json|dir ...] [-n 5]
+import argparse
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+from types import SimpleNamespace
+
+from droidbot.adapter.droidbot_app import DroidBotAppConn, ACC_EVENT_PREFIX, ACC_DIFF_PREFIX, \
+    ACC_SNAPSHOT_REQUEST, ACC_NODE_ID_KEY
+from droidbot.artifact_writer import ArtifactWriter
+from droidbot.device_state import DeviceState
+from .state_fixtures import find_state_files, load_views, views_to_tree, count_nodes
+
+ACTIVITY = "com.example/.MainActivity"
+
+
+class TimedDeviceState(DeviceState):
+    """
+    a DeviceState adding the time spent on its view strings and subtree hashes to view_strs_time
+    """
+    view_strs_time = 0.0
+
+    def _DeviceState__generate_view_strs(self, *args):
+        t0 = time.perf_counter()
+        DeviceState._DeviceState__generate_view_strs(self, *args)
+        TimedDeviceState.view_strs_time += time.perf_counter() - t0
+
+
+def make_conn():
+    device = SimpleNamespace(get_random_port=lambda: 0, enable_accessibility_hard=False, ignore_ad=False)
+    conn = DroidBotAppConn(device)
+    # the other end receives the snapshot requests
+    conn.sock, app_sock = socket.socketpair()
+    app_sock.setblocking(False)
+    return conn, app_sock
+
+
+def read_requests(app_sock):
+    requests = []
+    try:
+        data = app_sock.recv(65536)
+    except BlockingIOError:
+        return requests
+    while data:
+        _, _, length = struct.unpack(">BBI", data[:6])
+        requests.append(data[6:6 + length].decode())
+        data = data[6 + length:]
+    return requests
+
+
+def load_tree(state_file):
+    """
+    :return: the root node of an accessibility snapshot, with node ids, all visible
+    """
+    root_node = views_to_tree(load_views(state_file))
+    node_id = 0
+    stack = [root_node]
+    while stack:
+        node = stack.pop()
+        node[ACC_NODE_ID_KEY] = node_id
+        node["visible"] = True
+        node_id += 1
+        stack.extend(node["children"])
+    return root_node
+
+
+def find_path(root_node, target):
+    stack = [(root_node, [root_node])]
+    while stack:
+        node, path = stack.pop()
+        if node is target:
+            return path
+        for child in node["children"]:
+            stack.append((child, path + [child]))
+    return None
+
+
+def deepest_leaf(root_node):
+    best = (0, root_node)
+    stack = [(root_node, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if not node["children"] and depth > best[0]:
+            best = (depth, node)
+        for child in node["children"]:
+            stack.append((child, depth + 1))
+    return best[1]
+
+
+def send_snapshot(conn, seq, root_node):
+    conn.handle_message(ACC_EVENT_PREFIX + json.dumps({"seq": seq, "root_node": root_node}))
+
+
+def send_diff(conn, base, seq, patches):
+    conn.handle_message(ACC_DIFF_PREFIX + json.dumps({"base": base, "seq": seq, "patches": patches}))
+
+
+def check_path_copying(conn, root_node):
+    send_snapshot(conn, 0, root_node)
+    num_desyncs = conn.num_acc_desyncs
+    snapshot_event = conn.last_acc_event
+    old_root = snapshot_event["root_node"]
+    leaf = deepest_leaf(old_root)
+    path_ids = [node[ACC_NODE_ID_KEY] for node in find_path(old_root, leaf)]
+    old_text = leaf.get("text")
+
+    send_diff(conn, 0, 1, [{"op": "update", "node_id": leaf[ACC_NODE_ID_KEY], "fields": {"text": "changed"}}])
+    event = conn.last_acc_event
+    assert event is not snapshot_event and event["seq"] == 1
+    assert sorted(event["dirty_node_ids"]) == sorted(path_ids)
+    # the earlier tree is not modified
+    assert leaf.get("text") == old_text
+    new_path = find_path(event["root_node"], conn.acc_nodes[leaf[ACC_NODE_ID_KEY]])
+    assert [node[ACC_NODE_ID_KEY] for node in new_path] == path_ids
+    assert new_path[-1]["text"] == "changed"
+    # the nodes on the path are copies, the other children are shared with the earlier tree
+    for old_node, new_node in zip(find_path(old_root, leaf), new_path):
+        assert old_node is not new_node
+        for old_child, new_child in zip(old_node["children"], new_node["children"]):
+            if old_child[ACC_NODE_ID_KEY] not in path_ids:
+                assert old_child is new_child
+
+    # add a node under the root and remove the changed leaf
+    new_node = {ACC_NODE_ID_KEY: "added", "class": "android.widget.TextView", "text": "added",
+                "bounds": [0, 0, 10, 10], "visible": True, "children": []}
+    send_diff(conn, 1, 2, [{"op": "add", "parent": old_root[ACC_NODE_ID_KEY], "index": 0, "node": new_node},
+                           {"op": "remove", "node_id": leaf[ACC_NODE_ID_KEY]}])
+    event = conn.last_acc_event
+    assert event["root_node"]["children"][0][ACC_NODE_ID_KEY] == "added"
+    assert leaf[ACC_NODE_ID_KEY] not in conn.acc_nodes and "added" in conn.acc_nodes
+    assert conn.get_dirty_node_ids((event["generation"], 0), (event["generation"], 2)) >= set(path_ids)
+    assert conn.num_acc_desyncs == num_desyncs
+
+
+def check_desync(conn, app_sock, root_node):
+    send_snapshot(conn, 0, root_node)
+    num_desyncs = conn.num_acc_desyncs
+    event = conn.last_acc_event
+
+    # a sequence gap: the diff is dropped and a snapshot is requested once
+    send_diff(conn, 5, 6, [])
+    send_diff(conn, 6, 7, [])
+    assert conn.last_acc_event is event and conn.acc_seq is None
+    assert conn.num_acc_desyncs == num_desyncs + 2
+    assert read_requests(app_sock) == [ACC_SNAPSHOT_REQUEST]
+
+    # an unknown node id after the next snapshot
+    send_snapshot(conn, 0, root_node)
+    event = conn.last_acc_event
+    send_diff(conn, 0, 1, [{"op": "update", "node_id": "unknown", "fields": {"text": "x"}}])
+    assert conn.last_acc_event is event and conn.acc_seq is None
+    assert conn.num_acc_desyncs == num_desyncs + 3
+    assert read_requests(app_sock) == [ACC_SNAPSHOT_REQUEST]
+
+    # diffs apply again after the snapshot
+    send_snapshot(conn, 0, root_node)
+    send_diff(conn, 0, 1, [])
+    assert conn.last_acc_event["seq"] == 1 and conn.acc_seq == 1
+
+
+def check_state_reuse(conn, device, root_node, num):
+    """
+    :return: (ms to build a state from scratch, ms to build it with a base state,
+              ms of the view strings from scratch, ms of the view strings with a base state)
+    """
+    send_snapshot(conn, 0, root_node)
+    base_views, base_version = conn.get_acc_views()
+    base_state = DeviceState(device, base_views, ACTIVITY, [], [])
+
+    leaf = deepest_leaf(conn.last_acc_event["root_node"])
+    send_diff(conn, 0, 1, [{"op": "update", "node_id": leaf[ACC_NODE_ID_KEY], "fields": {"text": "changed"}}])
+    views, version = conn.get_acc_views()
+    dirty_node_ids = conn.get_dirty_node_ids(base_version, version)
+    assert dirty_node_ids
+
+    for activity in (ACTIVITY, ACTIVITY + "2"):
+        full_state = DeviceState(device, views, activity, [], [])
+        state = DeviceState(device, views, activity, [], [], base_state=base_state, dirty_node_ids=dirty_node_ids)
+        assert [view["view_str"] for view in state.views] == [view["view_str"] for view in full_state.views]
+        assert [view["signature"] for view in state.views] == [view["signature"] for view in full_state.views]
+        assert state.subtree_hashes == full_state.subtree_hashes
+        assert state.state_str == full_state.state_str and state.structure_str == full_state.structure_str
+
+    def timed(func):
+        TimedDeviceState.view_strs_time = 0.0
+        t0 = time.perf_counter()
+        for _ in range(num):
+            func()
+        return (time.perf_counter() - t0) * 1000 / num, TimedDeviceState.view_strs_time * 1000 / num
+
+    full_ms, full_strs_ms = timed(lambda: TimedDeviceState(device, views, ACTIVITY, [], []))
+    reuse_ms, reuse_strs_ms = timed(lambda: TimedDeviceState(device, views, ACTIVITY, [], [], base_state=base_state,
+                                                             dirty_node_ids=dirty_node_ids))
+    return full_ms, reuse_ms, full_strs_ms, reuse_strs_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="accessibility diff check")
+    parser.add_argument("--state", dest="states", nargs="*", help="recorded state json files or directories")
+    parser.add_argument("-n", dest="num", type=int, default=5, help="number of state constructions to time")
+    opts = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp()
+    device = SimpleNamespace(output_dir=output_dir, humanoid=None, artifact_writer=ArtifactWriter(),
+                             get_width=lambda refresh=False: 1080, get_height=lambda refresh=False: 2400)
+    conn, app_sock = make_conn()
+
+    print("%-32s %8s %14s %14s %18s %18s" % ("state", "nodes", "scratch(ms)", "reused(ms)",
+                                             "view strs scratch", "view strs reused"))
+    try:
+        for state_file in find_state_files(opts.states):
+            root_node = load_tree(state_file)
+            check_path_copying(conn, root_node)
+            check_desync(conn, app_sock, root_node)
+            full_ms, reuse_ms, full_strs_ms, reuse_strs_ms = check_state_reuse(conn, device, root_node, opts.num)
+            print("%-32s %8d %14.2f %14.2f %18.2f %18.2f" % (os.path.basename(state_file), count_nodes(root_node),
+                                                             full_ms, reuse_ms, full_strs_ms, reuse_strs_ms))
+        print("all checks passed")
+    finally:
+        conn.sock.close()
+        app_sock.close()
+        device.artifact_writer.stop()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
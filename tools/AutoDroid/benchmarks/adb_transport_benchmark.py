@@ -0,0 +1,64 @@
+# Compare adb command latency of the subprocess and the socket transports of droidbot.adapter.adb.ADB
+# Usage: python -m benchmarks.adb_transport_benchmark [-n 200]
+# The subprocess transport needs a real `adb` client on PATH, which is pointed at the fake server.
+import argparse
+import os
+import shutil
+import time
+from types import SimpleNamespace
+
+from droidbot.adapter.adb import ADB, ADB_TRANSPORT_SUBPROCESS, ADB_TRANSPORT_SOCKET
+from .fake_adb_server import FakeADBServer, FAKE_SERIAL
+
+RESPONSES = {
+    "getprop ro.build.version.sdk": b"30\n",
+    "getprop": b"\n",
+    "dumpsys activity activities": b"  * Hist #0: ActivityRecord{1 u0 com.example/.MainActivity t1}\n" * 200,
+}
+COMMANDS = ["getprop ro.build.version.sdk", "input tap 100 200", "dumpsys activity activities"]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    k = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[k]
+
+
+def measure(adb, num):
+    latencies = []
+    for i in range(num):
+        cmd = COMMANDS[i % len(COMMANDS)]
+        t0 = time.perf_counter()
+        adb.shell(cmd)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="adb transport latency benchmark")
+    parser.add_argument("-n", dest="num", type=int, default=200, help="number of commands per transport")
+    opts = parser.parse_args()
+
+    server = FakeADBServer(RESPONSES).start()
+    os.environ["ANDROID_ADB_SERVER_PORT"] = str(server.port)
+
+    transports = [ADB_TRANSPORT_SOCKET]
+    if shutil.which("adb"):
+        transports.insert(0, ADB_TRANSPORT_SUBPROCESS)
+    else:
+        print("adb not found on PATH, skipping the subprocess transport")
+
+    print("%-12s %10s %10s %10s" % ("transport", "p50(ms)", "p99(ms)", "mean(ms)"))
+    for transport in transports:
+        adb = ADB(device=SimpleNamespace(serial=FAKE_SERIAL, adb_transport=transport))
+        measure(adb, 5)  # warm up
+        latencies = measure(adb, opts.num)
+        print("%-12s %10.2f %10.2f %10.2f" % (transport, percentile(latencies, 50), percentile(latencies, 99),
+                                             sum(latencies) / len(latencies)))
+        if adb.host_conn is not None:
+            adb.host_conn.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
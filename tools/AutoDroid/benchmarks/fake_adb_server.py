@@ -0,0 +1,102 @@
+# A minimal fake adb server for benchmarks.
+# It implements the subset of the adb host protocol droidbot uses to run shell commands, see:
+# https://android.googlesource.com/platform/packages/modules/adb/+/refs/heads/main/OVERVIEW.TXT
+import socketserver
+import struct
+import threading
+
+ADB_SERVER_VERSION = 41
+FAKE_SERIAL = "emulator-5554"
+FAKE_FEATURES = "shell_v2,cmd,stat_v2,ls_v2,abb,abb_exec"
+
+
+class FakeADBHandler(socketserver.BaseRequestHandler):
+
+    def recv_exactly(self, size):
+        buf = b""
+        while len(buf) < size:
+            pkt = self.request.recv(size - len(buf))
+            if not pkt:
+                raise EOFError()
+            buf += pkt
+        return buf
+
+    def read_request(self):
+        length = int(self.recv_exactly(4), 16)
+        return self.recv_exactly(length).decode()
+
+    def okay(self, message=None):
+        if message is None:
+            self.request.sendall(b"OKAY")
+        else:
+            payload = message.encode()
+            self.request.sendall(b"OKAY" + b"%04x" % len(payload) + payload)
+
+    def fail(self, message):
+        payload = message.encode()
+        self.request.sendall(b"FAIL" + b"%04x" % len(payload) + payload)
+
+    def handle(self):
+        try:
+            while True:
+                request = self.read_request()
+                if request == "host:version":
+                    self.okay("%04x" % ADB_SERVER_VERSION)
+                    return
+                elif request in ("host:features", "host-serial:%s:features" % FAKE_SERIAL):
+                    self.okay(FAKE_FEATURES)
+                    return
+                elif request == "host-serial:%s:get-state" % FAKE_SERIAL:
+                    self.okay("device")
+                    return
+                elif request == "host:transport:%s" % FAKE_SERIAL:
+                    self.okay()
+                elif request == "host:tport:serial:%s" % FAKE_SERIAL:
+                    self.okay()
+                    self.request.sendall(struct.pack("<Q", 1))
+                elif request.startswith("shell,v2,"):
+                    cmd_line = request.split(":", 1)[1]
+                    self.okay()
+                    out = self.server.respond(cmd_line)
+                    self.request.sendall(struct.pack("<BI", 1, len(out)) + out +
+                                         struct.pack("<BI", 3, 1) + b"\x00")
+                    return
+                elif request.startswith("shell:") or request.startswith("exec:"):
+                    self.okay()
+                    self.request.sendall(self.server.respond(request.split(":", 1)[1]))
+                    return
+                else:
+                    self.fail("unsupported request: %s" % request)
+                    return
+        except EOFError:
+            pass
+
+
+class FakeADBServer(socketserver.ThreadingTCPServer):
+    """
+    answers shell commands with canned outputs, looked up by command prefix
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, responses=None, port=0):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", port), FakeADBHandler)
+        self.responses = responses or {}
+        self.commands = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def respond(self, cmd_line):
+        self.commands.append(cmd_line)
+        for prefix in sorted(self.responses, key=len, reverse=True):
+            if cmd_line.startswith(prefix):
+                return self.responses[prefix]
+        return b""
+
+    def start(self):
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
@@ -0,0 +1,52 @@
+# Compare tap latency of the adb input command and the sendevent input channel on a real device
+# Usage: python -m benchmarks.input_latency_benchmark -d <serial> [-n 50] [-x 1 -y 1]
+# Taps are sent at (x, y), the default top-left corner is usually harmless (status bar).
+import argparse
+import time
+from types import SimpleNamespace
+
+from droidbot.adapter.adb import ADB
+from droidbot.adapter.sendevent import SendEventInput
+from .adb_transport_benchmark import percentile
+
+
+def measure(tap, num):
+    latencies = []
+    for i in range(num):
+        t0 = time.perf_counter()
+        tap()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="input injection latency benchmark")
+    parser.add_argument("-d", dest="device_serial", required=True, help="serial number of the device")
+    parser.add_argument("-n", dest="num", type=int, default=50, help="number of taps per backend")
+    parser.add_argument("-x", dest="x", type=int, default=1)
+    parser.add_argument("-y", dest="y", type=int, default=1)
+    opts = parser.parse_args()
+
+    device = SimpleNamespace(serial=opts.device_serial)
+    device.adb = ADB(device=device)
+    sendevent_input = SendEventInput(device=device)
+    sendevent_input.connect()
+    if not sendevent_input.check_connectivity():
+        print("sendevent input is not available on this device")
+        return
+
+    backends = [
+        ("adb", lambda: device.adb.touch(opts.x, opts.y)),
+        ("sendevent", lambda: sendevent_input.touch(opts.x, opts.y))
+    ]
+    print("%-12s %10s %10s %10s" % ("backend", "p50(ms)", "p99(ms)", "mean(ms)"))
+    for name, tap in backends:
+        measure(tap, 3)  # warm up
+        latencies = measure(tap, opts.num)
+        print("%-12s %10.2f %10.2f %10.2f" % (name, percentile(latencies, 50), percentile(latencies, 99),
+                                             sum(latencies) / len(latencies)))
+    sendevent_input.disconnect()
+
+
+if __name__ == "__main__":
+    main()
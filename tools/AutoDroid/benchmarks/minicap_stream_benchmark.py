@@ -0,0 +1,79 @@
+# Measure the throughput of droidbot.adapter.minicap.MinicapStreamReader on a minicap stream served from a local socket
+# Usage: python -m benchmarks.minicap_stream_benchmark [--stream recorded.bin] [-n 300]
+# A stream can be recorded from a device with `adb forward tcp:1313 localabstract:minicap` and `nc localhost 1313`,
+# otherwise a synthetic stream of JPEG-sized frames is used.
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+from droidbot.adapter.minicap import MinicapStreamReader, MINICAP_BANNER_STRUCT
+
+
+def synthetic_stream(num_frames, width=1080, height=1920):
+    banner = MINICAP_BANNER_STRUCT.pack(1, MINICAP_BANNER_STRUCT.size, 1234, width, height, width, height, 0, 0)
+    frames = []
+    for i in range(num_frames):
+        body = b"\xff\xd8" + os.urandom(100 * 1024 + (i * 7919) % (200 * 1024))
+        frames.append(struct.pack("<I", len(body)) + body)
+    return banner + b"".join(frames)
+
+
+def serve(stream):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    def send():
+        conn, _ = server.accept()
+        conn.sendall(stream)
+        conn.close()
+        server.close()
+
+    thread = threading.Thread(target=send)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+
+def read_frames(port):
+    sock = socket.create_connection(("127.0.0.1", port))
+    reader = MinicapStreamReader(sock)
+    reader.read_banner()
+    num_frames = 0
+    num_bytes = 0
+    try:
+        while True:
+            frame = reader.read_frame()
+            num_frames += 1
+            num_bytes += len(frame)
+    except EOFError:
+        pass
+    sock.close()
+    return num_frames, num_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="minicap stream decoding benchmark")
+    parser.add_argument("--stream", dest="stream", help="a recorded minicap stream, including the banner")
+    parser.add_argument("-n", dest="num", type=int, default=300, help="number of synthetic frames")
+    opts = parser.parse_args()
+
+    if opts.stream:
+        with open(opts.stream, "rb") as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(opts.num)
+
+    port = serve(stream)
+    t0 = time.perf_counter()
+    num_frames, num_bytes = read_frames(port)
+    elapsed = time.perf_counter() - t0
+    print("%d frames, %.1f MB in %.3fs: %.1f frames/s, %.1f MB/s" % (
+        num_frames, num_bytes / 1e6, elapsed, num_frames / elapsed, num_bytes / 1e6 / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Compare navigation queries answered by networkx on every call against a NavigationIndex,
+# on a synthetic exploration graph that keeps growing while it is queried.
+# Usage: python -m benchmarks.nav_index_benchmark [--nodes 10000] [--steps 2000] [--targets 20]
+import argparse
+import random
+import time
+
+import networkx as nx
+
+from droidbot.nav_index import NavigationIndex
+
+
+def build_graph(num_nodes, rng):
+    """
+    each node is reached from a random earlier node, with back edges to the first nodes and random shortcuts,
+    like the UTG of an exploration that returns to the main pages
+    """
+    graph = nx.DiGraph()
+    graph.add_node(0)
+    for node in range(1, num_nodes):
+        graph.add_edge(rng.randrange(node), node)
+        if rng.random() < 0.5:
+            graph.add_edge(node, rng.randrange(min(node, 10)))
+        if rng.random() < 0.3:
+            graph.add_edge(node, rng.randrange(node))
+    return graph
+
+
+def explore(graph, steps, num_targets, rng, shortest_path, descendants, add_edge):
+    """
+    at each step add an edge, then look for a navigation target as UtgGreedySearchPolicy does:
+    the reachable states from the current state, and a path to some of them
+    :return: (seconds, list of path lengths)
+    """
+    nodes = list(graph.nodes())
+    current = 0
+    path_lengths = []
+    start = time.perf_counter()
+    for _ in range(steps):
+        u, v = current, rng.choice(nodes)
+        if u != v and not graph.has_edge(u, v):
+            graph.add_edge(u, v)
+            add_edge(u, v)
+        reachable = sorted(descendants(current))
+        for target in rng.sample(reachable, min(num_targets, len(reachable))):
+            path_lengths.append(len(shortest_path(current, target)))
+        # follow a random edge, or restart the app
+        successors = list(graph.successors(current))
+        current = rng.choice(successors) if successors and rng.random() < 0.8 else 0
+    return time.perf_counter() - start, path_lengths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="navigation index benchmark")
+    parser.add_argument("--nodes", type=int, default=10000, help="number of nodes of the synthetic graph")
+    parser.add_argument("--steps", type=int, default=2000, help="number of exploration steps")
+    parser.add_argument("--targets", type=int, default=20, help="number of paths computed per step")
+    parser.add_argument("--seed", type=int, default=0)
+    opts = parser.parse_args()
+
+    nx_graph = build_graph(opts.nodes, random.Random(opts.seed))
+    nx_time, nx_lengths = explore(nx_graph, opts.steps, opts.targets, random.Random(opts.seed),
+                                  lambda s, t: nx.shortest_path(nx_graph, s, t),
+                                  lambda s: nx.descendants(nx_graph, s),
+                                  lambda u, v: None)
+
+    index_graph = build_graph(opts.nodes, random.Random(opts.seed))
+    index = NavigationIndex(index_graph)
+    index_time, index_lengths = explore(index_graph, opts.steps, opts.targets, random.Random(opts.seed),
+                                        index.shortest_path, index.descendants, index.add_edge)
+
+    assert nx_lengths == index_lengths, "the index found paths of different lengths"
+    print("graph: %d nodes, %d edges, %d steps, %d paths" % (index_graph.number_of_nodes(),
+                                                            index_graph.number_of_edges(),
+                                                            opts.steps, len(index_lengths)))
+    print("%-12s %12s %14s" % ("", "total(s)", "per step(ms)"))
+    print("%-12s %12.3f %14.3f" % ("networkx", nx_time, nx_time * 1000 / opts.steps))
+    print("%-12s %12.3f %14.3f" % ("index", index_time, index_time * 1000 / opts.steps))
+    print("speedup: %.1fx" % (nx_time / index_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Measure the state cache of a UTGStore under memory budgets: hits, misses, the time of a state lookup,
+# and the memory retained by the cached states, on a skewed walk over recorded states.
+# Usage: python -m benchmarks.state_cache_benchmark [--state state.json|dir ...] [-n 2000] [--copies 20]
+import argparse
+import gc
+import json
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from droidbot.artifact_writer import ArtifactWriter
+from droidbot.device_state import DeviceState
+from droidbot.utg_store import UTGStore, STATE_SIZE_FACTOR
+from .state_fixtures import find_state_files, load_views
+
+
+def walk(store, state_strs, num_steps, rng):
+    """
+    look up states like an exploration: mostly the recent states and the main pages, sometimes any state
+    :return: (average ms per lookup, bytes retained by the cache after the walk)
+    """
+    store.state_cache.clear()
+    store.cached_size = 0
+    gc.collect()
+    tracemalloc.start()
+    recent = state_strs[:10]
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        if rng.random() < 0.8:
+            state_str = rng.choice(recent)
+        else:
+            state_str = rng.choice(state_strs)
+            recent = recent[1:] + [state_str]
+        store.get_state(state_str)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed * 1000 / num_steps, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UTG state cache benchmark")
+    parser.add_argument("--state", dest="states", nargs="*", help="recorded state json files or directories")
+    parser.add_argument("-n", dest="num_steps", type=int, default=2000, help="number of state lookups")
+    parser.add_argument("--copies", type=int, default=20,
+                        help="number of distinct states made from each recorded state")
+    opts = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp()
+    device = SimpleNamespace(output_dir=output_dir, humanoid=None, artifact_writer=ArtifactWriter(),
+                             get_width=lambda refresh=False: 1080, get_height=lambda refresh=False: 2400)
+    try:
+        all_views = [load_views(state_file) for state_file in find_state_files(opts.states)]
+        states = []
+        for copy in range(opts.copies):
+            for views in all_views:
+                # different texts make a different state_str
+                views = [dict(view, text="%s %d" % (view.get("text") or "", copy)) for view in views]
+                states.append(DeviceState(device, views, "com.example/.MainActivity", [], []))
+        json_size = sum(len(json.dumps(state.to_dict())) for state in states)
+        estimated_size = json_size * STATE_SIZE_FACTOR
+
+        print("%d states, %.1f MB of json, %.1f MB estimated in memory" % (len(states), json_size / 1e6,
+                                                                          estimated_size / 1e6))
+        print("%12s %8s %8s %10s %12s %14s" % ("budget(MB)", "hits", "misses", "evictions", "lookup(ms)",
+                                                "retained(MB)"))
+        for fraction in [1.0, 0.5, 0.25, 0.1, 0.02]:
+            budget = int(estimated_size * fraction)
+            store = UTGStore(device, cache_budget=budget)
+            for state in states:
+                store.add_state(state)
+            state_strs = [state.state_str for state in states]
+            lookup_ms, retained = walk(store, state_strs, opts.num_steps, random.Random(0))
+            stats = store.get_stats()
+            print("%12.1f %8d %8d %10d %12.3f %14.1f" % (budget / 1e6, stats["hits"], stats["misses"],
+                                                         stats["evictions"], lookup_ms, retained / 1e6))
+        print("stored: %.1f MB compressed" % (stats["stored_size"] / 1e6))
+    finally:
+        device.artifact_writer.stop()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Measure the cost of building a DeviceState from a recorded state and describing its actions the way
+# the LLM policies do, with and without the memoized get_described_actions.
+# Usage: python -m benchmarks.state_construction_benchmark [--state state.json|dir ...] [-n 5] [-q 2]
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+from droidbot.adapter.droidbot_app import DroidBotAppConn
+from droidbot.artifact_writer import ArtifactWriter
+from droidbot.device_state import DeviceState
+from .state_fixtures import find_state_files, load_views, views_to_tree, count_nodes
+
+
+class UncachedDeviceState(DeviceState):
+    """
+    a DeviceState describing its actions from scratch on every call, as before the memoization
+    """
+
+    def get_described_actions(self, *args, **kwargs):
+        self._DeviceState__described_actions_views = None
+        return DeviceState.get_described_actions(self, *args, **kwargs)
+
+
+def build_and_describe(state_class, device, views, num_queries):
+    """
+    build a state, then query its described actions like a policy step (prompt, then the chosen action)
+    """
+    state = state_class(device, views, "com.example/.MainActivity", [], [])
+    for _ in range(num_queries):
+        state.get_described_actions()
+    return state
+
+
+def timed(func, num):
+    t0 = time.perf_counter()
+    for _ in range(num):
+        func()
+    return (time.perf_counter() - t0) * 1000 / num
+
+
+def main():
+    parser = argparse.ArgumentParser(description="state construction benchmark")
+    parser.add_argument("--state", dest="states", nargs="*", help="recorded state json files or directories")
+    parser.add_argument("-n", dest="num", type=int, default=5, help="number of runs per state")
+    parser.add_argument("-q", dest="num_queries", type=int, default=2,
+                        help="number of get_described_actions calls after construction")
+    opts = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp()
+    device = SimpleNamespace(output_dir=output_dir, humanoid=None, artifact_writer=ArtifactWriter(),
+                             get_width=lambda refresh=False: 1080, get_height=lambda refresh=False: 2400)
+    conn = DroidBotAppConn.__new__(DroidBotAppConn)
+    conn.ignore_ad = False
+
+    print("%-32s %8s %14s %14s %8s" % ("state", "nodes", "uncached(ms)", "cached(ms)", "speedup"))
+    try:
+        for state_file in find_state_files(opts.states):
+            root_node = views_to_tree(load_views(state_file))
+            # the recorded views are the ones a state kept, load them all as visible
+            stack = [root_node]
+            while stack:
+                node = stack.pop()
+                node["visible"] = True
+                stack.extend(node["children"])
+            conn.last_acc_event = {"root_node": root_node}
+            views = conn.get_views()
+
+            old_ms = timed(lambda: build_and_describe(UncachedDeviceState, device, views, opts.num_queries), opts.num)
+            new_ms = timed(lambda: build_and_describe(DeviceState, device, views, opts.num_queries), opts.num)
+            print("%-32s %8d %14.2f %14.2f %7.1fx" % (os.path.basename(state_file), count_nodes(root_node),
+                                                     old_ms, new_ms, old_ms / new_ms))
+    finally:
+        device.artifact_writer.stop()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
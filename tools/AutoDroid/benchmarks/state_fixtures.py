@@ -0,0 +1,56 @@
+# Recorded device states used by the benchmarks.
+# The state_*.json files written by DeviceState.save2dir can be used as fixtures,
+# by default the recorded states of the repository (src/states) are loaded.
+import glob
+import json
+import os
+
+DEFAULT_STATE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                 "..", "..", "..", "src", "states"))
+# keys added to views by DroidBotAppConn.get_views and DeviceState, not present in an accessibility event
+DERIVED_VIEW_KEYS = {"temp_id", "parent", "size", "signature", "content_free_signature", "view_str",
+                     "depth", "view_structure"}
+
+
+def find_state_files(paths=None):
+    """
+    :param paths: list of state json files or directories, DEFAULT_STATE_DIR if empty
+    :return: list of state json files
+    """
+    state_files = []
+    for path in paths or [DEFAULT_STATE_DIR]:
+        if os.path.isdir(path):
+            state_files += sorted(glob.glob(os.path.join(path, "*.json")))
+        else:
+            state_files.append(path)
+    return state_files
+
+
+def load_views(state_file):
+    with open(state_file, encoding="utf-8") as f:
+        return json.load(f)["views"]
+
+
+def views_to_tree(views):
+    """
+    rebuild the root node of an accessibility event from the saved views of a state
+    """
+    nodes = {}
+    for view in views:
+        node = {key: value for key, value in view.items() if key not in DERIVED_VIEW_KEYS}
+        (x1, y1), (x2, y2) = view["bounds"]
+        node["bounds"] = [x1, y1, x2, y2]
+        nodes[view["temp_id"]] = node
+    for view in views:
+        nodes[view["temp_id"]]["children"] = [nodes[child] for child in view["children"] if child in nodes]
+    return nodes[views[0]["temp_id"]]
+
+
+def count_nodes(tree):
+    num_nodes = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        num_nodes += 1
+        stack.extend(node["children"])
+    return num_nodes
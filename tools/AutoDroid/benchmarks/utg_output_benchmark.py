@@ -0,0 +1,118 @@
+# Measure the cost of MyUTG.add_transition per step as the graph grows, with my_utg.js rewritten on every step
+# (the previous behavior) and with the delayed rewrite.
+# Usage: python -m benchmarks.utg_output_benchmark [--states 5000] [--checkpoints 100 1000 ...]
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from droidbot import my_utg
+from droidbot.my_utg import MyUTG
+
+
+class FakeState(object):
+    def __init__(self, index):
+        self.structure_str = "structure_%d" % index
+        self.state_str = "state_%d" % index
+        self.foreground_activity = "com.example.app/com.example.app.Activity%d" % (index % 20)
+        self.screenshot_path = "states/screen_%d.png" % index
+        self.search_content = "view texts of state %d" % index
+        self.views = []
+        self.subtree_hashes = []
+
+    def to_dict(self):
+        return {"state_str": self.state_str, "views": []}
+
+
+class FakeEvent(object):
+    def __init__(self, index):
+        self.index = index
+
+    def get_event_str(self, state):
+        return "TouchEvent(state=%s, view=%d)" % (state.state_str, self.index)
+
+    def to_dict(self):
+        return {"event_type": "touch", "index": self.index}
+
+
+class FakeDevice(object):
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.serial = "emulator-5554"
+        self.resume_utg = False
+        self.utg_cache_budget = None
+
+    def get_model_number(self):
+        return "sdk_gphone_x86"
+
+    def get_sdk_version(self):
+        return 30
+
+
+class FakeApp(object):
+    package_name = "com.example.app"
+    main_activity = "com.example.app.Activity0"
+    activities = ["com.example.app.Activity%d" % i for i in range(20)]
+    hashes = ["md5", "sha1", "sha256"]
+
+
+def explore(num_states, checkpoints, rewrite_every_step):
+    """
+    add transitions to a new state, or back to a known one, until the graph has num_states states
+    :return: list of (num_states, average seconds per step since the previous checkpoint)
+    """
+    output_dir = tempfile.mkdtemp()
+    rng = random.Random(0)
+    utg = MyUTG(FakeDevice(output_dir), FakeApp(), random_input=False)
+    states = [FakeState(0)]
+    current = states[0]
+    utg.add_node(current, "function 0")
+    results = []
+    steps = 0
+    start = time.perf_counter()
+    num_steps = 0
+    try:
+        while len(states) < num_states:
+            if rng.random() < 0.7:
+                new_state = FakeState(len(states))
+                states.append(new_state)
+                utg.add_node(new_state, "function %d" % len(states))
+            else:
+                new_state = rng.choice(states)
+            utg.add_transition(FakeEvent(steps), current, new_state)
+            if rewrite_every_step:
+                utg.flush()
+            current = new_state
+            steps += 1
+            num_steps += 1
+            if checkpoints and len(states) >= checkpoints[0]:
+                results.append((checkpoints.pop(0), (time.perf_counter() - start) / num_steps))
+                start = time.perf_counter()
+                num_steps = 0
+        utg.close()
+    finally:
+        shutil.rmtree(output_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UTG output benchmark")
+    parser.add_argument("--states", type=int, default=5000, help="number of states of the final graph")
+    parser.add_argument("--checkpoints", type=int, nargs="*", default=[100, 500, 1000, 2000, 3000, 4000, 5000],
+                        help="graph sizes at which the average step time is reported")
+    opts = parser.parse_args()
+
+    # the delayed rewrite should not happen during the measurement
+    my_utg.UTG_OUTPUT_DELAY = 3600
+    checkpoints = sorted(c for c in opts.checkpoints if c <= opts.states)
+    rewrite = explore(opts.states, list(checkpoints), rewrite_every_step=True)
+    incremental = explore(opts.states, list(checkpoints), rewrite_every_step=False)
+
+    print("%8s %16s %16s" % ("states", "rewrite(ms)", "incremental(ms)"))
+    for (num_states, rewrite_time), (_, incremental_time) in zip(rewrite, incremental):
+        print("%8d %16.3f %16.3f" % (num_states, rewrite_time * 1000, incremental_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
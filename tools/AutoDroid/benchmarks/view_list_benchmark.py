@@ -0,0 +1,91 @@
+# Compare the cost of turning an accessibility event into the views and view tree of a state:
+# the previous deepcopy-based path against DroidBotAppConn.get_views and the shallow copies of DeviceState.
+# Usage: python -m benchmarks.view_list_benchmark [--state state.json|dir ...] [-n 20]
+import argparse
+import copy
+import os
+import time
+
+from droidbot.adapter.droidbot_app import DroidBotAppConn
+from .state_fixtures import find_state_files, load_views, views_to_tree, count_nodes
+
+
+def deepcopy_views(root_node):
+    """
+    the previous path: deepcopy the event tree, flatten it recursively,
+    then deepcopy the views (bk_views) and every node of the view tree again
+    """
+    def view_tree_to_list(view_tree, view_list):
+        tree_id = len(view_list)
+        view_tree['temp_id'] = tree_id
+        bounds = view_tree['bounds']
+        view_tree['bounds'] = [[bounds[0], bounds[1]], [bounds[2], bounds[3]]]
+        view_tree['size'] = "%d*%d" % (bounds[2] - bounds[0], bounds[3] - bounds[1])
+        view_list.append(view_tree)
+        children_ids = []
+        for child_tree in view_tree['children']:
+            child_tree['parent'] = tree_id
+            view_tree_to_list(child_tree, view_list)
+            children_ids.append(child_tree['temp_id'])
+        view_tree['children'] = children_ids
+
+    def assemble_view_tree(root_view, views):
+        for i, j in list(enumerate(root_view["children"])):
+            root_view["children"][i] = copy.deepcopy(views[j])
+            assemble_view_tree(root_view["children"][i], views)
+
+    view_tree = copy.deepcopy(root_node)
+    view_tree['parent'] = -1
+    views = []
+    view_tree_to_list(view_tree, views)
+    bk_views = copy.deepcopy(views)
+    tree = copy.deepcopy(views[0])
+    assemble_view_tree(tree, views)
+    return views, bk_views, tree
+
+
+def shared_views(conn, root_node):
+    """
+    the current path: flatten the event tree iteratively into shared view records,
+    then take the shallow copies a state works on
+    """
+    conn.last_acc_event = {'root_node': root_node}
+    raw_views = conn.get_views()
+    views = [dict(view) for view in raw_views]
+    bk_views = [dict(view) for view in views]
+    tree = dict(views[0])
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        node["children"] = [dict(views[j]) for j in node["children"]]
+        stack.extend(node["children"])
+    return views, bk_views, tree
+
+
+def timed(func, num):
+    t0 = time.perf_counter()
+    for _ in range(num):
+        func()
+    return (time.perf_counter() - t0) * 1000 / num
+
+
+def main():
+    parser = argparse.ArgumentParser(description="view list materialization benchmark")
+    parser.add_argument("--state", dest="states", nargs="*", help="recorded state json files or directories")
+    parser.add_argument("-n", dest="num", type=int, default=20, help="number of runs per state")
+    opts = parser.parse_args()
+
+    conn = DroidBotAppConn.__new__(DroidBotAppConn)
+    conn.ignore_ad = False
+
+    print("%-32s %8s %14s %14s %8s" % ("state", "nodes", "deepcopy(ms)", "shared(ms)", "speedup"))
+    for state_file in find_state_files(opts.states):
+        root_node = views_to_tree(load_views(state_file))
+        old_ms = timed(lambda: deepcopy_views(root_node), opts.num)
+        new_ms = timed(lambda: shared_views(conn, root_node), opts.num)
+        print("%-32s %8d %14.2f %14.2f %7.1fx" % (os.path.basename(state_file), count_nodes(root_node), old_ms, new_ms,
+                                                 old_ms / new_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Compare the memory kept per state by the dict copies of the views (the previous bk_views and view_tree)
+# against a ViewStore, over the states of a recorded exploration.
+# Usage: python -m benchmarks.view_store_memory_benchmark [--state <output_dir>/states|state.json ...]
+import argparse
+import os
+import tracemalloc
+
+from droidbot.view_store import ViewStore
+from .state_fixtures import find_state_files, load_views
+
+
+def dict_copies(views):
+    """
+    the previous copies: a shallow copy of every view, and a nested view tree of further copies
+    """
+    bk_views = [dict(view) for view in views]
+    view_tree = dict(views[0])
+    stack = [view_tree]
+    while stack:
+        node = stack.pop()
+        node["children"] = [dict(views[j]) for j in node["children"]]
+        stack.extend(node["children"])
+    return bk_views, view_tree
+
+
+def retained_size(build, all_views):
+    """
+    :return: list of bytes still allocated after building the copies of each state, all copies are kept
+    """
+    kept = []
+    sizes = []
+    tracemalloc.start()
+    for views in all_views:
+        before = tracemalloc.get_traced_memory()[0]
+        kept.append(build(views))
+        sizes.append(tracemalloc.get_traced_memory()[0] - before)
+    tracemalloc.stop()
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="view store memory benchmark")
+    parser.add_argument("--state", dest="states", nargs="*",
+                        help="state json files or directories, e.g. the states directory of a droidbot output")
+    opts = parser.parse_args()
+
+    state_files = find_state_files(opts.states)
+    all_views = [load_views(state_file) for state_file in state_files]
+    dict_sizes = retained_size(dict_copies, all_views)
+    store_sizes = retained_size(ViewStore, all_views)
+
+    print("%-32s %8s %12s %12s %8s" % ("state", "views", "dicts(KB)", "store(KB)", "ratio"))
+    for state_file, views, dict_size, store_size in zip(state_files, all_views, dict_sizes, store_sizes):
+        print("%-32s %8d %12.1f %12.1f %7.1fx" % (os.path.basename(state_file), len(views), dict_size / 1024.0,
+                                                 store_size / 1024.0, dict_size / float(store_size)))
+    print("%-32s %8d %12.1f %12.1f %7.1fx" % ("total", sum(len(views) for views in all_views),
+                                             sum(dict_sizes) / 1024.0, sum(store_sizes) / 1024.0,
+                                             sum(dict_sizes) / float(sum(store_sizes))))
+
+
+if __name__ == "__main__":
+    main()
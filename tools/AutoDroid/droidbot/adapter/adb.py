@@ -1,7 +1,12 @@
 # This is the interface for adb
 import subprocess
 import logging
+import os
 import re
+import socket
+import struct
+import threading
+from collections import deque
 from .adapter import Adapter
 import time
 try:
@@ -17,6 +22,256 @@ class ADBException(Exception):
     pass
 
 
+class ADBConnectionError(ADBException):
+    """
+    Failure to reach the adb server or the device transport, before any service request is sent to the device
+    """
+    pass
+
+
+ADB_TRANSPORT_SUBPROCESS = "subprocess"
+ADB_TRANSPORT_SOCKET = "socket"
+ADB_TRANSPORTS = [ADB_TRANSPORT_SUBPROCESS, ADB_TRANSPORT_SOCKET]
+
+ADB_SERVER_HOST = "127.0.0.1"
+ADB_SERVER_PORT = 5037
+ADB_SOCKET_POOL_SIZE = 2
+ADB_SOCKET_TIMEOUT = 60
+
+# packet ids of the shell v2 protocol
+SHELL_V2_STDOUT = 1
+SHELL_V2_STDERR = 2
+SHELL_V2_EXIT = 3
+
+
+class ADBHostConnection(object):
+    """
+    shell transport which speaks the adb server's host protocol over local sockets, see:
+    https://android.googlesource.com/platform/packages/modules/adb/+/refs/heads/main/OVERVIEW.TXT
+    The adb server closes a connection after serving one device service, so a small pool of
+    connections which have already been switched to the device transport is kept warm.
+    """
+
+    def __init__(self, serial, host=None, port=None, pool_size=ADB_SOCKET_POOL_SIZE, timeout=ADB_SOCKET_TIMEOUT):
+        """
+        :param serial: serial no of the device
+        :param host: address of the adb server, defaults to $ADB_SERVER_HOST or localhost
+        :param port: port of the adb server, defaults to $ANDROID_ADB_SERVER_PORT or 5037
+        :param pool_size: number of idle connections to keep
+        :param timeout: socket timeout in seconds
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.serial = serial
+        self.host = host or os.environ.get("ADB_SERVER_HOST", ADB_SERVER_HOST)
+        self.port = int(port or os.environ.get("ANDROID_ADB_SERVER_PORT", ADB_SERVER_PORT))
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.features = None
+        self.__idle = deque()
+        self.__lock = threading.Lock()
+        self.__refilling = False
+
+    @staticmethod
+    def __recv_exactly(sock, size):
+        buf = bytearray()
+        while len(buf) < size:
+            pkt = sock.recv(size - len(buf))
+            if not pkt:
+                raise ADBException("connection closed by adb server")
+            buf += pkt
+        return bytes(buf)
+
+    def __send_request(self, sock, request):
+        payload = request.encode("utf-8")
+        sock.sendall(b"%04x" % len(payload) + payload)
+        self.__check_status(sock, request, self.__recv_exactly(sock, 4))
+
+    def __send_pooled_request(self, sock, request):
+        """
+        send a request on a pooled connection, which can be stale (e.g. the adb server was restarted)
+        :return: False if the connection is stale, i.e. the write failed or the connection was closed before
+                 any response, then the request did not run and can be sent again on another connection
+        """
+        payload = request.encode("utf-8")
+        try:
+            sock.sendall(b"%04x" % len(payload) + payload)
+        except socket.error:
+            return False
+        try:
+            status = sock.recv(4)
+        except ConnectionResetError:
+            return False
+        if not status:
+            return False
+        if len(status) < 4:
+            status += self.__recv_exactly(sock, 4 - len(status))
+        self.__check_status(sock, request, status)
+        return True
+
+    def __check_status(self, sock, request, status):
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            msg = self.__read_message(sock)
+            raise ADBException("adb server rejected %s: %s" % (request, msg))
+        raise ADBException("invalid adb server response: %s" % status)
+
+    def __read_message(self, sock):
+        length = int(self.__recv_exactly(sock, 4), 16)
+        return self.__recv_exactly(sock, length).decode("utf-8", "replace")
+
+    @staticmethod
+    def __recv_all(sock):
+        chunks = []
+        while True:
+            pkt = sock.recv(65536)
+            if not pkt:
+                break
+            chunks.append(pkt)
+        return b"".join(chunks)
+
+    def __open(self):
+        return socket.create_connection((self.host, self.port), timeout=self.timeout)
+
+    def __open_transport(self):
+        try:
+            sock = self.__open()
+        except socket.error as e:
+            raise ADBConnectionError("failed to connect to adb server: %s" % e)
+        try:
+            self.__send_request(sock, "host:transport:%s" % self.serial)
+        except (socket.error, ADBException) as e:
+            sock.close()
+            raise ADBConnectionError("failed to switch to transport %s: %s" % (self.serial, e))
+        return sock
+
+    def __refill(self):
+        try:
+            while True:
+                with self.__lock:
+                    if len(self.__idle) >= self.pool_size:
+                        return
+                sock = self.__open_transport()
+                with self.__lock:
+                    self.__idle.append(sock)
+        except Exception as e:
+            self.logger.debug("failed to refill adb connection pool: %s" % e)
+        finally:
+            self.__refilling = False
+
+    def __take(self):
+        with self.__lock:
+            sock = self.__idle.popleft() if self.__idle else None
+            refill = not self.__refilling and self.pool_size > 0
+            if refill:
+                self.__refilling = True
+        if refill:
+            refill_thread = threading.Thread(target=self.__refill)
+            refill_thread.daemon = True
+            refill_thread.start()
+        if sock is None:
+            sock = self.__open_transport()
+        return sock
+
+    def get_features(self):
+        """
+        get the features supported by both the adb server and the device
+        :return: list of str
+        """
+        if self.features is None:
+            try:
+                sock = self.__open()
+            except socket.error as e:
+                raise ADBConnectionError("failed to connect to adb server: %s" % e)
+            try:
+                self.__send_request(sock, "host-serial:%s:features" % self.serial)
+                self.features = self.__read_message(sock).split(",")
+            except (socket.error, ADBException) as e:
+                raise ADBConnectionError("failed to get features of %s: %s" % (self.serial, e))
+            finally:
+                sock.close()
+        return self.features
+
+    def __run_service(self, service):
+        """
+        run a device service on a pooled connection.
+        an idle connection can be stale (e.g. the adb server was restarted), so retry once on a fresh one,
+        but only if the service did not reach the server, other errors are raised since it may have run
+        :raise ADBConnectionError: if no connection to the device transport could be opened
+        """
+        sock = self.__take()
+        try:
+            sent = self.__send_pooled_request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        if sent:
+            return sock
+        sock.close()
+        sock = self.__open_transport()
+        try:
+            self.__send_request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def shell(self, cmd_line):
+        """
+        run a command line in device shell
+        :param cmd_line: str, the (quoted) command line
+        :return: (bytes, int), stdout of the command and its exit code (None if unknown)
+        """
+        if "shell_v2" not in self.get_features():
+            sock = self.__run_service("shell:%s" % cmd_line)
+            try:
+                out = self.__recv_all(sock)
+            finally:
+                sock.close()
+            # the legacy shell service runs in a pty, which translates "\n" into "\r\n"
+            return out.replace(b"\r\n", b"\n"), None
+
+        sock = self.__run_service("shell,v2,raw:%s" % cmd_line)
+        stdout = []
+        exit_code = None
+        try:
+            while True:
+                header = sock.recv(5)
+                if not header:
+                    break
+                if len(header) < 5:
+                    header += self.__recv_exactly(sock, 5 - len(header))
+                packet_id, length = struct.unpack("<BI", header)
+                data = self.__recv_exactly(sock, length) if length else b""
+                if packet_id == SHELL_V2_STDOUT:
+                    stdout.append(data)
+                elif packet_id == SHELL_V2_STDERR:
+                    self.logger.debug(data.decode("utf-8", "replace"))
+                elif packet_id == SHELL_V2_EXIT:
+                    exit_code = data[0] if data else 0
+                    break
+        finally:
+            sock.close()
+        return b"".join(stdout), exit_code
+
+    def exec_out(self, cmd_line):
+        """
+        run a command line on device without a pty, so that binary output is not mangled
+        :param cmd_line: str, the (quoted) command line
+        :return: bytes, raw stdout of the command
+        """
+        sock = self.__run_service("exec:%s" % cmd_line)
+        try:
+            return self.__recv_all(sock)
+        finally:
+            sock.close()
+
+    def close(self):
+        with self.__lock:
+            while self.__idle:
+                self.__idle.popleft().close()
+
+
 class ADB(Adapter):
     """
     interface of ADB
@@ -47,6 +302,16 @@ class ADB(Adapter):
 
         self.cmd_prefix = ['adb', "-s", device.serial]
 
+        self.host_conn = None
+        if getattr(device, "adb_transport", ADB_TRANSPORT_SUBPROCESS) == ADB_TRANSPORT_SOCKET:
+            self.host_conn = ADBHostConnection(device.serial)
+
+        # read-only (ro.*) properties never change until reboot, and display info only changes on rotation
+        self.property_cache = {}
+        self.display_info = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def run_cmd(self, extra_args):
         """
         run an adb command and return the output
@@ -65,13 +330,34 @@ class ADB(Adapter):
 
         self.logger.debug('command:')
         self.logger.debug(args)
-        r = subprocess.check_output(args).strip()
+        r = None
+        if self.host_conn is not None and extra_args and extra_args[0] == 'shell':
+            r = self.__run_shell_via_host_conn(args, " ".join(extra_args[1:]))
+        if r is None:
+            r = subprocess.check_output(args)
+        r = r.strip()
         if not isinstance(r, str):
             r = r.decode()
         self.logger.debug('return:')
         self.logger.debug(r)
         return r
 
+    def __run_shell_via_host_conn(self, args, cmd_line):
+        """
+        run a shell command line through the host connection
+        :return: bytes output, or None if the adb server is unreachable and subprocess should be used instead
+        """
+        # only fall back before the command is sent, otherwise the command could run twice
+        try:
+            out, exit_code = self.host_conn.shell(cmd_line)
+        except ADBConnectionError as e:
+            self.logger.warning("adb host connection failed, falling back to subprocess: %s" % e)
+            return None
+        if exit_code:
+            # keep the behavior of subprocess.check_output, which fails when adb exits non-zero
+            raise subprocess.CalledProcessError(exit_code, args, output=out)
+        return out
+
     def shell(self, extra_args):
         """
         run an `adb shell` command
@@ -88,6 +374,28 @@ class ADB(Adapter):
         shell_extra_args = ['shell'] + [ quote(arg) for arg in extra_args ]
         return self.run_cmd(shell_extra_args)
 
+    def exec_out(self, extra_args):
+        """
+        run an `adb exec-out` command, which streams binary stdout of the command (e.g. screencap)
+        requires Android 5.0 (API 21) or above
+        @param extra_args:
+        @return: bytes, raw output of the command
+        """
+        if isinstance(extra_args, str):
+            extra_args = extra_args.split()
+        if not isinstance(extra_args, list):
+            msg = "invalid arguments: %s\nshould be list or str, %s given" % (extra_args, type(extra_args))
+            self.logger.warning(msg)
+            raise ADBException(msg)
+
+        cmd_line = " ".join([quote(arg) for arg in extra_args])
+        if self.host_conn is not None:
+            try:
+                return self.host_conn.exec_out(cmd_line)
+            except ADBConnectionError as e:
+                self.logger.warning("adb host connection failed, falling back to subprocess: %s" % e)
+        return subprocess.check_output(self.cmd_prefix + ["exec-out", cmd_line])
+
     def check_connectivity(self):
         """
         check if adb is connected
@@ -106,15 +414,43 @@ class ADB(Adapter):
         """
         disconnect adb
         """
+        if self.host_conn is not None:
+            self.host_conn.close()
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
-    def get_property(self, property_name):
+    def get_property(self, property_name, refresh=False):
         """
         get the value of property
+        read-only properties (ro.*) are cached
         @param property_name:
+        @param refresh: if set to True, query the device even if the value is cached
         @return:
         """
-        return self.shell(["getprop", property_name])
+        if not refresh and property_name in self.property_cache:
+            self.cache_hits += 1
+            return self.property_cache[property_name]
+        self.cache_misses += 1
+        value = self.shell(["getprop", property_name])
+        if property_name.startswith("ro."):
+            self.property_cache[property_name] = value
+        return value
+
+    def invalidate_display_info(self):
+        """
+        drop the cached display info, should be called when the screen is rotated
+        """
+        self.display_info = None
+
+    def get_cache_stats(self):
+        """
+        get hit/miss counters of the property and display info cache
+        :return: dict
+        """
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "cached_properties": len(self.property_cache)
+        }
 
     def get_model_number(self):
         """
@@ -148,9 +484,22 @@ class ADB(Adapter):
         """
         return int(self.get_property(ADB.RO_DEBUGGABLE_PROPERTY))
 
+    def get_display_info(self, refresh=False):
+        """
+        Get display dimensions, orientation and density.
+        The result is cached until the next rotation, see invalidate_display_info.
+        @param refresh: if set to True, query the device even if the display info is cached
+        """
+        if not refresh and self.display_info is not None:
+            self.cache_hits += 1
+            return self.display_info
+        self.cache_misses += 1
+        self.display_info = self.__query_display_info()
+        return self.display_info
+
     # The following methods are originally from androidviewclient project.
     # https://github.com/dtmilano/AndroidViewClient.
-    def get_display_info(self):
+    def __query_display_info(self):
         """
         Gets C{mDefaultViewport} and then C{deviceWidth} and C{deviceHeight} values from dumpsys.
         This is a method to obtain display dimensions and density
@@ -320,10 +669,11 @@ class ADB(Adapter):
         self.shell("input keyevent %s" % key_code)
 
     def touch(self, x, y, orientation=-1, event_type=DOWN_AND_UP):
+        cur_orientation = self.get_orientation()
         if orientation == -1:
-            orientation = self.get_orientation()
+            orientation = cur_orientation
         self.shell("input tap %d %d" %
-                   self.__transform_point_by_orientation((x, y), orientation, self.get_orientation()))
+                   self.__transform_point_by_orientation((x, y), orientation, cur_orientation))
 
     def long_touch(self, x, y, duration=2000, orientation=-1):
         """
@@ -341,10 +691,11 @@ class ADB(Adapter):
         """
         (x0, y0) = start_xy
         (x1, y1) = end_xy
+        cur_orientation = self.get_orientation()
         if orientation == -1:
-            orientation = self.get_orientation()
-        (x0, y0) = self.__transform_point_by_orientation((x0, y0), orientation, self.get_orientation())
-        (x1, y1) = self.__transform_point_by_orientation((x1, y1), orientation, self.get_orientation())
+            orientation = cur_orientation
+        (x0, y0) = self.__transform_point_by_orientation((x0, y0), orientation, cur_orientation)
+        (x1, y1) = self.__transform_point_by_orientation((x1, y1), orientation, cur_orientation)
 
         version = self.get_sdk_version()
         if version <= 15:
@@ -3,6 +3,11 @@
 # https://github.com/hjaurum/DHash/blob/master/dHash.py
 
 
+DHASH_WIDTH = 18
+DHASH_HEIGHT = 16
+DHASH_BYTES = DHASH_HEIGHT * (DHASH_WIDTH - 1) // 8
+
+
 def _intersect(rect1, rect2):
     """
     Check whether two rectangles intersect.
@@ -24,6 +29,43 @@ def _intersect(rect1, rect2):
     return x_intersect and y_intersect
 
 
+def _intersect_matrix(rects):
+    """
+    Check whether each pair of rectangles intersect, same as `_intersect` on all pairs.
+    :param rects: numpy.ndarray of shape (n, 4+), each row is (x,y,w,h,...)
+    :return: numpy.ndarray of shape (n, n), of bool
+    """
+    x, y, w, h = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+    dx = x[None, :] - x[:, None]
+    dy = y[None, :] - y[:, None]
+    x_intersect = ((dx >= 0) & (dx < w[:, None])) | ((dx <= 0) & (-dx < w[None, :]))
+    y_intersect = ((dy >= 0) & (dy < h[:, None])) | ((dy <= 0) & (-dy < h[None, :]))
+    return x_intersect & y_intersect
+
+
+def _suppress_rectangles(rects):
+    """
+    Keep rectangles in order, a new rectangle replaces the intersecting kept ones unless it has more corners
+    than one of them, in which case it is dropped (together with the kept ones checked before that one).
+    :param rects: numpy.ndarray of shape (n, 5), each row is (x,y,w,h,approxPoly_corner_count)
+    :return: numpy.ndarray of bool, whether each rectangle is kept
+    """
+    import numpy
+    intersect = _intersect_matrix(rects)
+    corners = rects[:, 4]
+    kept = numpy.zeros(len(rects), dtype=bool)
+    for i in range(len(rects)):
+        prior = numpy.flatnonzero(kept[:i] & intersect[i, :i])
+        if prior.size:
+            blockers = prior[corners[prior] < corners[i]]
+            if blockers.size:
+                kept[prior[prior < blockers[0]]] = False
+                continue
+            kept[prior] = False
+        kept[i] = True
+    return kept
+
+
 def load_image_from_path(img_path):
     """
     Load an image from path
@@ -42,7 +84,7 @@ def load_image_from_buf(img_bytes):
     """
     import cv2
     import numpy
-    img_bytes = numpy.array(img_bytes)
+    img_bytes = numpy.frombuffer(img_bytes, dtype=numpy.uint8)
     return cv2.imdecode(img_bytes, cv2.IMREAD_UNCHANGED)
 
 
@@ -53,6 +95,7 @@ def find_views(img):
     :return: a list of rectangles, each of which is a tuple (x,y,w,h) representing an identified UI view.
     """
     import cv2
+    import numpy
     x_scale = 0.3
     y_scale = 0.3
     # resize to a smaller image
@@ -72,7 +115,7 @@ def find_views(img):
     edges = blue_edges | green_edges | red_edges
     # find contour
     contours, hierarchy = cv2.findContours(edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-    rectangle_list = []
+    candidates = []
     for index, cnt in enumerate(contours):
         contour_area = cv2.contourArea(cnt)
         # area constraint
@@ -84,29 +127,18 @@ def find_views(img):
         approx = cv2.approxPolyDP(cnt, epsilon, True)
         if len(approx) == 2:
             continue
-        new_rectangle = (x, y, w, h, len(approx))
-        should_append = True
-        remove_list = []
-        for index, rectangle in enumerate(rectangle_list):
-            if _intersect(new_rectangle, rectangle):
-                if new_rectangle[4] > rectangle[4]:
-                    should_append = False
-                    break
-                else:
-                    remove_list.append(index)
-        remove_list.reverse()
-        for index in remove_list:
-            del rectangle_list[index]
-        if should_append:
-            rectangle_list.append(new_rectangle)
-
-    result_rectangles = [
-        (int(float(x)/x_scale), int(float(y)/y_scale), int(float(w)/x_scale), int(float(h)/y_scale))
-        for x, y, w, h, len_approx in rectangle_list]
+        candidates.append((x, y, w, h, len(approx)))
+    if not candidates:
+        return []
+
+    rectangles = numpy.array(candidates, dtype=numpy.int64)
+    rectangles = rectangles[_suppress_rectangles(rectangles)]
+    rectangles = (rectangles[:, :4] / numpy.array([x_scale, y_scale, x_scale, y_scale])).astype(int)
+    result_rectangles = [tuple(rect) for rect in rectangles.tolist()]
 
     # For debugging, show the image
     # print result_rectangles
-    # for x, y, w, h, len_approx in rectangle_list:
+    # for x, y, w, h in result_rectangles:
     #     cv2.rectangle(img, (x, y), (x+w, y+h), (0, 255, 0), 5)
     # cv2.imshow('image', img)
     # cv2.waitKey(0)
@@ -119,41 +151,63 @@ def calculate_dhash(img):
     """
     Calculate the dhash value of an image.
     :param img: numpy.ndarray, representing an image in opencv
-    :return:
+    :return: str, the hex string of the dhash
     """
-    difference = _calculate_pixel_difference(img)
-    # convert to hex
-    decimal_value = 0
-    hash_string = ""
-    for index, value in enumerate(difference):
-        if value:
-            decimal_value += value * (2 ** (index % 8))
-        if index % 8 == 7:  # every eight binary bit to one hex number
-            hash_string += str(hex(decimal_value)[2:-1].rjust(2, "0"))  # 0xf=>0x0f
-            decimal_value = 0
-    return hash_string
+    return _calculate_dhash_bytes([img])[0].tobytes().hex()
 
 
-def _calculate_pixel_difference(img):
+def calculate_dhashes(img, rects):
     """
-    Calculate difference between pixels
+    Calculate the dhash values of multiple regions of an image in one call.
     :param img: numpy.ndarray, representing an image in opencv
+    :param rects: list of (x,y,w,h)
+    :return: list of str, the hex strings of the dhashes, see `calculate_dhash`
     """
-    import cv2
-    resize_width = 18
-    resize_height = 16
-    # 1. resize to 18*16
-    smaller_image = cv2.resize(img, (resize_width, resize_height))
+    if len(rects) == 0:
+        return []
+    packed = _calculate_dhash_bytes([img[y:y + h, x:x + w] for x, y, w, h in rects])
+    return [row.tobytes().hex() for row in packed]
+
 
-    # 2. calculate grayscale
-    grayscale_image = cv2.cvtColor(smaller_image, cv2.COLOR_BGR2GRAY)
+def _calculate_dhash_bytes(imgs):
+    """
+    Calculate the dhash values of images as packed bits
+    :param imgs: list of numpy.ndarray, representing images in opencv
+    :return: numpy.ndarray of shape (len(imgs), DHASH_BYTES), of uint8
+    """
+    import numpy
+    difference = _calculate_pixel_difference(imgs)
+    # the first pixel of each group of eight is the lowest bit of a byte
+    return numpy.packbits(difference.reshape(len(imgs), -1), axis=1, bitorder="little")
+
+
+def _calculate_pixel_difference(imgs):
+    """
+    Calculate difference between pixels
+    :param imgs: list of numpy.ndarray, representing images in opencv
+    :return: numpy.ndarray of shape (len(imgs), DHASH_HEIGHT, DHASH_WIDTH - 1), of bool
+    """
+    import cv2
+    import numpy
+    # 1. resize to 18*16, 2. calculate grayscale
+    grayscale_images = numpy.stack([
+        cv2.cvtColor(cv2.resize(img, (DHASH_WIDTH, DHASH_HEIGHT)), cv2.COLOR_BGR2GRAY)
+        for img in imgs])
 
     # 3. calculate difference between pixels
-    difference = []
-    for row in range(resize_height):
-        for col in range(resize_width - 1):
-            difference.append(grayscale_image[row][col] > grayscale_image[row][col + 1])
-    return difference
+    return grayscale_images[:, :, :-1] > grayscale_images[:, :, 1:]
+
+
+def _popcount(packed):
+    """
+    Count the set bits in each row of packed bits
+    :param packed: numpy.ndarray of uint8
+    :return: numpy.ndarray of int, summed over the last axis
+    """
+    import numpy
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(packed).sum(axis=-1, dtype=int)
+    return numpy.unpackbits(packed, axis=-1).sum(axis=-1, dtype=int)
 
 
 def img_hamming_distance(img1, img2):
@@ -168,14 +222,8 @@ def img_hamming_distance(img1, img2):
         return dhash_hamming_distance(img1, img2)
 
     # B. use numpy.ndarray to calculate hamming distance
-    _hamming_distance = 0
-    image1_difference = _calculate_pixel_difference(img1)
-    image2_difference = _calculate_pixel_difference(img2)
-    for index, img1_pix in enumerate(image1_difference):
-        img2_pix = image2_difference[index]
-        if img1_pix != img2_pix:
-            _hamming_distance += 1
-    return _hamming_distance
+    packed = _calculate_dhash_bytes([img1, img2])
+    return int(_popcount(packed[0] ^ packed[1]))
 
 
 def dhash_hamming_distance(dhash1, dhash2):
@@ -187,3 +235,21 @@ def dhash_hamming_distance(dhash1, dhash2):
     """
     difference = (int(dhash1, 16)) ^ (int(dhash2, 16))
     return bin(difference).count("1")
+
+
+def dhash_hamming_distances(dhashes1, dhashes2):
+    """
+    Calculate the pairwise hamming distances between two lists of dhash values
+    :param dhashes1: list of str, dhashes returned by `calculate_dhash` or `calculate_dhashes`
+    :param dhashes2: list of str
+    :return: numpy.ndarray of shape (len(dhashes1), len(dhashes2)), of int
+    """
+    import numpy
+
+    def to_packed(dhashes):
+        return numpy.frombuffer(b"".join(bytes.fromhex(dhash) for dhash in dhashes),
+                                dtype=numpy.uint8).reshape(len(dhashes), -1)
+
+    packed1 = to_packed(dhashes1)
+    packed2 = to_packed(dhashes2)
+    return _popcount(packed1[:, None, :] ^ packed2[None, :, :])
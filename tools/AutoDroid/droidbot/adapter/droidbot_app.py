@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import socket
 import subprocess
@@ -5,6 +6,7 @@ import time
 import json
 import struct
 import traceback
+from collections import OrderedDict
 from .adapter import Adapter
 
 DROIDBOT_APP_REMOTE_ADDR = "tcp:7336"
@@ -13,6 +15,20 @@ DROIDBOT_APP_PACKET_HEAD_LEN = 6
 ACCESSIBILITY_SERVICE = DROIDBOT_APP_PACKAGE + "/io.github.privacystreams.accessibility.PSAccessibilityService"
 MAX_NUM_GET_VIEWS = 5
 GET_VIEW_WAIT_TIME = 1
+# the UI is considered settled when the view structure has not changed for UI_SETTLE_QUIET_TIME seconds,
+# and either it changed since the wait began or UI_SETTLE_MIN_WAIT seconds have passed
+UI_SETTLE_QUIET_TIME = 0.3
+UI_SETTLE_MIN_WAIT = 0.5
+UI_SETTLE_POLL_INTERVAL = 0.05
+# accessibility messages: a full snapshot of the window, or a list of patches to the last tree
+ACC_EVENT_PREFIX = "AccEvent >>> "
+ACC_DIFF_PREFIX = "AccDiff >>> "
+# sent to the app to ask for a full snapshot after a diff did not apply
+ACC_SNAPSHOT_REQUEST = "AccSnapshot <<< "
+# the key of the stable node identity that patches refer to
+ACC_NODE_ID_KEY = "node_id"
+# number of applied diffs whose dirty nodes are kept, see get_dirty_node_ids
+ACC_DIRTY_LOG_SIZE = 64
 
 
 class DroidBotAppConnException(Exception):
@@ -52,6 +68,17 @@ class DroidBotAppConn(Adapter):
 
         self.sock = None
         self.last_acc_event = None
+        # index of the canonical tree (the tree of last_acc_event) for applying diffs
+        self.acc_nodes = {}
+        self.acc_parents = {}
+        self.acc_root_id = None
+        self.acc_seq = None
+        # number of snapshots received, the seq of a diff stream starts over from each snapshot
+        self.acc_generation = 0
+        # seq of an applied diff -> (seq of the tree it applied to, dirty node ids), oldest first
+        self.acc_dirty_log = OrderedDict()
+        self.acc_snapshot_requested = False
+        self.num_acc_desyncs = 0
         self.enable_accessibility_hard = device.enable_accessibility_hard
         self.ignore_ad = device.ignore_ad
         if self.ignore_ad:
@@ -149,18 +176,29 @@ class DroidBotAppConn(Adapter):
                 # clear self.last_acc_event
                 self.logger.warning("Restarting droidbot app")
                 self.last_acc_event = None
+                self.acc_seq = None
                 self.disconnect()
                 self.connect()
 
     def handle_message(self, message):
-        acc_event_idx = message.find("AccEvent >>> ")
+        acc_event_idx = message.find(ACC_EVENT_PREFIX)
         if acc_event_idx >= 0:
             if acc_event_idx > 0:
                 self.logger.warning("Invalid data before packet head: " + message[:acc_event_idx])
-            body = json.loads(message[acc_event_idx + len("AccEvent >>> "):])
+            body = json.loads(message[acc_event_idx + len(ACC_EVENT_PREFIX):])
+            self.__index_acc_tree(body)
             self.last_acc_event = body
             return
 
+        acc_diff_idx = message.find(ACC_DIFF_PREFIX)
+        if acc_diff_idx >= 0:
+            if acc_diff_idx > 0:
+                self.logger.warning("Invalid data before packet head: " + message[:acc_diff_idx])
+            acc_event = self.__apply_acc_diff(json.loads(message[acc_diff_idx + len(ACC_DIFF_PREFIX):]))
+            if acc_event is not None:
+                self.last_acc_event = acc_event
+            return
+
         rotation_idx = message.find("rotation >>> ")
         if rotation_idx >= 0:
             if rotation_idx > 0:
@@ -171,6 +209,165 @@ class DroidBotAppConn(Adapter):
         self.logger.warning("Unhandled message from droidbot app: " + message)
         raise DroidBotAppConnException()
 
+    def __index_subtree(self, node, parent_id):
+        stack = [(node, parent_id)]
+        while stack:
+            node, parent_id = stack.pop()
+            node_id = node.get(ACC_NODE_ID_KEY)
+            if node_id is None:
+                raise KeyError(ACC_NODE_ID_KEY)
+            self.acc_nodes[node_id] = node
+            self.acc_parents[node_id] = parent_id
+            for child in node.get('children') or []:
+                stack.append((child, node_id))
+
+    def __unindex_subtree(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node_id = node[ACC_NODE_ID_KEY]
+            self.acc_nodes.pop(node_id, None)
+            self.acc_parents.pop(node_id, None)
+            stack.extend(node.get('children') or [])
+
+    def __index_acc_tree(self, acc_event):
+        """
+        take a full snapshot as the canonical tree, diffs based on its sequence number can be applied then
+        snapshots without sequence number or node identities (from app versions without diff mode) are not indexed
+        """
+        self.acc_nodes = {}
+        self.acc_parents = {}
+        self.acc_seq = None
+        self.acc_dirty_log.clear()
+        self.acc_snapshot_requested = False
+        self.acc_generation += 1
+        acc_event['generation'] = self.acc_generation
+        root_node = acc_event.get('root_node')
+        if not root_node or acc_event.get('seq') is None:
+            return
+        try:
+            self.__index_subtree(root_node, None)
+        except KeyError:
+            self.acc_nodes = {}
+            self.acc_parents = {}
+            return
+        self.acc_root_id = root_node[ACC_NODE_ID_KEY]
+        self.acc_seq = acc_event['seq']
+
+    def __apply_acc_diff(self, diff):
+        """
+        apply a diff to the canonical tree
+        the patched nodes and their ancestors are copied, the other nodes are shared with the previous tree,
+        so the previous event (and the states built from it) stay unchanged
+        :param diff: dict, {"base": seq of the tree it applies to, "seq": seq of the result, "patches": [patch]}
+            a patch is {"op": "add", "parent": node_id, "index": int, "node": node},
+            {"op": "remove", "node_id": node_id} or {"op": "update", "node_id": node_id, "fields": dict}
+        :return: the new accessibility event, with "dirty_node_ids" listing the nodes whose subtrees changed,
+            or None if the diff does not apply, in which case diffs are dropped until the next full snapshot
+        """
+        if self.acc_seq is None or diff.get('base') != self.acc_seq:
+            return self.__acc_desync("diff based on %s, the canonical tree is %s" % (diff.get('base'), self.acc_seq))
+
+        # node_id -> copy of the node in the new tree
+        copied = {}
+
+        def copy_path(node_id):
+            path = []
+            ancestor_id = node_id
+            while ancestor_id is not None and ancestor_id not in copied:
+                path.append(ancestor_id)
+                ancestor_id = self.acc_parents[ancestor_id]
+            for ancestor_id in reversed(path):
+                node = self.acc_nodes[ancestor_id]
+                node_copy = dict(node)
+                node_copy['children'] = list(node.get('children') or [])
+                parent_id = self.acc_parents[ancestor_id]
+                if parent_id is not None:
+                    siblings = copied[parent_id]['children']
+                    siblings[next(i for i, child in enumerate(siblings) if child is node)] = node_copy
+                copied[ancestor_id] = node_copy
+                self.acc_nodes[ancestor_id] = node_copy
+            return copied[node_id]
+
+        try:
+            for patch in diff['patches']:
+                op = patch['op']
+                if op == 'update':
+                    node = copy_path(patch['node_id'])
+                    node.update(patch['fields'])
+                elif op == 'add':
+                    parent = copy_path(patch['parent'])
+                    index = patch.get('index', len(parent['children']))
+                    parent['children'].insert(index, patch['node'])
+                    self.__index_subtree(patch['node'], patch['parent'])
+                elif op == 'remove':
+                    node = self.acc_nodes[patch['node_id']]
+                    parent_id = self.acc_parents[patch['node_id']]
+                    if parent_id is None:
+                        raise KeyError("root node")
+                    parent = copy_path(parent_id)
+                    parent['children'] = [child for child in parent['children'] if child is not node]
+                    self.__unindex_subtree(node)
+                else:
+                    raise KeyError(op)
+        except (KeyError, StopIteration) as e:
+            return self.__acc_desync("unable to apply patch: %s" % e)
+
+        dirty_node_ids = [node_id for node_id in copied if node_id in self.acc_nodes]
+        self.acc_dirty_log[diff['seq']] = (self.acc_seq, dirty_node_ids)
+        while len(self.acc_dirty_log) > ACC_DIRTY_LOG_SIZE:
+            self.acc_dirty_log.popitem(last=False)
+        self.acc_seq = diff['seq']
+        acc_event = dict(self.last_acc_event)
+        acc_event.pop('view_list', None)
+        acc_event['seq'] = diff['seq']
+        acc_event['root_node'] = self.acc_nodes[self.acc_root_id]
+        acc_event['dirty_node_ids'] = dirty_node_ids
+        return acc_event
+
+    def __acc_desync(self, reason):
+        self.logger.warning("Accessibility tree out of sync (%s), requesting a full snapshot" % reason)
+        self.num_acc_desyncs += 1
+        self.acc_nodes = {}
+        self.acc_parents = {}
+        self.acc_seq = None
+        self.acc_dirty_log.clear()
+        if not self.acc_snapshot_requested:
+            self.acc_snapshot_requested = self.__request_acc_snapshot()
+        return None
+
+    def __request_acc_snapshot(self):
+        """
+        ask the app to send a full snapshot, the following diffs are dropped until it arrives
+        :return: True if the request was sent
+        """
+        message = ACC_SNAPSHOT_REQUEST.encode()
+        try:
+            self.sock.sendall(struct.pack(">BBI", 0, 0, len(message)) + message)
+        except (socket.error, AttributeError) as e:
+            self.logger.warning("Failed to request an accessibility snapshot: %s" % e)
+            return False
+        return True
+
+    def get_dirty_node_ids(self, base_version, version):
+        """
+        get the nodes whose subtrees changed between two trees of the diff stream
+        :param base_version: (generation, seq) of the earlier tree, as returned by get_acc_views
+        :param version: (generation, seq) of the later tree
+        :return: set of node ids, or None if the trees are not linked by the kept diffs (e.g. a snapshot in between)
+        """
+        if base_version is None or version is None or base_version[0] != version[0]:
+            return None
+        base_seq, seq = base_version[1], version[1]
+        dirty_node_ids = set()
+        while seq != base_seq:
+            entry = self.acc_dirty_log.get(seq)
+            if entry is None:
+                return None
+            seq, node_ids = entry
+            dirty_node_ids.update(node_ids)
+        return dirty_node_ids
+
     def check_connectivity(self):
         """
         check if droidbot app is connected
@@ -196,56 +393,121 @@ class DroidBotAppConn(Adapter):
             print(e)
         self.__can_wait = False
 
-    def __view_tree_to_list(self, view_tree, view_list):
-        tree_id = len(view_list)
-        view_tree['temp_id'] = tree_id
-
-        bounds = [[-1, -1], [-1, -1]]
-        bounds[0][0] = view_tree['bounds'][0]
-        bounds[0][1] = view_tree['bounds'][1]
-        bounds[1][0] = view_tree['bounds'][2]
-        bounds[1][1] = view_tree['bounds'][3]
-        width = bounds[1][0] - bounds[0][0]
-        height = bounds[1][1] - bounds[0][1]
-        view_tree['size'] = "%d*%d" % (width, height)
-        view_tree['bounds'] = bounds
-
-        view_list.append(view_tree)
-        children_ids = []
-        for child_tree in view_tree['children']:
-            if self.ignore_ad and child_tree['resource_id'] is not None:
-                id_word_list = self.__id_convert(child_tree['resource_id']).split('_')
-                if "ad" in id_word_list or \
-                   "banner" in id_word_list:
-                    continue
-            child_tree['parent'] = tree_id
-            self.__view_tree_to_list(child_tree, view_list)
-            children_ids.append(child_tree['temp_id'])
-        view_tree['children'] = children_ids
+    def __is_ad_view(self, view_tree):
+        if view_tree['resource_id'] is None:
+            return False
+        id_word_list = self.__id_convert(view_tree['resource_id']).split('_')
+        return "ad" in id_word_list or "banner" in id_word_list
+
+    def __view_tree_to_list(self, view_tree):
+        """
+        flatten the view tree in pre-order, without modifying it
+        each view is a shallow copy of a tree node, with bounds converted and children replaced by temp_ids
+        :param view_tree: dict, the root node in an accessibility event
+        :return: list of views
+        """
+        view_list = []
+        # (node, temp_id of its parent)
+        stack = [(view_tree, -1)]
+        while stack:
+            node, parent_id = stack.pop()
+            tree_id = len(view_list)
+            view = dict(node)
+            x1, y1, x2, y2 = node['bounds'][:4]
+            view['temp_id'] = tree_id
+            view['parent'] = parent_id
+            view['bounds'] = [[x1, y1], [x2, y2]]
+            view['size'] = "%d*%d" % (x2 - x1, y2 - y1)
+            view['children'] = []
+            view_list.append(view)
+            if parent_id >= 0:
+                view_list[parent_id]['children'].append(tree_id)
+
+            children = node['children']
+            if self.ignore_ad:
+                children = [child for child in children if not self.__is_ad_view(child)]
+            for child in reversed(children):
+                stack.append((child, tree_id))
+        return view_list
+
+    @staticmethod
+    def __structure_hash(acc_event):
+        """
+        hash the structure of the view tree in an accessibility event, ignoring texts and other contents
+        """
+        if not acc_event or not acc_event.get('root_node'):
+            return None
+        structure_md5 = hashlib.md5()
+        stack = [acc_event['root_node']]
+        while stack:
+            node = stack.pop()
+            structure_md5.update(("%s|%s|%s;" % (node.get('class'), node.get('resource_id'),
+                                                 node.get('bounds'))).encode())
+            stack.extend(reversed(node.get('children') or []))
+        return structure_md5.hexdigest()
+
+    def wait_for_settle(self, max_wait, quiet_time=UI_SETTLE_QUIET_TIME, min_wait=UI_SETTLE_MIN_WAIT):
+        """
+        wait until the UI is quiescent, i.e. the accessibility events stop changing the view structure
+        :param max_wait: the ceiling of waiting time in seconds
+        :param quiet_time: how long the view structure should stay unchanged
+        :param min_wait: how long to wait if the view structure does not change at all
+        :return: True if the UI settled, False if max_wait is reached
+        """
+        start_time = time.time()
+        deadline = start_time + max_wait
+        last_event = self.last_acc_event
+        last_hash = self.__structure_hash(last_event)
+        last_change_time = start_time
+        changed = False
+        while True:
+            now = time.time()
+            acc_event = self.last_acc_event
+            if acc_event is not last_event:
+                last_event = acc_event
+                structure_hash = self.__structure_hash(acc_event)
+                if structure_hash != last_hash:
+                    last_hash = structure_hash
+                    last_change_time = now
+                    changed = True
+            if now - last_change_time >= quiet_time and (changed or now - start_time >= min_wait):
+                return True
+            if now >= deadline:
+                return False
+            time.sleep(min(UI_SETTLE_POLL_INTERVAL, deadline - now))
 
     def get_views(self):
+        return self.get_acc_views()[0]
+
+    def get_acc_views(self):
+        """
+        get the views of the last accessibility event
+        :return: (list of views, (generation, seq) of the event in the diff stream),
+            the version is None for events without a seq
+        """
         get_views_times = 0
         while not self.last_acc_event:
             self.logger.warning("last_acc_event is None, waiting")
             get_views_times += 1
             if get_views_times > MAX_NUM_GET_VIEWS:
                 self.logger.warning("cannot get non-None last_acc_event")
-                return None
+                return None, None
             time.sleep(GET_VIEW_WAIT_TIME)
 
-        if 'view_list' in self.last_acc_event:
-            return self.last_acc_event['view_list']
+        # the listening thread replaces last_acc_event, read it once
+        acc_event = self.last_acc_event
+        version = (acc_event.get('generation'), acc_event['seq']) if acc_event.get('seq') is not None else None
+        if 'view_list' in acc_event:
+            return acc_event['view_list'], version
 
-        import copy
-        view_tree = copy.deepcopy(self.last_acc_event['root_node'])
+        view_tree = acc_event['root_node']
         # print view_tree
         if not view_tree:
-            return None
-        view_tree['parent'] = -1
-        view_list = []
-        self.__view_tree_to_list(view_tree, view_list)
-        self.last_acc_event['view_list'] = view_list
-        return view_list
+            return None, None
+        # the view list is cached in the event and shared by the states built from it, do not modify it
+        view_list = self.__view_tree_to_list(view_tree)
+        acc_event['view_list'] = view_list
+        return view_list, version
 
 
 if __name__ == "__main__":
@@ -1,7 +1,23 @@
 import subprocess
 import logging
-import copy
+import sys
+import threading
+from collections import deque, namedtuple
 from .adapter import Adapter
+from ..utils import LOGCAT_THREADTIME_RE
+try:
+    import queue # Python 3
+except ImportError:
+    import Queue as queue # Python 2
+
+# caps of the in-memory logcat buffer, the oldest lines are dropped when either is exceeded
+LOGCAT_MAX_LINES = 100000
+LOGCAT_MAX_BYTES = 32 * 1024 * 1024
+# size of the write buffer of logcat.txt
+LOGCAT_FILE_BUFFER_SIZE = 1024 * 1024
+
+# a parsed logcat line, pid and tag are None if the line is not in threadtime format
+LogcatRecord = namedtuple("LogcatRecord", ["seq", "date", "time", "pid", "tid", "level", "tag", "content", "line"])
 
 
 class Logcat(Adapter):
@@ -9,10 +25,12 @@ class Logcat(Adapter):
     A connection with the target device through logcat.
     """
 
-    def __init__(self, device=None):
+    def __init__(self, device=None, max_lines=LOGCAT_MAX_LINES, max_bytes=LOGCAT_MAX_BYTES):
         """
         initialize logcat connection
         :param device: a Device instance
+        :param max_lines: maximum number of lines kept in memory
+        :param max_bytes: maximum memory held by the lines kept in memory
         """
         self.logger = logging.getLogger(self.__class__.__name__)
         if device is None:
@@ -22,21 +40,35 @@ class Logcat(Adapter):
         self.connected = False
         self.process = None
         self.parsers = []
-        self.recent_lines = []
         if device.output_dir is None:
             self.out_file = None
         else:
             self.out_file = "%s/logcat.txt" % device.output_dir
 
+        # ring buffer of records, with per-pid and per-tag indexes in the same (arrival) order
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.records = deque()
+        self.records_by_pid = {}
+        self.records_by_tag = {}
+        self.num_bytes = 0
+        self.num_dropped = 0
+        self.__last_seq = 0
+        self.__read_seq = 0
+        self.__lock = threading.Lock()
+        self.__sink_queue = queue.Queue()
+
     def connect(self):
-        self.device.adb.run_cmd("logcat -c")
+        self.device.adb.shell("logcat -c")
         self.process = subprocess.Popen(["adb", "-s", self.device.serial, "logcat", "-v", "threadtime", "*:I"],
                                         stdin=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
                                         stdout=subprocess.PIPE)
-        import threading
         listen_thread = threading.Thread(target=self.handle_output)
         listen_thread.start()
+        if self.out_file is not None:
+            sink_thread = threading.Thread(target=self.write_output)
+            sink_thread.start()
 
     def disconnect(self):
         self.connected = False
@@ -46,33 +78,128 @@ class Logcat(Adapter):
     def check_connectivity(self):
         return self.connected
 
-    def get_recent_lines(self):
-        lines = self.recent_lines
-        self.recent_lines = []
-        return lines
+    def add_line(self, line):
+        """
+        parse a logcat line and append it to the buffer, dropping the oldest lines if it is full
+        :return: LogcatRecord
+        """
+        m = LOGCAT_THREADTIME_RE.match(line.rstrip("\r\n"))
+        with self.__lock:
+            self.__last_seq += 1
+            if m:
+                record = LogcatRecord(self.__last_seq, m.group('date'), m.group('time'), int(m.group('pid')),
+                                      int(m.group('tid')), m.group('level'), m.group('tag').strip(),
+                                      m.group('content'), line)
+            else:
+                record = LogcatRecord(self.__last_seq, None, None, None, None, None, None, line, line)
+            self.records.append(record)
+            self.num_bytes += Logcat.__get_record_size(record)
+            if record.pid is not None:
+                self.records_by_pid.setdefault(record.pid, deque()).append(record)
+                self.records_by_tag.setdefault(record.tag, deque()).append(record)
+            while len(self.records) > self.max_lines or self.num_bytes > self.max_bytes:
+                self.__drop_oldest()
+        return record
+
+    @staticmethod
+    def __get_record_size(record):
+        """
+        the memory held by a record's strings: its line, and its content if it is a separate string
+        """
+        size = sys.getsizeof(record.line)
+        if record.content is not record.line:
+            size += sys.getsizeof(record.content)
+        return size
+
+    def __drop_oldest(self):
+        record = self.records.popleft()
+        self.num_bytes -= Logcat.__get_record_size(record)
+        self.num_dropped += 1
+        if record.pid is None:
+            return
+        # the oldest record overall is also the oldest one in its indexes
+        for index, key in ((self.records_by_pid, record.pid), (self.records_by_tag, record.tag)):
+            records = index[key]
+            records.popleft()
+            if not records:
+                del index[key]
+
+    def get_records(self, pid=None, tag=None, since_seq=0):
+        """
+        get buffered records, using the per-pid or per-tag index if given
+        the cost is proportional to the number of returned records
+        :param pid: int, only get records of this process
+        :param tag: str, only get records with this tag
+        :param since_seq: only get records newer than this sequence number
+        :return: list of LogcatRecord, from old to new
+        """
+        with self.__lock:
+            if pid is not None:
+                records = self.records_by_pid.get(int(pid), ())
+            elif tag is not None:
+                records = self.records_by_tag.get(tag, ())
+            else:
+                records = self.records
+            result = []
+            for record in reversed(records):
+                if record.seq <= since_seq:
+                    break
+                if tag is not None and record.tag != tag:
+                    continue
+                result.append(record)
+        result.reverse()
+        return result
+
+    def get_recent_lines(self, pid=None):
+        """
+        get the lines received since the last call
+        :param pid: int, only return lines of this process
+        :return: list of str
+        """
+        since_seq = self.__read_seq
+        self.__read_seq = self.__last_seq
+        return [record.line for record in self.get_records(pid=pid, since_seq=since_seq)
+                if record.seq <= self.__read_seq]
 
     def handle_output(self):
         self.connected = True
 
-        f = None
-        if self.out_file is not None:
-            f = open(self.out_file, 'w', encoding='utf-8')
-
         while self.connected:
             if self.process is None:
                 continue
             line = self.process.stdout.readline()
             if not isinstance(line, str):
                 line = line.decode()
-            self.recent_lines.append(line)
+            if not line:
+                # logcat exited
+                self.connected = False
+                break
+            self.add_line(line)
             self.parse_line(line)
-            if f is not None:
-                f.write(line)
-        if f is not None:
-            f.close()
+            if self.out_file is not None:
+                self.__sink_queue.put(line)
+        self.__sink_queue.put(None)
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
+    def write_output(self):
+        """
+        write received lines to logcat.txt in batches, off the reader thread
+        """
+        with open(self.out_file, 'w', encoding='utf-8', buffering=LOGCAT_FILE_BUFFER_SIZE) as f:
+            while True:
+                lines = [self.__sink_queue.get()]
+                try:
+                    while True:
+                        lines.append(self.__sink_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if None in lines:
+                    f.writelines(lines[:lines.index(None)])
+                    break
+                f.writelines(lines)
+                if self.__sink_queue.empty():
+                    f.flush()
+
     def parse_line(self, logcat_line):
         for parser in self.parsers:
             parser.parse(logcat_line)
-
@@ -1,5 +1,6 @@
 import logging
 import socket
+import struct
 import subprocess
 import time
 import os
@@ -9,6 +10,12 @@ from .adapter import Adapter
 
 MINICAP_REMOTE_ADDR = "localabstract:minicap"
 ROTATION_CHECK_INTERVAL_S = 1 # Check rotation once per second
+MINICAP_RECV_WINDOW = 256 * 1024
+MINICAP_FRAME_BUFFERS = 4
+
+# version, length, pid, real width, real height, virtual width, virtual height, orientation, quirks
+MINICAP_BANNER_STRUCT = struct.Struct("<BBIIIIIBB")
+MINICAP_FRAME_HEADER_STRUCT = struct.Struct("<I")
 
 
 class MinicapException(Exception):
@@ -18,6 +25,99 @@ class MinicapException(Exception):
     pass
 
 
+class MinicapStreamReader(object):
+    """
+    read the banner and frames of a minicap stream, see:
+    https://github.com/openstf/minicap#usage
+    Headers are parsed from a receive window with struct. Frame bodies are received (or copied once from
+    the window) into a small ring of reusable buffers, and returned as memoryviews of those buffers.
+    A frame view stays valid until `num_buffers` more frames have been read, copy it to keep it longer.
+    """
+
+    def __init__(self, sock, recv_window=MINICAP_RECV_WINDOW, num_buffers=MINICAP_FRAME_BUFFERS):
+        self.sock = sock
+        self.window = bytearray(recv_window)
+        self.window_view = memoryview(self.window)
+        self.start = 0
+        self.end = 0
+        self.buffers = [bytearray(0) for _ in range(num_buffers)]
+        self.buffer_idx = 0
+
+    def __fill(self, size):
+        """
+        make sure at least `size` bytes are available in the receive window
+        """
+        if self.end - self.start >= size:
+            return
+        if self.start > 0:
+            # move the remaining bytes to the beginning of the window
+            remaining = self.end - self.start
+            self.window_view[:remaining] = self.window_view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        while self.end - self.start < size:
+            received = self.sock.recv_into(self.window_view[self.end:])
+            if received == 0:
+                raise EOFError("minicap stream closed")
+            self.end += received
+
+    def __read_into(self, dest):
+        """
+        fill dest (a memoryview) with the next bytes of the stream
+        """
+        size = len(dest)
+        available = min(size, self.end - self.start)
+        if available:
+            dest[:available] = self.window_view[self.start:self.start + available]
+            self.start += available
+        # receive the rest of a large frame body directly into the frame buffer
+        while available < size:
+            received = self.sock.recv_into(dest[available:])
+            if received == 0:
+                raise EOFError("minicap stream closed")
+            available += received
+
+    def read_banner(self):
+        """
+        :return: dict of the banner fields
+        """
+        self.__fill(2)
+        banner_length = self.window[self.start + 1]
+        self.__fill(banner_length)
+        (version, length, pid, real_width, real_height, virtual_width, virtual_height, orientation, quirks) = \
+            MINICAP_BANNER_STRUCT.unpack_from(self.window, self.start)
+        self.start += banner_length
+        return {
+            "version": version,
+            "length": length,
+            "pid": pid,
+            "realWidth": real_width,
+            "realHeight": real_height,
+            "virtualWidth": virtual_width,
+            "virtualHeight": virtual_height,
+            "orientation": orientation * 90,
+            "quirks": quirks,
+        }
+
+    def read_frame(self):
+        """
+        :return: memoryview of the next JPEG frame
+        """
+        self.__fill(MINICAP_FRAME_HEADER_STRUCT.size)
+        (frame_length,) = MINICAP_FRAME_HEADER_STRUCT.unpack_from(self.window, self.start)
+        self.start += MINICAP_FRAME_HEADER_STRUCT.size
+
+        self.buffer_idx = (self.buffer_idx + 1) % len(self.buffers)
+        frame_buffer = self.buffers[self.buffer_idx]
+        if len(frame_buffer) < frame_length:
+            # a new buffer rather than a resize, old frame views may still reference the previous one
+            frame_buffer = bytearray(max(frame_length, 2 * len(frame_buffer)))
+            self.buffers[self.buffer_idx] = frame_buffer
+        frame = memoryview(frame_buffer)[:frame_length]
+        self.__read_into(frame)
+        return frame
+
+
 class Minicap(Adapter):
     """
     a connection with target device through minicap.
@@ -140,78 +240,21 @@ class Minicap(Adapter):
 
     def listen_messages(self):
         self.logger.debug("start listening minicap images ...")
-        CHUNK_SIZE = 4096
-
-        readBannerBytes = 0
-        bannerLength = 2
-        readFrameBytes = 0
-        frameBodyLength = 0
-        frameBody = bytearray()
-        banner = {
-            "version": 0,
-            "length": 0,
-            "pid": 0,
-            "realWidth": 0,
-            "realHeight": 0,
-            "virtualWidth": 0,
-            "virtualHeight": 0,
-            "orientation": 0,
-            "quirks": 0,
-        }
+        reader = MinicapStreamReader(self.sock)
 
         self.connected = True
-        while self.connected:
-            chunk = bytearray(self.sock.recv(CHUNK_SIZE))
-            if not chunk:
-                continue
-            chunk_len = len(chunk)
-            cursor = 0
-            while cursor < chunk_len and self.connected:
-                if readBannerBytes < bannerLength:
-                    if readBannerBytes == 0:
-                        banner['version'] = chunk[cursor]
-                    elif readBannerBytes == 1:
-                        banner['length'] = bannerLength = chunk[cursor]
-                    elif 2 <= readBannerBytes <= 5:
-                        banner['pid'] += (chunk[cursor] << ((readBannerBytes - 2) * 8))
-                    elif 6 <= readBannerBytes <= 9:
-                        banner['realWidth'] += (chunk[cursor] << ((readBannerBytes - 6) * 8))
-                    elif 10 <= readBannerBytes <= 13:
-                        banner['realHeight'] += (chunk[cursor] << ((readBannerBytes - 10) * 8))
-                    elif 14 <= readBannerBytes <= 17:
-                        banner['virtualWidth'] += (chunk[cursor] << ((readBannerBytes - 14) * 8))
-                    elif 18 <= readBannerBytes <= 21:
-                        banner['virtualHeight'] += (chunk[cursor] << ((readBannerBytes - 18) * 8))
-                    elif readBannerBytes == 22:
-                        banner['orientation'] += chunk[cursor] * 90
-                    elif readBannerBytes == 23:
-                        banner['quirks'] = chunk[cursor]
-
-                    cursor += 1
-                    readBannerBytes += 1
-                    if readBannerBytes == bannerLength:
-                        self.banner = banner
-                        self.logger.debug("minicap initialized: %s" % banner)
-
-                elif readFrameBytes < 4:
-                    frameBodyLength += (chunk[cursor] << (readFrameBytes * 8))
-                    cursor += 1
-                    readFrameBytes += 1
-                else:
-                    if chunk_len - cursor >= frameBodyLength:
-                        frameBody += chunk[cursor: cursor + frameBodyLength]
-                        self.handle_image(frameBody)
-                        cursor += frameBodyLength
-                        frameBodyLength = readFrameBytes = 0
-                        frameBody = bytearray()
-                    else:
-                        frameBody += chunk[cursor:]
-                        frameBodyLength -= chunk_len - cursor
-                        readFrameBytes += chunk_len - cursor
-                        cursor = chunk_len
+        try:
+            self.banner = reader.read_banner()
+            self.logger.debug("minicap initialized: %s" % self.banner)
+            while self.connected:
+                self.handle_image(reader.read_frame())
+        except (EOFError, socket.error) as e:
+            if self.connected:
+                self.logger.warning("minicap stream interrupted: %s" % e)
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
     def handle_image(self, frameBody):
+        # frameBody is a memoryview of a reusable buffer, see MinicapStreamReader
         # Sanity check for JPG header, only here for debugging purposes.
         if frameBody[0] != 0xFF or frameBody[1] != 0xD8:
             self.logger.warning("Frame body does not start with JPG header")
@@ -222,11 +265,18 @@ class Minicap(Adapter):
         self.check_rotation()
 
     def check_rotation(self):
+        """
+        reconnect if the orientation differs from the one minicap was started with.
+        the display info is cached by adb, and the droidbot app's rotation signal invalidates it (see
+        Device.handle_rotation), so the device is only queried here when the droidbot app is not connected
+        """
         current_time = datetime.now()
         if (current_time - self.last_rotation_check_time).total_seconds() < ROTATION_CHECK_INTERVAL_S:
             return
 
-        display = self.device.get_display_info(refresh=True)
+        droidbot_app = self.device.droidbot_app
+        rotation_signaled = droidbot_app and self.device.adapters[droidbot_app] and droidbot_app.check_connectivity()
+        display = self.device.get_display_info(refresh=not rotation_signaled)
         if 'orientation' in display:
             cur_orientation = display['orientation'] * 90
             if cur_orientation != self.orientation:
@@ -279,8 +329,10 @@ class Minicap(Adapter):
             return self.last_views
 
         from . import cv
-        img = cv.load_image_from_buf(self.last_screen)
+        # last_screen is a view of a buffer the reader reuses, copy the frame before decoding it
+        img = cv.load_image_from_buf(bytes(self.last_screen))
         view_bounds = cv.find_views(img)
+        signatures = cv.calculate_dhashes(img, view_bounds)
         root_view = {
             "class": "CVViewRoot",
             "bounds": [[0, 0], [self.width, self.height]],
@@ -289,13 +341,13 @@ class Minicap(Adapter):
         }
         views = [root_view]
         temp_id = 1
-        for x,y,w,h in view_bounds:
+        for (x,y,w,h), signature in zip(view_bounds, signatures):
             view = {
                 "class": "CVView",
                 "bounds": [[x,y], [x+w, y+h]],
                 "enabled": True,
                 "temp_id": temp_id,
-                "signature": cv.calculate_dhash(img[y:y+h, x:x+w]),
+                "signature": signature,
                 "parent": 0,
                 "children": []
             }
@@ -1,8 +1,10 @@
 import threading
 import logging
+import socket
 import time
 import subprocess
 from .adapter import Adapter
+from .adb import ADBException
 
 
 class ProcessMonitor(Adapter):
@@ -65,16 +67,18 @@ class ProcessMonitor(Adapter):
         maintain pid2user mapping, pid2ppid mapping and pid2name mapping by continuously calling ps command
         """
         while self.enabled:
-            if self.device is not None:
-                ps_cmd = ["adb", "-s", self.device.serial, "shell", "ps"]
-            else:
-                ps_cmd = ["adb", "shell", "ps"]
-
             try:
-                ps_out = subprocess.check_output(ps_cmd)
+                if self.device is not None:
+                    # go through the adb adapter, so that its transport is shared
+                    ps_out = self.device.adb.shell("ps")
+                else:
+                    ps_out = subprocess.check_output(["adb", "shell", "ps"])
                 if not isinstance(ps_out, str):
                     ps_out = ps_out.decode()
-            except subprocess.CalledProcessError:
+            except (subprocess.CalledProcessError, socket.error, ADBException) as e:
+                # e.g. a timeout of the adb socket transport, keep the mapping updated once adb recovers
+                self.logger.debug("ps failed: %s" % e)
+                time.sleep(1)
                 continue
 
             # parse ps_out to update self.pid2uid mapping and self.pid2name mapping
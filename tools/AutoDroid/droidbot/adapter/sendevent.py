@@ -0,0 +1,313 @@
+# This is the interface for injecting input with sendevent through a persistent shell
+import logging
+import re
+import subprocess
+import threading
+import time
+from .adapter import Adapter
+
+INPUT_BACKEND_ADB = "adb"
+INPUT_BACKEND_SENDEVENT = "sendevent"
+INPUT_BACKENDS = [INPUT_BACKEND_ADB, INPUT_BACKEND_SENDEVENT]
+
+# linux input event types and codes, see linux/input-event-codes.h
+EV_SYN = 0
+EV_KEY = 1
+EV_ABS = 3
+SYN_REPORT = 0
+BTN_TOUCH = 0x14a
+ABS_X = 0x00
+ABS_Y = 0x01
+ABS_MT_SLOT = 0x2f
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+
+# android key names (and keycodes) to linux key codes, following Generic.kl
+KEY_CODES = {
+    "HOME": 172, "3": 172,
+    "BACK": 158, "4": 158,
+    "VOLUME_UP": 115, "24": 115,
+    "VOLUME_DOWN": 114, "25": 114,
+    "POWER": 116, "26": 116,
+    "ENTER": 28, "66": 28,
+    "DEL": 14, "67": 14,
+    "MENU": 139, "82": 139,
+    "SEARCH": 217, "84": 217,
+    "APP_SWITCH": 580, "187": 580
+}
+
+# interval between two move events of a drag, in ms
+DRAG_STEP_INTERVAL = 20
+SENDEVENT_DONE_MARKER = "==droidbot-sendevent-done=="
+
+GETEVENT_DEVICE_RE = re.compile(r'^add device \d+: (\S+)')
+GETEVENT_TYPE_RE = re.compile(r'^\s*([A-Z_]+) \((\w+)\):\s*(.*)$')
+GETEVENT_ABS_RE = re.compile(r'([0-9a-f]{4})\s*:\s*value -?\d+, min (-?\d+), max (-?\d+)')
+GETEVENT_CODE_RE = re.compile(r'^[0-9a-f]{4}$')
+PHYSICAL_SIZE_RE = re.compile(r'Physical size: (\d+)x(\d+)')
+
+
+class SendEventException(Exception):
+    """
+    Exception in sendevent input
+    """
+
+    def __init__(self, msg, gesture_started=False):
+        """
+        :param msg: str, the error message
+        :param gesture_started: bool, whether the touch went down before the failure, i.e. the app may have
+                                seen part of the gesture and it should not be repeated by another input channel
+        """
+        super(SendEventException, self).__init__(msg)
+        self.gesture_started = gesture_started
+
+
+class SendEventInput(Adapter):
+    """
+    inject touches and key presses by writing `sendevent` sequences to a long-lived `adb shell`,
+    which avoids starting the `input` command (an app_process JVM) for every event
+    """
+
+    def __init__(self, device=None):
+        """
+        initialize the input channel
+        :param device: instance of Device
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if device is None:
+            from droidbot.device import Device
+            device = Device()
+        self.device = device
+        self.connected = False
+        self.process = None
+        self.lock = threading.Lock()
+        self.touch_device = None
+        self.touch_abs = {}
+        self.touch_has_btn = False
+        self.key_devices = {}
+        self.natural_size = None
+        self.__tracking_id = 0
+
+    @staticmethod
+    def parse_getevent_output(output):
+        """
+        parse the output of `getevent -p`
+        :return: a dict mapping each input device path to {"abs": {code: (min, max)}, "keys": set of codes}
+        """
+        devices = {}
+        current = None
+        section = None
+        for line in output.splitlines():
+            m = GETEVENT_DEVICE_RE.match(line)
+            if m:
+                current = {"abs": {}, "keys": set()}
+                devices[m.group(1)] = current
+                section = None
+                continue
+            if current is None:
+                continue
+            m = GETEVENT_TYPE_RE.match(line)
+            if m:
+                section = m.group(1)
+                line = m.group(3)
+            elif not line.startswith("    "):
+                section = None
+                continue
+            if section == "ABS":
+                for code, min_value, max_value in GETEVENT_ABS_RE.findall(line):
+                    current["abs"][int(code, 16)] = (int(min_value), int(max_value))
+            elif section == "KEY":
+                for token in line.split():
+                    if GETEVENT_CODE_RE.match(token):
+                        current["keys"].add(int(token, 16))
+        return devices
+
+    def connect(self):
+        try:
+            devices = self.parse_getevent_output(self.device.adb.shell("getevent -p"))
+            for path, info in devices.items():
+                if ABS_MT_POSITION_X in info["abs"] and ABS_MT_POSITION_Y in info["abs"] \
+                        or ABS_X in info["abs"] and ABS_Y in info["abs"] and BTN_TOUCH in info["keys"]:
+                    if self.touch_device is None or ABS_MT_POSITION_X in info["abs"]:
+                        self.touch_device = path
+                        self.touch_abs = info["abs"]
+                        self.touch_has_btn = BTN_TOUCH in info["keys"]
+                for key_code in info["keys"]:
+                    self.key_devices.setdefault(key_code, path)
+            if self.touch_device is None:
+                raise SendEventException("no touchscreen found in getevent output")
+
+            m = PHYSICAL_SIZE_RE.search(self.device.adb.shell("wm size"))
+            if not m:
+                raise SendEventException("unable to get the physical screen size")
+            self.natural_size = (int(m.group(1)), int(m.group(2)))
+
+            self.process = subprocess.Popen(["adb", "-s", self.device.serial, "shell", "sh"],
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+            self.connected = True
+            self.__run([])
+            self.logger.debug("using touchscreen %s" % self.touch_device)
+        except Exception as e:
+            self.logger.warning("Failed to connect sendevent input, falling back to adb input: %s" % e)
+            self.disconnect()
+
+    def check_connectivity(self):
+        """
+        check if the input channel is open
+        :return: True for connected
+        """
+        return self.connected and self.process is not None and self.process.poll() is None
+
+    def disconnect(self):
+        """
+        close the input channel
+        """
+        self.connected = False
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.terminate()
+            except Exception as e:
+                self.logger.debug(e)
+            self.process = None
+            print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
+
+    def __run(self, events):
+        """
+        write a batch of events to the shell, and wait until they are injected
+        :param events: list of (device, type, code, value)
+        """
+        cmds = ["sendevent %s %d %d %d" % event for event in events]
+        cmds.append("echo %s" % SENDEVENT_DONE_MARKER)
+        with self.lock:
+            if not self.check_connectivity():
+                raise SendEventException("sendevent shell is not running")
+            self.process.stdin.write(("; ".join(cmds) + "\n").encode())
+            self.process.stdin.flush()
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    self.connected = False
+                    raise SendEventException("sendevent shell exited")
+                line = line.decode("utf-8", "replace").strip()
+                if line == SENDEVENT_DONE_MARKER:
+                    return
+                if line:
+                    self.logger.warning(line)
+
+    def __to_raw_point(self, xy):
+        """
+        convert a point on the (rotated) screen to the coordinates of the touchscreen
+        """
+        (x, y) = xy
+        width, height = self.natural_size
+        orientation = self.device.adb.get_orientation()
+        if orientation == 1:
+            x, y = width - y, x
+        elif orientation == 2:
+            x, y = width - x, height - y
+        elif orientation == 3:
+            x, y = y, height - x
+        if ABS_MT_POSITION_X in self.touch_abs:
+            (x_min, x_max) = self.touch_abs[ABS_MT_POSITION_X]
+            (y_min, y_max) = self.touch_abs[ABS_MT_POSITION_Y]
+        else:
+            (x_min, x_max) = self.touch_abs[ABS_X]
+            (y_min, y_max) = self.touch_abs[ABS_Y]
+        raw_x = x_min + int(round(min(max(x, 0), width - 1) * (x_max - x_min) / float(max(width - 1, 1))))
+        raw_y = y_min + int(round(min(max(y, 0), height - 1) * (y_max - y_min) / float(max(height - 1, 1))))
+        return raw_x, raw_y
+
+    def __position_events(self, xy):
+        dev = self.touch_device
+        raw_x, raw_y = self.__to_raw_point(xy)
+        if ABS_MT_POSITION_X in self.touch_abs:
+            return [(dev, EV_ABS, ABS_MT_POSITION_X, raw_x), (dev, EV_ABS, ABS_MT_POSITION_Y, raw_y)]
+        return [(dev, EV_ABS, ABS_X, raw_x), (dev, EV_ABS, ABS_Y, raw_y)]
+
+    def __down_events(self, xy):
+        dev = self.touch_device
+        events = []
+        if ABS_MT_SLOT in self.touch_abs:
+            events.append((dev, EV_ABS, ABS_MT_SLOT, 0))
+        if ABS_MT_TRACKING_ID in self.touch_abs:
+            self.__tracking_id = (self.__tracking_id + 1) % (self.touch_abs[ABS_MT_TRACKING_ID][1] or 65535)
+            events.append((dev, EV_ABS, ABS_MT_TRACKING_ID, self.__tracking_id))
+        events += self.__position_events(xy)
+        if self.touch_has_btn:
+            events.append((dev, EV_KEY, BTN_TOUCH, 1))
+        events.append((dev, EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def __move_events(self, xy):
+        return self.__position_events(xy) + [(self.touch_device, EV_SYN, SYN_REPORT, 0)]
+
+    def __up_events(self):
+        dev = self.touch_device
+        events = []
+        if ABS_MT_SLOT in self.touch_abs:
+            events.append((dev, EV_ABS, ABS_MT_SLOT, 0))
+        if ABS_MT_TRACKING_ID in self.touch_abs:
+            events.append((dev, EV_ABS, ABS_MT_TRACKING_ID, -1))
+        if self.touch_has_btn:
+            events.append((dev, EV_KEY, BTN_TOUCH, 0))
+        events.append((dev, EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def touch(self, x, y):
+        """
+        tap at (x, y)
+        """
+        self.__run(self.__down_events((x, y)) + self.__up_events())
+
+    def long_touch(self, x, y, duration=2000):
+        """
+        long touch at (x, y)
+        @param duration: duration in ms
+        """
+        self.drag((x, y), (x, y), duration)
+
+    def drag(self, start_xy, end_xy, duration):
+        """
+        drag from start_xy to end_xy
+        @param duration: duration of the event in ms
+        """
+        (x0, y0) = start_xy
+        (x1, y1) = end_xy
+        self.__run(self.__down_events(start_xy))
+        try:
+            start_time = time.time()
+            num_steps = max(1, int(duration / DRAG_STEP_INTERVAL))
+            for i in range(1, num_steps + 1):
+                wait_time = start_time + duration / 1000.0 * i / num_steps - time.time()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+                if (x0, y0) == (x1, y1) and i < num_steps:
+                    continue
+                xy = (x0 + (x1 - x0) * i / num_steps, y0 + (y1 - y0) * i / num_steps)
+                self.__run(self.__move_events(xy))
+            self.__run(self.__up_events())
+        except SendEventException as e:
+            # the touch is down, lift it so that it is not left pressed
+            try:
+                self.__run(self.__up_events())
+            except SendEventException as up_e:
+                self.logger.warning("failed to lift the touch: %s" % up_e)
+            raise SendEventException(str(e), gesture_started=True)
+
+    def press(self, key_code):
+        """
+        press a key
+        @param key_code: the android key name or keycode, e.g. "BACK" or "66"
+        @return: True if the key was injected, False if it is not supported by any input device
+        """
+        code = KEY_CODES.get(str(key_code).upper().replace("KEYCODE_", ""))
+        if code is None or code not in self.key_devices:
+            return False
+        dev = self.key_devices[code]
+        self.__run([(dev, EV_KEY, code, 1), (dev, EV_SYN, SYN_REPORT, 0),
+                    (dev, EV_KEY, code, 0), (dev, EV_SYN, SYN_REPORT, 0)])
+        return True
@@ -0,0 +1,146 @@
+# Background writer for output artifacts
+import json
+import logging
+import os
+import threading
+try:
+    import queue # Python 3
+except ImportError:
+    import Queue as queue # Python 2
+
+# maximum number of artifacts waiting to be written, submitting more blocks until some are written
+ARTIFACT_QUEUE_SIZE = 256
+ARTIFACT_NUM_WORKERS = 2
+
+
+class ArtifactWriter(object):
+    """
+    write output artifacts (states, events, screenshots, view images, ...) in background threads,
+    so that exploration does not wait for disk I/O
+    """
+
+    def __init__(self, max_pending=ARTIFACT_QUEUE_SIZE, num_workers=ARTIFACT_NUM_WORKERS):
+        """
+        :param max_pending: maximum number of pending artifacts, submit blocks when it is reached
+        :param num_workers: number of writer threads
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.num_workers = num_workers
+        self.workers = []
+        self.__lock = threading.Lock()
+        self.__pending_paths = set()
+
+    def __ensure_workers(self):
+        with self.__lock:
+            self.workers = [worker for worker in self.workers if worker.is_alive()]
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self.__run)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def __run(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                func, args, kwargs = task
+                func(*args, **kwargs)
+            except Exception as e:
+                self.logger.warning("failed to write artifact: %s" % e)
+            finally:
+                self.tasks.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        run func(*args, **kwargs) in a writer thread
+        blocks while max_pending artifacts are waiting
+        """
+        self.__ensure_workers()
+        self.tasks.put((func, args, kwargs))
+
+    def submit_once(self, path, func, *args, **kwargs):
+        """
+        run func(*args, **kwargs), which writes path, in a writer thread,
+        unless path already exists or is waiting to be written
+        :return: True if it was submitted
+        """
+        with self.__lock:
+            if path in self.__pending_paths or os.path.exists(path):
+                return False
+            self.__pending_paths.add(path)
+        self.submit(self.__write_once, path, func, args, kwargs)
+        return True
+
+    def __write_once(self, path, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        finally:
+            with self.__lock:
+                self.__pending_paths.discard(path)
+
+    def write_bytes(self, path, data):
+        """
+        write data to path in a writer thread
+        :param path: str, the destination file
+        :param data: bytes
+        """
+        self.submit(write_bytes, path, data)
+
+    def write_text(self, path, text):
+        """
+        write a str to path in a writer thread, encoded in utf-8
+        """
+        self.submit(write_text, path, text)
+
+    def write_json(self, path, obj, indent=None):
+        """
+        serialize obj to path in a writer thread
+        obj must not be modified afterwards, copy the parts that may change before submitting it
+        """
+        self.submit(write_json, path, obj, indent)
+
+    def drain(self):
+        """
+        wait until all submitted artifacts are written
+        """
+        if self.workers:
+            self.tasks.join()
+
+    def stop(self):
+        """
+        write the remaining artifacts and stop the writer threads
+        """
+        with self.__lock:
+            workers = [worker for worker in self.workers if worker.is_alive()]
+            self.workers = []
+        for _ in workers:
+            self.tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def _make_parent_dir(path):
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+
+
+def write_bytes(path, data):
+    _make_parent_dir(path)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_text(path, text):
+    _make_parent_dir(path)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def write_json(path, obj, indent=None):
+    _make_parent_dir(path)
+    with open(path, "w") as f:
+        json.dump(obj, f, indent=indent)
@@ -4,21 +4,43 @@ import re
 import subprocess
 import sys
 import time
+from concurrent import futures
 
-from .adapter.adb import ADB
+from .adapter.adb import ADB, ADB_TRANSPORT_SUBPROCESS
 from .adapter.droidbot_app import DroidBotAppConn
 from .adapter.logcat import Logcat
 from .adapter.minicap import Minicap
 from .adapter.process_monitor import ProcessMonitor
+from .adapter.sendevent import SendEventInput, SendEventException, INPUT_BACKEND_ADB, INPUT_BACKEND_SENDEVENT
 from .adapter.telnet import TelnetConsole
 from .adapter.user_input_monitor import UserInputMonitor
 from .adapter.droidbot_ime import DroidBotIme
 from .app import App
+from .artifact_writer import ArtifactWriter
 from .intent import Intent
+from .screenshot import Screenshot
 
 DEFAULT_NUM = '1234567890'
 DEFAULT_CONTENT = 'Hello world!'
 
+# sections of the composite state probe, each one is a dumpsys command
+STATE_PROBE_SECTIONS = {
+    "activities": "dumpsys activity activities",
+    "services": "dumpsys activity services"
+}
+STATE_PROBE_MARKER = "==droidbot-probe=="
+
+# probes run concurrently by get_current_state, and their timeouts in seconds
+STATE_ACQUISITION_TIMEOUTS = {
+    "views": 30,
+    "probe": 20,
+    "screenshot": 20
+}
+
+ACTIVITY_LINE_RE = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
+ACTIVITY_TASK_LINE_RE = re.compile(r'^\s*Task\s*id\s*#(\d+)|^\s*Task\{\w+\s*#(\d+)')
+SERVICE_LINE_RE = re.compile('^.+ServiceRecord{.+ ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)')
+
 
 class Device(object):
     """
@@ -27,11 +49,17 @@ class Device(object):
 
     def __init__(self, device_serial=None, is_emulator=False, output_dir=None,
                  cv_mode=False, grant_perm=False, telnet_auth_token=None,
-                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False):
+                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False,
+                 adb_transport=ADB_TRANSPORT_SUBPROCESS, input_backend=INPUT_BACKEND_ADB, resume_utg=False,
+                 utg_cache_budget=None):
         """
         initialize a device connection
         :param device_serial: serial number of target device
         :param is_emulator: boolean, type of device, True for emulator, False for real device
+        :param adb_transport: how adb commands are sent, "subprocess" or "socket" (adb server host protocol)
+        :param input_backend: how input events are injected, "adb" (input command) or "sendevent" (persistent shell)
+        :param resume_utg: boolean, continue the UTG saved in output_dir by a previous run
+        :param utg_cache_budget: int, bytes of the states a UTG keeps in memory, None for the default budget
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -56,6 +84,10 @@ class Device(object):
         self.enable_accessibility_hard = enable_accessibility_hard
         self.humanoid = humanoid
         self.ignore_ad = ignore_ad
+        self.adb_transport = adb_transport
+        self.input_backend = input_backend
+        self.resume_utg = resume_utg
+        self.utg_cache_budget = utg_cache_budget
 
         # basic device information
         self.settings = {}
@@ -69,6 +101,16 @@ class Device(object):
         self.last_know_state = None
         self.__used_ports = []
         self.pause_sending_event = False
+        # result of the composite state probe, only kept while getting the current state
+        self.__step_probe = None
+        # (version, state) of the last state built from the accessibility diff stream, the base of the next state
+        self.__acc_base = None
+        # writes screenshots and view images in background
+        self.artifact_writer = ArtifactWriter()
+        # runs the probes of get_current_state concurrently, spare workers absorb probes that timed out
+        self.state_acquisition_timeouts = dict(STATE_ACQUISITION_TIMEOUTS)
+        self.state_acquisition_timings = {}
+        self.__state_executor = futures.ThreadPoolExecutor(max_workers=2 * len(STATE_ACQUISITION_TIMEOUTS))
 
         # adapters
         self.adb = ADB(device=self)
@@ -79,9 +121,11 @@ class Device(object):
         self.user_input_monitor = UserInputMonitor(device=self)
         self.process_monitor = ProcessMonitor(device=self)
         self.droidbot_ime = DroidBotIme(device=self)
+        self.sendevent_input = SendEventInput(device=self)
 
         self.adapters = {
             self.adb: True,
+            self.sendevent_input: input_backend == INPUT_BACKEND_SENDEVENT,
             self.telnet: False,
             self.droidbot_app: True,
             self.minicap: True,
@@ -162,7 +206,7 @@ class Device(object):
         self.get_release_version()
         self.get_ro_secure()
         self.get_ro_debuggable()
-        self.get_display_info()
+        self.get_display_info(refresh=True)
 
         self.unlock()
         self.check_connectivity()
@@ -174,12 +218,15 @@ class Device(object):
         :return:
         """
         self.connected = False
+        self.logger.info("device property cache: %s" % self.get_cache_stats())
         for adapter in self.adapters:
             adapter_enabled = self.adapters[adapter]
             if not adapter_enabled:
                 continue
             adapter.disconnect()
 
+        self.__state_executor.shutdown(wait=False)
+        self.artifact_writer.stop()
         if self.output_dir is not None:
             temp_dir = os.path.join(self.output_dir, "temp")
             if os.path.exists(temp_dir):
@@ -245,16 +292,23 @@ class Device(object):
             self.ro_debuggable = self.adb.get_ro_debuggable()
         return self.ro_debuggable
 
-    def get_display_info(self, refresh=True):
+    def get_display_info(self, refresh=False):
         """
         get device display information, including width, height, and density
+        the values are cached by adb until the screen is rotated
         :param refresh: if set to True, refresh the display info instead of using the old values
         :return: dict, display_info
         """
-        if self.display_info is None or refresh:
-            self.display_info = self.adb.get_display_info()
+        self.display_info = self.adb.get_display_info(refresh=refresh)
         return self.display_info
 
+    def get_cache_stats(self):
+        """
+        get hit/miss counters of the device property cache
+        :return: dict
+        """
+        return self.adb.get_cache_stats()
+
     def get_width(self, refresh=False):
         display_info = self.get_display_info(refresh=refresh)
         width = 0
@@ -504,30 +558,87 @@ class Device(object):
         intent = Intent(suffix=package_name)
         self.send_intent(intent)
 
+    def probe_state(self, sections=None):
+        """
+        Get activities, tasks and services of the device with a single shell invocation.
+        :param sections: names of the dumpsys sections to include, see STATE_PROBE_SECTIONS. All by default.
+        :return: a dict with keys top_activity, task_to_activities and services (None if not probed)
+        """
+        if sections is None:
+            sections = list(STATE_PROBE_SECTIONS.keys())
+        cmd_line = "; ".join(["echo %s %s; %s" % (STATE_PROBE_MARKER, section, STATE_PROBE_SECTIONS[section])
+                              for section in sections])
+        out = self.adb.run_cmd(["shell", cmd_line])
+        return self.__parse_state_probe_lines(out.splitlines())
+
+    @staticmethod
+    def __parse_state_probe_lines(lines):
+        top_activity = None
+        task_to_activities = None
+        services = None
+        section = None
+
+        for line in lines:
+            if line.startswith(STATE_PROBE_MARKER):
+                section = line[len(STATE_PROBE_MARKER):].strip()
+                if section == "activities":
+                    task_to_activities = {}
+                elif section == "services":
+                    services = []
+                continue
+
+            if section == "activities":
+                line = line.strip()
+                task_m = ACTIVITY_TASK_LINE_RE.match(line)
+                if task_m:
+                    task_id = task_m.group(1) if task_m.group(1) else task_m.group(2)
+                    task_to_activities[task_id] = []
+                elif re.match(r'\*\s*Hist\s*#', line):
+                    m = ACTIVITY_LINE_RE.match(line)
+                    if m:
+                        activity = m.group(1)
+                        task_id = m.group(2)
+                        if top_activity is None:
+                            top_activity = activity
+                        if task_id not in task_to_activities:
+                            task_to_activities[task_id] = []
+                        task_to_activities[task_id].append(activity)
+            elif section == "services":
+                m = SERVICE_LINE_RE.search(line)
+                if m:
+                    services.append("%s/%s" % (m.group(1), m.group(2)))
+
+        return {
+            "top_activity": top_activity,
+            "task_to_activities": task_to_activities,
+            "services": services
+        }
+
+    def __get_probe(self, section):
+        """
+        get the probe result of the current step, or probe the given section if not getting a state
+        """
+        if self.__step_probe is not None:
+            return self.__step_probe
+        return self.probe_state(sections=[section])
+
     def get_top_activity_name(self):
         """
         Get current activity
         """
-        r = self.adb.shell("dumpsys activity activities")
-        activity_line_re = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
-        m = activity_line_re.search(r)
-        if m:
-            return m.group(1)
-        # data = self.adb.shell("dumpsys activity top").splitlines()
-        # regex = re.compile("\s*ACTIVITY ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)")
-        # m = regex.search(data[1])
-        # if m:
-        #     return m.group(1) + "/" + m.group(2)
-        self.logger.warning("Unable to get top activity name.")
-        return None
+        top_activity = self.__get_probe("activities")["top_activity"]
+        if top_activity is None:
+            self.logger.warning("Unable to get top activity name.")
+        return top_activity
 
     def get_current_activity_stack(self):
         """
         Get current activity stack
         :return: a list of str, each str is an activity name, the first is the top activity name
         """
-        task_to_activities = self.get_task_activities()
-        top_activity = self.get_top_activity_name()
+        probe = self.__get_probe("activities")
+        task_to_activities = probe["task_to_activities"]
+        top_activity = probe["top_activity"]
         if top_activity:
             for task_id in task_to_activities:
                 activities = task_to_activities[task_id]
@@ -538,80 +649,19 @@ class Device(object):
         else:
             return None
 
-    # def get_task_activities(self):
-    #     """
-    #     Get current tasks and corresponding activities.
-    #     :return: a dict mapping each task id to a list of activities, from top to down.
-    #     """
-    #     task_to_activities = {}
-
-    #     lines = self.adb.shell("dumpsys activity activities").splitlines()
-    #     activity_line_re = re.compile('\* Hist #\d+: ActivityRecord{[^ ]+ [^ ]+ ([^ ]+) t(\d+)}')
-
-    #     for line in lines:
-    #         line = line.strip()
-    #         if line.startswith("Task id #"):
-    #             task_id = line[9:]
-    #             task_to_activities[task_id] = []
-    #         elif line.startswith("* Hist #"):
-    #             m = activity_line_re.match(line)
-    #             if m:
-    #                 activity = m.group(1)
-    #                 task_id = m.group(2)
-    #                 if task_id not in task_to_activities:
-    #                     task_to_activities[task_id] = []
-    #                 task_to_activities[task_id].append(activity)
-
-    #     return task_to_activities
-
     def get_task_activities(self):
         """
         Get current tasks and corresponding activities.
         :return: a dict mapping each task id to a list of activities, from top to down.
         """
-        task_to_activities = {}
-
-        lines = self.adb.shell("dumpsys activity activities").splitlines()
-        activity_line_re = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
-
-        for line in lines:
-            line = line.strip()
-            activity_line_task_re = re.compile(r'^\s*Task\s*id\s*#(\d+)|^\s*Task\{\w+\s*#(\d+)')
-            activity_line_task_m = activity_line_task_re.match(line)
-            if activity_line_task_m:
-                if activity_line_task_m.group(1):
-                    task_id = activity_line_task_m.group(1)
-                else:
-                    task_id = activity_line_task_m.group(2)
-                task_to_activities[task_id] = []
-            elif re.match(r'\*\s*Hist\s*#', line):
-                m = activity_line_re.match(line)
-                if m:
-                    activity = m.group(1)
-                    task_id = m.group(2)
-                    if task_id not in task_to_activities:
-                        task_to_activities[task_id] = []
-                    task_to_activities[task_id].append(activity)
-
-        return task_to_activities
+        return self.__get_probe("activities")["task_to_activities"]
 
     def get_service_names(self):
         """
         get current running services
         :return: list of services
         """
-        services = []
-        dat = self.adb.shell('dumpsys activity services')
-        lines = dat.splitlines()
-        service_re = re.compile('^.+ServiceRecord{.+ ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)')
-
-        for line in lines:
-            m = service_re.search(line)
-            if m:
-                package = m.group(1)
-                service = m.group(2)
-                services.append("%s/%s" % (package, service))
-        return services
+        return self.__get_probe("services")["services"]
 
     def get_package_path(self, package_name):
         """
@@ -794,65 +844,149 @@ class Device(object):
     def pull_file(self, remote_file, local_file):
         self.adb.run_cmd(["pull", remote_file, local_file])
 
-    def take_screenshot(self):
-        # image = None
-        #
-        # received = self.adb.shell("screencap -p").replace("\r\n", "\n")
-        # import StringIO
-        # stream = StringIO.StringIO(received)
-        #
-        # try:
-        #     from PIL import Image
-        #     image = Image.open(stream)
-        # except IOError as e:
-        #     self.logger.warning("exception in take_screenshot: %s" % e)
-        # return image
+    def __capture_screen(self, local_image_dir, tag):
+        """
+        capture the screen into memory
+        :return: (Screenshot, bool), the screenshot and whether it is already written to its path
+        """
+        if not os.path.exists(local_image_dir):
+            os.makedirs(local_image_dir)
+
+        if self.adapters[self.minicap] and self.minicap.last_screen:
+            # minicap use jpg format
+            local_image_path = os.path.join(local_image_dir, "screen_%s.jpg" % tag)
+            return Screenshot(bytes(self.minicap.last_screen), "jpg", local_image_path), False
+
+        # screencap use png format
+        local_image_path = os.path.join(local_image_dir, "screen_%s.png" % tag)
+        if self.get_sdk_version() >= 21:
+            # exec-out streams the image back in a single round-trip
+            data = self.adb.exec_out(["screencap", "-p"])
+            return Screenshot(data, "png", local_image_path), False
+
+        remote_image_path = "/sdcard/screen_%s.png" % tag
+        self.adb.shell("screencap -p %s" % remote_image_path)
+        self.pull_file(remote_image_path, local_image_path)
+        self.adb.shell("rm %s" % remote_image_path)
+        with open(local_image_path, "rb") as local_image_file:
+            data = local_image_file.read()
+        return Screenshot(data, "png", local_image_path), True
+
+    def capture_screenshot(self):
+        """
+        capture the screen into memory, the image file is written to output_dir/temp in background
+        :return: Screenshot, or None if output_dir is not set
+        """
         if self.output_dir is None:
             return None
 
         from datetime import datetime
         tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         local_image_dir = os.path.join(self.output_dir, "temp")
-        if not os.path.exists(local_image_dir):
-            os.makedirs(local_image_dir)
+        screenshot, written = self.__capture_screen(local_image_dir, tag)
+        if not written:
+            self.artifact_writer.write_bytes(screenshot.path, screenshot.data)
+        return screenshot
 
-        if self.adapters[self.minicap] and self.minicap.last_screen:
-            # minicap use jpg format
-            local_image_path = os.path.join(local_image_dir, "screen_%s.jpg" % tag)
-            with open(local_image_path, 'wb') as local_image_file:
-                local_image_file.write(self.minicap.last_screen)
-            return local_image_path
-        else:
-            # screencap use png format
-            local_image_path = os.path.join(local_image_dir, "screen_%s.png" % tag)
-            remote_image_path = "/sdcard/screen_%s.png" % tag
-            self.adb.shell("screencap -p %s" % remote_image_path)
-            self.pull_file(remote_image_path, local_image_path)
-            self.adb.shell("rm %s" % remote_image_path)
+    def take_screenshot(self):
+        """
+        take a screenshot and write it to output_dir/temp
+        :return: path to the image file, or None if output_dir is not set
+        """
+        if self.output_dir is None:
+            return None
 
-        return local_image_path
+        from datetime import datetime
+        tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        local_image_dir = os.path.join(self.output_dir, "temp")
+        screenshot, written = self.__capture_screen(local_image_dir, tag)
+        if not written:
+            with open(screenshot.path, 'wb') as local_image_file:
+                local_image_file.write(screenshot.data)
+        return screenshot.path
+
+    def __acquire_state(self):
+        """
+        run views, activities/services and screenshot probes concurrently, each with its own timeout
+        :return: dict, probe name -> result, None if the probe failed or timed out
+        """
+        probes = {
+            "views": self.__get_views_with_version,
+            "probe": self.probe_state,
+            "screenshot": self.capture_screenshot
+        }
+        timings = {}
+
+        def timed(name, func):
+            start_time = time.time()
+            try:
+                return func()
+            finally:
+                timings[name] = time.time() - start_time
+
+        start_time = time.time()
+        pending = {}
+        for name, func in probes.items():
+            pending[name] = self.__state_executor.submit(timed, name, func)
+
+        results = {}
+        for name, future in pending.items():
+            remaining = start_time + self.state_acquisition_timeouts[name] - time.time()
+            try:
+                results[name] = future.result(timeout=max(0, remaining))
+            except futures.TimeoutError:
+                self.logger.warning("state probe %s timed out" % name)
+                results[name] = None
+            except Exception as e:
+                self.logger.warning("state probe %s failed: %s" % (name, e))
+                results[name] = None
+
+        timings["total"] = time.time() - start_time
+        self.state_acquisition_timings = timings
+        self.logger.info("state acquired in %.3fs (%s)" % (
+            timings["total"],
+            ", ".join(["%s %.3fs" % (name, timings[name]) if name in timings else "%s timeout" % name
+                       for name in probes])))
+        return results
 
     def get_current_state(self):
         self.logger.debug("getting current device state...")
         current_state = None
         try:
-            views = self.get_views()
+            results = self.__acquire_state()
+            views, acc_version = results["views"] or (None, None)
+            self.__step_probe = results["probe"]
+            if self.__step_probe is None:
+                # do not probe again, the activities and services are unknown in this state
+                self.__step_probe = self.__parse_state_probe_lines([])
             foreground_activity = self.get_top_activity_name()
             activity_stack = self.get_current_activity_stack()
             background_services = self.get_service_names()
-            screenshot_path = self.take_screenshot()
+            screenshot = results["screenshot"]
             self.logger.debug("finish getting current device state...")
+            # reuse the results of the subtrees which did not change since the last state
+            base_state, dirty_node_ids = None, None
+            if acc_version is not None and self.__acc_base is not None:
+                dirty_node_ids = self.droidbot_app.get_dirty_node_ids(self.__acc_base[0], acc_version)
+                if dirty_node_ids is not None:
+                    base_state = self.__acc_base[1]
             from .device_state import DeviceState
             current_state = DeviceState(self,
                                         views=views,
                                         foreground_activity=foreground_activity,
                                         activity_stack=activity_stack,
                                         background_services=background_services,
-                                        screenshot_path=screenshot_path)
+                                        screenshot_path=screenshot.path if screenshot else None,
+                                        screenshot=screenshot,
+                                        base_state=base_state,
+                                        dirty_node_ids=dirty_node_ids)
+            self.__acc_base = (acc_version, current_state) if acc_version is not None else None
         except Exception as e:
             self.logger.warning("exception in get_current_state: %s" % e)
             import traceback
             traceback.print_exc()
+        finally:
+            self.__step_probe = None
         self.logger.debug("finish getting current device state...")
         self.last_know_state = current_state
         if not current_state:
@@ -862,8 +996,25 @@ class Device(object):
     def get_last_known_state(self):
         return self.last_know_state
 
+    def __send_input(self, action, *args):
+        """
+        inject an input event with the sendevent channel if it is enabled, otherwise (or if it fails) with adb
+        a gesture which failed after the touch went down is not repeated with adb
+        :param action: name of the method, one of touch, long_touch, drag and press
+        """
+        if self.adapters[self.sendevent_input] and self.sendevent_input.check_connectivity():
+            try:
+                if getattr(self.sendevent_input, action)(*args) is not False:
+                    return
+            except SendEventException as e:
+                if e.gesture_started:
+                    self.logger.warning("sendevent input failed during %s, not repeating it: %s" % (action, e))
+                    return
+                self.logger.warning("sendevent input failed, using adb input: %s" % e)
+        getattr(self.adb, action)(*args)
+
     def view_touch(self, x, y):
-        self.adb.touch(x, y)
+        self.__send_input("touch", x, y)
 
     def view_long_touch(self, x, y, duration=2000):
         """
@@ -871,13 +1022,13 @@ class Device(object):
         @param duration: duration in ms
         This workaround was suggested by U{HaMi<http://stackoverflow.com/users/2571957/hami>}
         """
-        self.adb.long_touch(x, y, duration)
+        self.__send_input("long_touch", x, y, duration)
 
     def view_drag(self, start_xy, end_xy, duration):
         """
         Sends drag event n PX (actually it's using C{input swipe} command.
         """
-        self.adb.drag(start_xy, end_xy, duration)
+        self.__send_input("drag", start_xy, end_xy, duration)
 
     def view_append_text(self, text):
         if self.droidbot_ime.connected:
@@ -893,28 +1044,53 @@ class Device(object):
             self.adb.type(text)
 
     def key_press(self, key_code):
-        self.adb.press(key_code)
+        self.__send_input("press", key_code)
 
     def shutdown(self):
         self.adb.shell("reboot -p")
 
+    def wait_for_ui_settle(self, max_wait):
+        """
+        wait until the UI is quiescent instead of sleeping a fixed time
+        falls back to sleeping max_wait seconds if the droidbot app is not connected
+        :param max_wait: the ceiling of waiting time in seconds
+        :return: True if the UI settled before max_wait
+        """
+        if not max_wait or max_wait <= 0:
+            return False
+        start_time = time.time()
+        if self.droidbot_app and self.adapters[self.droidbot_app] and self.droidbot_app.check_connectivity():
+            settled = self.droidbot_app.wait_for_settle(max_wait)
+        else:
+            time.sleep(max_wait)
+            settled = False
+        self.logger.debug("waited %.3fs for UI to settle (%s)" % (time.time() - start_time,
+                                                                 "settled" if settled else "ceiling reached"))
+        return settled
+
     def get_views(self):
+        return self.__get_views_with_version()[0]
+
+    def __get_views_with_version(self):
+        """
+        :return: (views, version of the accessibility tree they come from or None, see DroidBotAppConn.get_acc_views)
+        """
         if self.cv_mode and self.adapters[self.minicap]:
             # Get views using cv module
             views = self.minicap.get_views()
             if views:
-                return views
+                return views, None
             else:
                 self.logger.warning("Failed to get views using OpenCV.")
         if self.droidbot_app and self.adapters[self.droidbot_app]:
-            views = self.droidbot_app.get_views()
+            views, version = self.droidbot_app.get_acc_views()
             if views:
-                return views
+                return views, version
             else:
                 self.logger.warning("Failed to get views using Accessibility.")
 
         self.logger.warning("failed to get current views!")
-        return None
+        return None, None
 
     def get_random_port(self):
         """
@@ -932,6 +1108,7 @@ class Device(object):
         return port
 
     def handle_rotation(self):
+        self.adb.invalidate_display_info()
         if not self.adapters[self.minicap]:
             return
         self.pause_sending_event = True
@@ -10,6 +10,8 @@ import shutil
 from threading import Timer
 
 from .device import Device
+from .adapter.adb import ADB_TRANSPORT_SUBPROCESS
+from .adapter.sendevent import INPUT_BACKEND_ADB
 from .app import App
 from .env_manager import AppEnvManager
 from .input_manager import InputManager
@@ -48,7 +50,11 @@ class DroidBot(object):
                  master=None,
                  humanoid=None,
                  ignore_ad=False,
-                 replay_output=None):
+                 replay_output=None,
+                 adb_transport=ADB_TRANSPORT_SUBPROCESS,
+                 input_backend=INPUT_BACKEND_ADB,
+                 resume_utg=False,
+                 utg_cache_budget=None):
         """
         initiate droidbot with configurations
         :return:
@@ -88,6 +94,10 @@ class DroidBot(object):
         self.humanoid = humanoid
         self.ignore_ad = ignore_ad
         self.replay_output = replay_output
+        self.adb_transport = adb_transport
+        self.input_backend = input_backend
+        self.resume_utg = resume_utg
+        self.utg_cache_budget = utg_cache_budget
 
         self.enabled = True
 
@@ -100,7 +110,11 @@ class DroidBot(object):
                 grant_perm=grant_perm,
                 enable_accessibility_hard=self.enable_accessibility_hard,
                 humanoid=self.humanoid,
-                ignore_ad=ignore_ad)
+                ignore_ad=ignore_ad,
+                adb_transport=self.adb_transport,
+                input_backend=self.input_backend,
+                resume_utg=self.resume_utg,
+                utg_cache_budget=self.utg_cache_budget)
             self.app = App(app_path, output_dir=self.output_dir)
 
             self.env_manager = AppEnvManager(
@@ -0,0 +1,76 @@
+# Counts of the explored possible events of the states of a UTG
+
+
+class ExploredEventIndex(object):
+    """
+    the number of explored event strs among the possible input of each state
+    a state is registered once with the event strs of its possible input, an event str is marked explored once,
+    both update the counts of the states having the event str, so queries do not regenerate the possible input
+    """
+
+    def __init__(self):
+        self.explored_event_strs = set()
+        # state_str -> list of the distinct event strs of the possible input, in the order of get_possible_input
+        self.__state_event_strs = {}
+        # state_str -> number of explored event strs of the state
+        self.__num_explored = {}
+        # state_str -> position of the first event str that may be unexplored
+        self.__next_unexplored = {}
+        # event_str -> list of the state_strs having the event str, for the unexplored event strs
+        self.__event_state_strs = {}
+
+    def is_registered(self, state_str):
+        return state_str in self.__state_event_strs
+
+    def register_state(self, state_str, event_strs):
+        """
+        :param state_str: state_str of the state
+        :param event_strs: list of the event strs of the possible input of the state
+        """
+        if state_str in self.__state_event_strs:
+            return
+        event_strs = list(dict.fromkeys(event_strs))
+        num_explored = 0
+        for event_str in event_strs:
+            if event_str in self.explored_event_strs:
+                num_explored += 1
+            else:
+                self.__event_state_strs.setdefault(event_str, []).append(state_str)
+        self.__state_event_strs[state_str] = event_strs
+        self.__num_explored[state_str] = num_explored
+        self.__next_unexplored[state_str] = 0
+
+    def mark_explored(self, event_str):
+        if event_str in self.explored_event_strs:
+            return
+        self.explored_event_strs.add(event_str)
+        for state_str in self.__event_state_strs.pop(event_str, []):
+            self.__num_explored[state_str] += 1
+
+    def is_event_explored(self, event_str):
+        return event_str in self.explored_event_strs
+
+    def is_state_explored(self, state_str):
+        """
+        :return: True if all the possible events of the registered state are explored
+        """
+        return self.__num_explored[state_str] == len(self.__state_event_strs[state_str])
+
+    def get_num_events(self, state_str):
+        """
+        :return: (number of possible event strs, number of explored event strs) of the registered state
+        """
+        return len(self.__state_event_strs[state_str]), self.__num_explored[state_str]
+
+    def get_next_unexplored_event_str(self, state_str):
+        """
+        :return: the first unexplored event str of the registered state in the order of its possible input,
+        None if all are explored
+        """
+        event_strs = self.__state_event_strs[state_str]
+        # the events before the position are explored, and stay explored
+        position = self.__next_unexplored[state_str]
+        while position < len(event_strs) and event_strs[position] in self.explored_event_strs:
+            position += 1
+        self.__next_unexplored[state_str] = position
+        return event_strs[position] if position < len(event_strs) else None
@@ -148,6 +148,10 @@ class InputEvent(object):
             return ExitEvent(event_dict=event_dict)
         elif event_type == KEY_SpawnEvent:
             return SpawnEvent(event_dict=event_dict)
+        elif event_type == KEY_ManualEvent:
+            return ManualEvent(event_dict=event_dict)
+        elif event_type == KEY_KillAppEvent:
+            return KillAppEvent(event_dict=event_dict)
 
     @abstractmethod
     def get_event_str(self, state):
@@ -203,12 +207,11 @@ class EventLog(object):
             else:
                 output_dir = os.path.join(self.device.output_dir, "events")
         try:
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
             event_json_file_path = "%s/event_%s.json" % (output_dir, self.tag)
-            event_json_file = open(event_json_file_path, "w")
-            json.dump(self.to_dict(), event_json_file, indent=2)
-            event_json_file.close()
+            event_dict = self.to_dict()
+            # the json is written in background, copy the attributes of the event in case it is reused
+            event_dict["event"] = dict(event_dict["event"])
+            self.device.artifact_writer.write_json(event_json_file_path, event_dict, indent=2)
         except Exception as e:
             self.device.logger.warning("Saving event to dir failed.")
             self.device.logger.warning(e)
@@ -118,7 +118,7 @@ class InputManager(object):
         event_log = EventLog(self.device, self.app, event, self.profiling_method)
         event_log.start()
         while True:
-            time.sleep(self.event_interval)
+            self.device.wait_for_ui_settle(self.event_interval)
             if not self.device.pause_sending_event:
                 break
         event_log.stop()
@@ -131,7 +131,11 @@ class InputManager(object):
 
         try:
             if self.policy is not None:
-                self.policy.start(self)
+                try:
+                    self.policy.start(self)
+                finally:
+                    # the UTG database can only be used in the thread which opened it, close it here
+                    self.policy.stop()
             elif self.policy_name == POLICY_NONE:
                 self.device.start_app(self.app)
                 if self.event_count == 0:
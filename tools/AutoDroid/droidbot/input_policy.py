@@ -10,7 +10,6 @@ import requests
 import ast
 from .input_event import *
 from .utg import UTG
-import time
 from .input_event import ScrollEvent
 
 
@@ -116,6 +115,12 @@ class InputPolicy(object):
                 continue
             self.action_count += 1
 
+    def stop(self):
+        """
+        release the resources of the policy, called in the thread of start() after it returns
+        """
+        pass
+
     @abstractmethod
     def generate_event(self, input_manager):
         """
@@ -161,6 +166,9 @@ class UtgBasedInputPolicy(InputPolicy):
             self.humanoid_view_trees = []
             self.humanoid_events = []
 
+    def stop(self):
+        self.utg.close()
+
     def generate_event(self, input_manager):
         """
         generate an event
@@ -200,8 +208,7 @@ class UtgBasedInputPolicy(InputPolicy):
 
         if event is None:
             old_state, event = self.generate_event_based_on_utg(input_manager)
-            import time
-            time.sleep(3)
+            self.device.wait_for_ui_settle(3)
         # update last events for humanoid
         if self.device.humanoid is not None:
             self.humanoid_events = self.humanoid_events + [event]
@@ -541,17 +548,21 @@ class UtgGreedySearchPolicy(UtgBasedInputPolicy):
                 # If last navigation was failed, add nav target to missing states
                 self.__missed_states.add(self.__nav_target.state_str)
 
-        reachable_states = self.utg.get_reachable_states(current_state)
+        reachable_state_strs = self.utg.get_reachable_state_strs(current_state)
         if self.random_input:
-            random.shuffle(reachable_states)
+            random.shuffle(reachable_state_strs)
 
-        for state in reachable_states:
+        for state_str in reachable_state_strs:
+            # Do not consider missed states
+            if state_str in self.__missed_states:
+                continue
+            # the states are loaded from the UTG store, skip the known explored states before loading
+            if state_str in self.utg.explored_state_strs:
+                continue
+            state = self.utg.get_state(state_str)
             # Only consider foreground states
             if state.get_app_activity_depth(self.app) != 0:
                 continue
-            # Do not consider missed states
-            if state.state_str in self.__missed_states:
-                continue
             # Do not consider explored states
             if self.utg.is_state_explored(state):
                 continue
@@ -591,6 +602,9 @@ class UtgReplayPolicy(InputPolicy):
         self.last_state = None
         self.current_state = None
 
+    def stop(self):
+        self.utg.close()
+
     def generate_event(self):
         """
         generate an event based on replay_output
@@ -1253,7 +1267,7 @@ class FunctionExplorePolicy(InputPolicy):
                 # 生成触发主页面目录按钮的event
                 # self.logger.info("Current View")
                 # self.logger.info(self.current_state.views)
-                time.sleep(1)
+                self.device.wait_for_ui_settle(1)
                 self.current_state = self.device.get_current_state()
                 print(self.current_state.get_view_by_id(self.menu_bar_id))
                 return TouchEvent(view = self.current_state.get_view_by_id(self.menu_bar_id))
@@ -1269,7 +1283,7 @@ class FunctionExplorePolicy(InputPolicy):
         self.logger.info("I am finally here!")
 
         if self.menu_phase:
-            time.sleep(1)
+            self.device.wait_for_ui_settle(1)
             current_state = self.device.get_current_state()
             menu_view = current_state.get_view_by_id(r'com.sinovatech.unicom.ui:id/home_menu_pop_recylerView')
 
@@ -1302,7 +1316,7 @@ class FunctionExplorePolicy(InputPolicy):
             return ExitEvent() 
 
         if(self.page_phase):
-            time.sleep(1)
+            self.device.wait_for_ui_settle(1)
             current_state = self.device.get_current_state()
             # 遍历页面，获取按钮上的关键词和页面布局，为给大模型，让大模型进行：总结页面功能，判断是否由更多值得探索的子功能，返回进一步探索方案
             print(f"I am in page {self.current_content}!")
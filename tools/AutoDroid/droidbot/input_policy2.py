@@ -652,18 +652,13 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
             return nav_action
 
     def parse_log_lines(self):
-        log_lines = self.device.logcat.get_recent_lines()
-        filtered_lines = []
         app_pid = self.device.get_app_pid(self.app)
         # print(f'current app_pid: {app_pid}')
-        for line in log_lines:
-            try:
-                seps = line.split()
-                if int(seps[2]) == app_pid:
-                    filtered_lines.append(line)
-            except:
-                pass
-        return filtered_lines
+        if app_pid is None:
+            # consume the lines anyway, so that they are not attributed to the next event
+            self.device.logcat.get_recent_lines()
+            return []
+        return self.device.logcat.get_recent_lines(pid=app_pid)
 
     def get_shortest_nav_steps(self, current_state, target_state, target_action):
         normal_nav_steps = self.utg.get_G2_nav_steps(current_state, target_state)
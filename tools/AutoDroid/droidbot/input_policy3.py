@@ -12,7 +12,6 @@ import ast
 from .input_event import *
 from .utg import UTG
 from .my_utg import MyUTG
-import time
 from .input_event import ScrollEvent
 
 
@@ -75,6 +74,9 @@ class MyUtgBasedInputPolicy(InputPolicy):
             self.humanoid_view_trees = []
             self.humanoid_events = []
 
+    def stop(self):
+        self.utg.close()
+
     def generate_event(self, input_manager):
         """
         generate an event
@@ -108,8 +110,7 @@ class MyUtgBasedInputPolicy(InputPolicy):
 
         if event is None:
             old_state, event = self.generate_event_based_on_utg(input_manager)
-            import time
-            time.sleep(3)
+            self.device.wait_for_ui_settle(3)
         # update last events for humanoid
         if self.device.humanoid is not None:
             self.humanoid_events = self.humanoid_events + [event]
@@ -181,6 +182,10 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
         self.state_actions_map = {}  # 存储状态到可用动作的映射
         self.dfs_depth = 0
 
+    def stop(self):
+        super(FunctionExplorePolicy, self).stop()
+        self.my_utg.close()
+
     # 根据utg得出当前state执行返回event后应该落回的状态
     def _get_expected_state(self, current_state):
 
@@ -261,7 +266,7 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
                 # 生成触发主页面目录按钮的event
                 # self.logger.info("Current View")
                 # self.logger.info(self.current_state.views)
-                time.sleep(3)
+                self.device.wait_for_ui_settle(3)
                 self.current_state = self.device.get_current_state()
                 self.my_utg.add_node(self.current_state, "Starting point - Main page")
                 self.last_state = self.current_state
@@ -269,7 +274,7 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
                 # return self.current_state, TouchEvent(view = self.current_state.get_view_by_id(self.menu_bar_id))
 
         if self.menu_phrase:
-            time.sleep(3)
+            self.device.wait_for_ui_settle(3)
             current_state = self.device.get_current_state()
             self.my_utg.add_node(self.current_state, "Main page with menu bar - navigation to each main function of this app")
             self.my_utg.add_transition(TouchEvent(view = self.last_state.get_view_by_id(self.menu_bar_id)), self.last_state, self.current_state, KeyEvent(name="BACK"))
@@ -308,7 +313,7 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
             return self.current_state, ExitEvent() 
 
         if self.page_phrase:
-            time.sleep(5)
+            self.device.wait_for_ui_settle(5)
             self.current_state = self.device.get_current_state()
 
             def is_back_key_event(event):
@@ -326,7 +331,7 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
                             self.logger.info('Current state: ' + self.current_state.structure_str)
                             self.logger.info('Expected state: ' + self.expected_state)
                             self.logger.info("Waiting for the expected state...")
-                            time.sleep(1)
+                            self.device.wait_for_ui_settle(1)
                             waited_times += 1
                             self.current_state = self.device.get_current_state()
                             if self.current_state.structure_str == self.expected_state:
@@ -467,15 +472,19 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
         #         # If last navigation was failed, add nav target to missing states
         #         self.__missed_states.add(self.__nav_target.state_str)
 
-        reachable_states = self.utg.get_reachable_states(current_state)
+        reachable_state_strs = self.utg.get_reachable_state_strs(current_state)
 
-        for state in reachable_states:
+        for state_str in reachable_state_strs:
+            # Do not consider missed states
+            if state_str in self.__missed_states:
+                continue
+            # the states are loaded from the UTG store, skip the known explored states before loading
+            if state_str in self.utg.explored_state_strs:
+                continue
+            state = self.utg.get_state(state_str)
             # Only consider foreground states
             if state.get_app_activity_depth(self.app) != 0:
                 continue
-            # Do not consider missed states
-            if state.state_str in self.__missed_states:
-                continue
             # Do not consider explored states
             if self.utg.is_state_explored(state):
                 continue
@@ -515,7 +524,7 @@ class FunctionExplorePolicy(MyUtgBasedInputPolicy):
     def __explore_current_state(self):
         current_state = self.device.get_current_state()
         # 遍历页面，获取按钮上的关键词和页面布局，为给大模型，让大模型进行：总结页面功能，判断是否由更多值得探索的子功能，返回进一步探索方案
-        time.sleep(3)
+        self.device.wait_for_ui_settle(3)
         
         # scroll to get prompt content
         scrollable_views = current_state.get_scrollable_views()
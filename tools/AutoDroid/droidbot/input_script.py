@@ -18,6 +18,8 @@ REGEX_VAL = r'<regex>'
 EVENT_POLICY_VAL = '<event_policy>'
 EVENT_TYPE_VAL = '<event_type>'
 IDENTIFIER_RE = re.compile(r'^[^\d\W]\w*\Z', re.UNICODE)
+# maximum number of view values whose match results are kept by a ViewSelector
+VALUE_MATCH_CACHE_SIZE = 10000
 
 ViewSelector_VAL = 'ViewSelector'
 StateSelector_VAL = 'StateSelector'
@@ -275,6 +277,8 @@ class ViewSelector(object):
         self.script = script
         self.out_coordinates = []
         self.in_coordinates = []
+        # (view key, value) -> whether the regex of the key matches the value
+        self.value_matches = {}
         self.parse()
 
     def parse(self):
@@ -334,6 +338,51 @@ class ViewSelector(object):
                 return False
         return True
 
+    def match_value(self, key, regex, value):
+        """
+        return True if the regex of a view key matches a value, the results are cached
+        """
+        cache_key = (key, value)
+        matched = self.value_matches.get(cache_key)
+        if matched is None:
+            if len(self.value_matches) >= VALUE_MATCH_CACHE_SIZE:
+                self.value_matches.clear()
+            matched = bool(safe_re_match(regex, value))
+            self.value_matches[cache_key] = matched
+        return matched
+
+    def find_match(self, device_state):
+        """
+        find the first view of a state matched by this view_selector
+        if the state has view indexes (DeviceState.get_view_index), the regexes are run once for each distinct
+        value of a key, and only the views with matched values are checked
+        @param device_state: DeviceState
+        @return: the matched view_dict, or None
+        """
+        view_dicts = device_state.views
+        key_regexes = [(key, regex) for key, regex in [('resource_id', self.resource_id_re),
+                                                       ('class', self.class_re),
+                                                       ('text', self.text_re),
+                                                       ('content_description', self.content_desc_re)] if regex]
+        get_view_index = getattr(device_state, 'get_view_index', None)
+        if get_view_index is None or not key_regexes:
+            candidates = view_dicts
+        else:
+            candidate_ids = None
+            for key, regex in key_regexes:
+                matched_ids = set()
+                for value, view_ids in get_view_index(key).items():
+                    if self.match_value(key, regex, value):
+                        matched_ids.update(view_ids)
+                candidate_ids = matched_ids if candidate_ids is None else candidate_ids & matched_ids
+                if not candidate_ids:
+                    return None
+            candidates = [view_dicts[view_id] for view_id in sorted(candidate_ids)]
+        for view_dict in candidates:
+            if self.match(view_dict):
+                return view_dict
+        return None
+
 
 class StateSelector(object):
     """
@@ -395,17 +444,12 @@ class StateSelector(object):
             if not service_re_matched:
                 return False
         for view_selector in self.views:
-            view_selector_matched = False
             view_dicts = device_state.views
             if view_dicts is None:
                 return False
             if not isinstance(view_dicts, list):
                 return False
-            for view_dict in view_dicts:
-                if view_selector.match(view_dict):
-                    view_selector_matched = True
-                    break
-            if not view_selector_matched:
+            if view_selector.find_match(device_state) is None:
                 return False
         return True
 
@@ -7,6 +7,9 @@ import pdb
 import tools
 from .utils import md5
 from .input_event import TouchEvent, LongTouchEvent, ScrollEvent, SetTextEvent, KeyEvent, UIEvent
+from .view_store import ViewStore
+from .adapter.droidbot_app import ACC_NODE_ID_KEY
+from .screenshot import Screenshot
 import hashlib
 from treelib import Tree
 import networkx as nx
@@ -16,13 +19,21 @@ import numpy as np
 import yaml
 from collections import deque
 
+# keys added to the views while a state is built, not part of its bk_views
+DERIVED_VIEW_KEYS = ("signature", "content_free_signature", "view_str", "view_structure", "depth")
+
 class MyDeviceState(object):
     """
     the state of the current device
     """
 
     def __init__(self, device, views, foreground_activity, activity_stack, background_services,
-                 tag=None, screenshot_path=None):
+                 tag=None, screenshot_path=None, screenshot=None, base_state=None, dirty_node_ids=None,
+                 restored=None):
+        # base_state and dirty_node_ids: the previous state built from the same accessibility diff stream, and
+        # the ids of the nodes whose subtrees changed since then, the results of the clean subtrees are reused
+        # restored: the dict of a stored state with its subtree_hashes, see UTGStore, the views are then the
+        # stored views, already filtered and with their view strings, and nothing derived from them is recomputed
         self.device = device
         self.foreground_activity = foreground_activity
         self.activity_stack = activity_stack if isinstance(activity_stack, list) else []
@@ -32,27 +43,63 @@ class MyDeviceState(object):
             tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         self.tag = tag
         self.screenshot_path = screenshot_path
+        # the in-memory screenshot, if captured with Device.capture_screenshot
+        self.screenshot = screenshot
         self.views = self.__parse_views(views)
 
-        # 进行一个过滤
-        self.__filter_views()
-        
-        self.bk_views = copy.deepcopy(self.views)
-        self.view_graph = self._build_view_graph()
+        if restored is None:
+            # 进行一个过滤
+            self.__filter_views()
+            # a compact, read-only snapshot of the views before the view strings are added
+            self.bk_views = ViewStore(self.views)
+        else:
+            self.bk_views = ViewStore([dict((key, value) for key, value in view_dict.items()
+                                            if key not in DERIVED_VIEW_KEYS) for view_dict in self.views])
+        # the networkx view graph and the nested view tree are only built on demand, see view_graph and view_tree
+        self.__view_graph = None
+        self.__view_tree = None
+        self.__build_subtree_index()
+        # key -> nearest flagged view of each view, see __get_nearest_flagged_ids
+        self.__nearest_flagged_ids = {}
+        # key -> {value: view ids}, see get_view_index
+        self.__view_indexes = {}
         # self._adjust_view_clickability()
 
-        self.view_tree = {}
-        self.__assemble_view_tree(self.view_tree, self.views)
-        self.__generate_view_strs()
-        self.state_str = self.__get_hashed_state_str()
-        self.structure_str = self.__get_content_free_state_str()
+        # described actions by options, see get_described_actions
+        self.__described_actions_cache = {}
+        self.__described_actions_views = None
+        if restored is None:
+            self.__generate_view_strs(base_state, dirty_node_ids)
+            self.state_str = self.__get_hashed_state_str()
+            self.structure_str = self.__get_content_free_state_str()
+        else:
+            self.subtree_hashes = restored['subtree_hashes']
+            self.state_str = restored['state_str']
+            self.structure_str = restored['state_str_content_free']
         self.search_content = self.__get_search_content()
         self.possible_events = None
-        self.width = device.get_width(refresh=True)
+        self.width = device.get_width()
         self.height = device.get_height(refresh=False)
-        self._save_important_view_ids()
+        if restored is None:
+            # a restored state was saved when it was built
+            self._save_important_view_ids()
         
 
+    @property
+    def view_tree(self):
+        """
+        the nested view tree of bk_views, assembled on first access, bk_views is read-only so it stays valid
+        """
+        if self.__view_tree is None:
+            self.__view_tree = self.__assemble_view_tree(self.bk_views)
+        return self.__view_tree
+
+    @property
+    def view_graph(self):
+        if self.__view_graph is None:
+            self.__view_graph = self._build_view_graph()
+        return self.__view_graph
+
     @property
     def activity_short_name(self):
         return self.foreground_activity.split('.')[-1]
@@ -60,17 +107,12 @@ class MyDeviceState(object):
         
     def _save_important_view_ids(self):
         _, _, _, important_view_ids = self.get_described_actions(remove_time_and_ip=False)
-        ids_path = self.device.output_dir +'/states_view_ids'
-        if not os.path.exists(ids_path):
-            os.mkdir(ids_path)
         # if not isinstance(current_state, str):
         #     current_state_str = current_state.state_str
         # else:
         #     current_state_str = current_state
         important_view_id_path = self.device.output_dir +'/states_view_ids/'+ self.state_str + '.txt'
-        f = open(important_view_id_path, 'w', encoding='utf-8')
-        f.write(str(important_view_ids))
-        f.close()
+        self.device.artifact_writer.write_text(important_view_id_path, str(important_view_ids))
 
     def __get_hashed_state_str(self):
         state, _, _, _ = self.get_described_actions(remove_time_and_ip=True)
@@ -104,25 +146,103 @@ class MyDeviceState(object):
             # if resource_id is not None and ":" in resource_id:
             #     resource_id = resource_id[(resource_id.find(":") + 1):]
             #     view_dict['resource_id'] = resource_id
-            views.append(view_dict)
+            # the raw views are shared by all states built from the same accessibility event,
+            # keys are added and updated on a shallow copy, nested values are never modified
+            views.append(dict(view_dict))
         return views
 
-    def __assemble_view_tree(self, root_view, views):
-        if not len(self.view_tree): # bootstrap
-            self.view_tree = copy.deepcopy(views[0])
-            self.__assemble_view_tree(self.view_tree, views)
-        else:
-            children = list(enumerate(root_view["children"]))
-            if not len(children):
-                return
-            for i, j in children:
-                root_view["children"][i] = copy.deepcopy(self.views[j])
-                self.__assemble_view_tree(root_view["children"][i], views)
+    @staticmethod
+    def __assemble_view_tree(views, root_id=0):
+        """
+        build the nested view tree, each node is a shallow copy of a view with children replaced by child nodes
+        :param root_id: the view at the root of the tree
+        """
+        if not views:
+            return {}
+        view_tree = dict(views[root_id])
+        stack = [view_tree]
+        while stack:
+            node = stack.pop()
+            node["children"] = [dict(views[j]) for j in node["children"]]
+            stack.extend(node["children"])
+        return view_tree
+
+    def __generate_view_strs(self, base_state=None, dirty_node_ids=None):
+        """
+        compute the view_str of all views in one top-down pass, where each view extends the ancestor
+        signatures of its parent, then the subtree hashes of all views in one bottom-up pass
+        a view whose node is not dirty since base_state takes the signature and subtree hash of the same node
+        in base_state, and its view_str too if the activity and the signatures of its ancestors are unchanged
+        """
+        num_views = len(self.views)
+        base_ids = self.__match_base_views(base_state, dirty_node_ids)
+        # whether a view has the same ancestor signatures as its base view (and the activity is unchanged)
+        same_context = [False] * num_views
+        context_reusable = base_state is not None and base_state.foreground_activity == self.foreground_activity
+        # view id -> signatures of the view and its ancestors, from the root, joined by "//", built on demand
+        ancestor_strs = [None] * num_views
+
+        def get_ancestor_str(view_id):
+            path = []
+            while view_id >= 0 and ancestor_strs[view_id] is None:
+                path.append(view_id)
+                view_id = self._view_parent[view_id]
+            ancestor_str = ancestor_strs[view_id] if view_id >= 0 else ""
+            for path_id in reversed(path):
+                view_signature = MyDeviceState.__get_view_signature(self.views[path_id])
+                ancestor_str = ancestor_str + "//" + view_signature if ancestor_str else view_signature
+                ancestor_strs[path_id] = ancestor_str
+            return ancestor_str
+
+        for view_id in self._preorder:
+            view_dict = self.views[view_id]
+            parent_id = self._view_parent[view_id]
+            base_id, clean = base_ids[view_id]
+            if base_id >= 0:
+                base_view = base_state.views[base_id]
+                if clean:
+                    view_dict['signature'] = base_view['signature']
+                base_parent_id = base_state._view_parent[base_id]
+                if parent_id < 0:
+                    same_context[view_id] = context_reusable and base_parent_id < 0
+                else:
+                    same_context[view_id] = same_context[parent_id] and base_ids[parent_id][0] == base_parent_id \
+                        and MyDeviceState.__get_view_signature(self.views[parent_id]) == \
+                        base_state.views[base_parent_id]['signature']
+                if clean and same_context[view_id]:
+                    view_dict['view_str'] = base_view['view_str']
+                    continue
+            self.__get_view_str(view_dict, get_ancestor_str(parent_id) if parent_id >= 0 else "")
+
+        # the hash of a subtree covers the signatures of all views in it and the tree shape,
+        # equal subtrees have equal hashes, in this state and in others
+        self.subtree_hashes = [None] * num_views
+        for view_id in reversed(self._preorder):
+            base_id, clean = base_ids[view_id]
+            if clean:
+                self.subtree_hashes[view_id] = base_state.subtree_hashes[base_id]
+                continue
+            child_hashes = ",".join(self.subtree_hashes[child_id] for child_id in self._subtree_children[view_id])
+            subtree_str = "%s(%s)" % (MyDeviceState.__get_view_signature(self.views[view_id]), child_hashes)
+            self.subtree_hashes[view_id] = hashlib.md5(subtree_str.encode('utf-8')).hexdigest()
 
-    def __generate_view_strs(self):
+    def __match_base_views(self, base_state, dirty_node_ids):
+        """
+        match the views to the views of base_state by accessibility node id
+        :return: list of (id of the view with the same node in base_state or -1, whether the subtree is clean)
+        """
+        if base_state is None or dirty_node_ids is None:
+            return [(-1, False)] * len(self.views)
+        base_view_ids = {}
+        for base_id, base_view in enumerate(base_state.views):
+            node_id = base_view.get(ACC_NODE_ID_KEY)
+            if node_id is not None:
+                base_view_ids[node_id] = base_id
+        base_ids = []
         for view_dict in self.views:
-            self.__get_view_str(view_dict)
-            # self.__get_view_structure(view_dict)
+            base_id = base_view_ids.get(view_dict.get(ACC_NODE_ID_KEY), -1)
+            base_ids.append((base_id, base_id >= 0 and view_dict[ACC_NODE_ID_KEY] not in dirty_node_ids))
+        return base_ids
 
     @staticmethod
     def __calculate_depth(views):
@@ -212,15 +332,20 @@ class MyDeviceState(object):
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             dest_state_json_path = "%s/state_%s.json" % (output_dir, self.tag)
-            if self.device.adapters[self.device.minicap]:
+            screenshot = self.__load_screenshot()
+            if screenshot is not None:
+                dest_screenshot_path = "%s/screen_%s.%s" % (output_dir, self.tag, screenshot.format)
+            elif self.device.adapters[self.device.minicap]:
                 dest_screenshot_path = "%s/screen_%s.jpg" % (output_dir, self.tag)
             else:
                 dest_screenshot_path = "%s/screen_%s.png" % (output_dir, self.tag)
-            state_json_file = open(dest_state_json_path, "w")
-            state_json_file.write(self.to_json())
-            state_json_file.close()
-            import shutil
-            shutil.copyfile(self.screenshot_path, dest_screenshot_path)
+            # the views are not modified after the state is built, the json is written in background
+            self.device.artifact_writer.write_json(dest_state_json_path, self.to_dict(), indent=2)
+            if screenshot is not None:
+                self.device.artifact_writer.write_bytes(dest_screenshot_path, screenshot.data)
+            else:
+                import shutil
+                shutil.copyfile(self.screenshot_path, dest_screenshot_path)
             self.screenshot_path = dest_screenshot_path
             # from PIL.Image import Image
             # if isinstance(self.screenshot_path, Image):
@@ -242,21 +367,44 @@ class MyDeviceState(object):
                 view_file_path = "%s/view_%s.jpg" % (output_dir, view_str)
             else:
                 view_file_path = "%s/view_%s.png" % (output_dir, view_str)
+            view_bound = view_dict['bounds']
+            screenshot = self.__load_screenshot()
+            if screenshot is not None:
+                # crop from the image decoded once for the state, and save it in background,
+                # the writer skips it if the view image is already written or pending
+                self.device.artifact_writer.submit_once(
+                    view_file_path, lambda: MyDeviceState.__crop_view_img(screenshot.image, view_bound, view_file_path))
+                return
             if os.path.exists(view_file_path):
                 return
             from PIL import Image
             # Load the original image:
-            view_bound = view_dict['bounds']
             original_img = Image.open(self.screenshot_path)
-            # view bound should be in original image bound
-            view_img = original_img.crop((min(original_img.width - 1, max(0, view_bound[0][0])),
-                                          min(original_img.height - 1, max(0, view_bound[0][1])),
-                                          min(original_img.width, max(0, view_bound[1][0])),
-                                          min(original_img.height, max(0, view_bound[1][1]))))
-            view_img.convert("RGB").save(view_file_path)
+            MyDeviceState.__crop_view_img(original_img, view_bound, view_file_path)
         except Exception as e:
             self.device.logger.warning(e)
 
+    def __load_screenshot(self):
+        """
+        get the in-memory screenshot, read from screenshot_path once if the screen was not captured in memory
+        :return: Screenshot, or None if there is no screenshot
+        """
+        if self.screenshot is None and self.screenshot_path and os.path.isfile(self.screenshot_path):
+            with open(self.screenshot_path, "rb") as f:
+                data = f.read()
+            image_format = os.path.splitext(self.screenshot_path)[1].lstrip(".") or "png"
+            self.screenshot = Screenshot(data, image_format, self.screenshot_path)
+        return self.screenshot
+
+    @staticmethod
+    def __crop_view_img(original_img, view_bound, view_file_path):
+        # view bound should be in original image bound
+        view_img = original_img.crop((min(original_img.width - 1, max(0, view_bound[0][0])),
+                                      min(original_img.height - 1, max(0, view_bound[0][1])),
+                                      min(original_img.width, max(0, view_bound[1][0])),
+                                      min(original_img.height, max(0, view_bound[1][1]))))
+        view_img.convert("RGB").save(view_file_path)
+
     def is_different_from(self, another_state):
         """
         compare this state with another
@@ -304,25 +452,29 @@ class MyDeviceState(object):
         view_dict['content_free_signature'] = content_free_signature
         return content_free_signature
 
-    def __get_view_str(self, view_dict):
+    def __get_view_str(self, view_dict, parent_str=None):
         """
         get a string which can represent the given view
         @param view_dict: dict, an element of list MyDeviceState.views
+        @param parent_str: the signatures of the ancestors joined by "//", collected from the views if None
         @return:
         """
         if 'view_str' in view_dict:
             return view_dict['view_str']
         view_signature = MyDeviceState.__get_view_signature(view_dict)
-        parent_strs = []
-        for parent_id in self.get_all_ancestors(view_dict):
-            parent_strs.append(MyDeviceState.__get_view_signature(self.views[parent_id]))
-        parent_strs.reverse()
+        if parent_str is None:
+            parent_strs = []
+            for parent_id in self.get_all_ancestors(view_dict):
+                parent_strs.append(MyDeviceState.__get_view_signature(self.views[parent_id]))
+            parent_strs.reverse()
+            parent_str = "//".join(parent_strs)
         child_strs = []
-        for child_id in self.get_all_children(view_dict):
+        # the direct children, which is also what get_all_children returns, without walking the subtree
+        for child_id in set(MyDeviceState.__safe_dict_get(view_dict, 'children') or []):
             child_strs.append(MyDeviceState.__get_view_signature(self.views[child_id]))
         child_strs.sort()
         view_str = "Activity:%s\nSelf:%s\nParents:%s\nChildren:%s" % \
-                   (self.foreground_activity, view_signature, "//".join(parent_strs), "||".join(child_strs))
+                   (self.foreground_activity, view_signature, parent_str, "||".join(child_strs))
         import hashlib
         view_str = hashlib.md5(view_str.encode('utf-8')).hexdigest()
         view_dict['view_str'] = view_str
@@ -506,12 +658,40 @@ class MyDeviceState(object):
         return [] + possible_events
     
     def _get_self_ancestors_property(self, view, key, default=None):
-        all_views = [view] + [self.views[i] for i in self.get_all_ancestors(view)]
-        for v in all_views:
-            value = self.__safe_dict_get(v, key)
-            if value:
-                return value
-        return default
+        flagged_view = self.__find_flagged_view(view, key)
+        if flagged_view is None:
+            return default
+        return self.__safe_dict_get(flagged_view, key)
+
+    def __get_nearest_flagged_ids(self, key):
+        """
+        get, for each view, the id of the nearest view with a truthy key among itself and its ancestors
+        computed with one top-down pass over the views in pre-order, and cached for each key
+        :return: list of int, -1 if there is no such view
+        """
+        nearest_ids = self.__nearest_flagged_ids.get(key)
+        if nearest_ids is None:
+            nearest_ids = [-1] * len(self.views)
+            for view_id in self._preorder:
+                if self.__safe_dict_get(self.views[view_id], key):
+                    nearest_ids[view_id] = view_id
+                elif self._view_parent[view_id] >= 0:
+                    nearest_ids[view_id] = nearest_ids[self._view_parent[view_id]]
+            self.__nearest_flagged_ids[key] = nearest_ids
+        return nearest_ids
+
+    def __find_flagged_view(self, view, key):
+        """
+        find the nearest view with a truthy key among the view and its ancestors
+        :return: dict, the view, or None if there is no such view
+        """
+        if self.__safe_dict_get(view, key):
+            return view
+        parent_id = self.__safe_dict_get(view, 'parent', -1)
+        if not 0 <= parent_id < len(self.views):
+            return None
+        nearest_id = self.__get_nearest_flagged_ids(key)[parent_id]
+        return self.views[nearest_id] if nearest_id >= 0 else None
     
 
     def _merge_text(self, view_text, content_description):
@@ -638,6 +818,54 @@ class MyDeviceState(object):
     #             print(node, self.views[node]['text'], self.views[node]['content_description'])            
     #     # import pdb;pdb.set_trace()
     #     return view_tree
+    def __build_subtree_index(self):
+        """
+        index the view tree (as given by the parent of each view) in pre-order,
+        the descendants of a view are the contiguous slice preorder[preorder_pos[id] + 1:subtree_end[id]]
+        """
+        num_views = len(self.views)
+        children = [[] for _ in range(num_views)]
+        self._view_parent = [-1] * num_views
+        roots = [0] if num_views else []
+        for view_id in range(1, num_views):
+            parent_id = self.views[view_id]['parent']
+            if 0 <= parent_id < num_views and parent_id != view_id:
+                children[parent_id].append(view_id)
+                self._view_parent[view_id] = parent_id
+            else:
+                roots.append(view_id)
+        self._subtree_children = children
+        self._preorder = []
+        self._preorder_pos = [-1] * num_views
+        self._subtree_end = [0] * num_views
+        self._view_depth = [0] * num_views
+        for root_id in roots:
+            if self._preorder_pos[root_id] >= 0:
+                continue
+            # (view id, depth), or (-view id - 1, depth) to close the subtree of the view
+            stack = [(root_id, 0)]
+            while stack:
+                item = stack.pop()
+                if item[0] < 0:
+                    self._subtree_end[-item[0] - 1] = len(self._preorder)
+                    continue
+                view_id, depth = item
+                if self._preorder_pos[view_id] >= 0:
+                    continue
+                self._preorder_pos[view_id] = len(self._preorder)
+                self._view_depth[view_id] = depth
+                self._preorder.append(view_id)
+                stack.append((-view_id - 1, depth))
+                for child_id in reversed(children[view_id]):
+                    stack.append((child_id, depth + 1))
+
+    def _is_descendant(self, view_id, ancestor_id):
+        """
+        check if a view is in the subtree of another view (excluding itself)
+        """
+        pos = self._preorder_pos[view_id]
+        return self._preorder_pos[ancestor_id] < pos < self._subtree_end[ancestor_id]
+
     def _build_view_graph(self):        
         view_graph = nx.DiGraph()
         for view_id in range(1, len(self.views)):
@@ -662,6 +890,9 @@ class MyDeviceState(object):
                     if successor != view_id and self.__safe_dict_get(self.views[successor], 'clickable', False):
                         # print(self.views[view_id], 'disabled, because of ', self.views[successor])
                         self.views[view_id]['clickable'] = False
+                        self.__described_actions_cache = {}
+                        self.__nearest_flagged_ids = {}
+                        self.__view_indexes = {}
                         # print('origin:', view_id, 'because of:', successor, 'disabled')
                         break
             if self.__safe_dict_get(self.views[view_id], 'checkable', default=False):
@@ -669,26 +900,32 @@ class MyDeviceState(object):
                 for successor in successors:
                     if successor != view_id and self.__safe_dict_get(self.views[successor], 'checkable', False):
                         self.views[view_id]['checkable'] = False
+                        self.__described_actions_cache = {}
+                        self.__nearest_flagged_ids = {}
+                        self.__view_indexes = {}
                         break
     
     def _get_ancestor_id(self, view, key, default=None):
         if self.__safe_dict_get(view, key=key, default=False):
             return view['temp_id']
-        all_views = [view] + [self.views[i] for i in self.get_all_ancestors(view)]
-        for v in all_views:
-            value = self.__safe_dict_get(v, key)
-            if value:
-                return v['temp_id']
-        return default
+        flagged_view = self.__find_flagged_view(view, key)
+        if flagged_view is None:
+            return default
+        return flagged_view['temp_id']
     
     def _extract_all_children(self, id):
+        """
+        get the descendants (within 100 levels) of a view, grouped by parent, parents in pre-order
+        :return: a new list of view ids
+        """
         successors = []
-        successors_of_view = nx.dfs_successors(self.view_graph, source=id, depth_limit=100)
-        # print(successors_of_view)
-        for k, v in successors_of_view.items():
-            for successor_id in v:
-                if successor_id not in successors and successor_id != id:
-                    successors.append(successor_id)
+        if id is None or not 0 <= id < len(self.views):
+            return successors
+        start = self._preorder_pos[id]
+        max_depth = self._view_depth[id] + 100
+        for view_id in self._preorder[start:self._subtree_end[id]]:
+            if self._view_depth[view_id] < max_depth:
+                successors.extend(self._subtree_children[view_id])
         return successors
         # if len(self.viewtree.children(id)) == 0:
         #     return
@@ -786,7 +1023,21 @@ class MyDeviceState(object):
                                 merge_buttons =True, add_edit_box = True, add_check_box = True, add_pure_text = True):
         """
         Get a text description of current state
+        the description is computed once for each combination of options, and cached until self.views is replaced
+        :return: (state description, candidate actions, view descriptions without ids, important view ids),
+            the lists and actions are copies, callers may modify them
         """
+        if self.__described_actions_views is not self.views:
+            self.__described_actions_cache = {}
+            self.__described_actions_views = self.views
+        options = (remove_time_and_ip, merge_buttons, add_edit_box, add_check_box, add_pure_text)
+        if options not in self.__described_actions_cache:
+            self.__described_actions_cache[options] = self.__describe_actions(*options)
+        views_desc, available_actions, views_without_id, important_view_ids = self.__described_actions_cache[options]
+        return (prefix + views_desc, [copy.copy(action) for action in available_actions], list(views_without_id),
+                [list(important_view_id) for important_view_id in important_view_ids])
+
+    def __describe_actions(self, remove_time_and_ip, merge_buttons, add_edit_box, add_check_box, add_pure_text):
         enabled_view_ids = []
         for view_dict in self.views:
             # exclude navigation bar if exists
@@ -923,10 +1174,8 @@ class MyDeviceState(object):
                 available_actions.append(TouchEvent(view=view))
         view_descs.append(f"<button id={len(view_descs)}>go back</button>")
         available_actions.append(KeyEvent(name='BACK'))
-        # state_desc = 'The current state has the following UI elements: \n' #views and corresponding actions, with action id in parentheses:\n '
-        state_desc = prefix #'Given a screen, an instruction, predict the id of the UI element to perform the insturction. The screen has the following UI elements: \n'
-        # state_desc = 'You can perform actions on a contacts app, the current state of which has the following UI views and corresponding actions, with action id in parentheses:\n'
-        state_desc += '\n'.join(view_descs)
+        # the prefix of the state description is added in get_described_actions
+        state_desc = '\n'.join(view_descs)
         
         views_without_id = self._remove_view_ids(view_descs)
         # print(views_without_id)
@@ -1209,29 +1458,50 @@ class MyDeviceState(object):
     
 
     def __filter_views(self):
-        def is_all_children_invisible(view_dict):
-            """检查一个节点的所有子节点是否都不可见"""
-            if not self.__safe_dict_get(view_dict, 'children'):
-                return True
-            
-            for child_id in view_dict['children']:
-                child_view = self.views[child_id]
-                if self.__safe_dict_get(child_view, 'visible'):
-                    return False
-                # 递归检查子节点的子节点
-                if not is_all_children_invisible(child_view):
-                    return False
-            return True
-
-        # 过滤views列表，只保留可见的view或其子节点有可见的view
-        self.views = [
-            view_dict for view_dict in self.views
-            if self.__safe_dict_get(view_dict, 'visible') or not is_all_children_invisible(view_dict)
-        ]
+        """
+        只保留可见的view或其子节点有可见的view，并重新分配temp_id
+        the ids in parent and children are remapped to the new temp_ids, the kept views form a subtree
+        since the ancestors of a kept view are kept too
+        """
+        num_views = len(self.views)
+        # 一次后序遍历：keep[i]表示view i可见或有可见的子孙节点
+        keep = [False] * num_views
+        visited = [False] * num_views
+        for root_id in range(num_views):
+            if visited[root_id]:
+                continue
+            visited[root_id] = True
+            # (view id, whether its children are pushed)
+            stack = [(root_id, False)]
+            while stack:
+                view_id, expanded = stack.pop()
+                view_dict = self.views[view_id]
+                children = self.__safe_dict_get(view_dict, 'children') or []
+                if expanded:
+                    keep[view_id] = bool(self.__safe_dict_get(view_dict, 'visible')) or \
+                        any(keep[child_id] for child_id in children)
+                    continue
+                stack.append((view_id, True))
+                for child_id in children:
+                    if not visited[child_id]:
+                        visited[child_id] = True
+                        stack.append((child_id, False))
 
-        # 重新分配temp_id
-        for idx, view_dict in enumerate(self.views):
+        new_ids = [-1] * num_views
+        views = []
+        for view_id in range(num_views):
+            if keep[view_id]:
+                new_ids[view_id] = len(views)
+                views.append(self.views[view_id])
+        # 重新分配temp_id, the children lists may be shared with other states and are replaced, not modified
+        for idx, view_dict in enumerate(views):
             view_dict['temp_id'] = idx
+            parent_id = view_dict.get('parent')
+            if isinstance(parent_id, int) and 0 <= parent_id < num_views:
+                view_dict['parent'] = new_ids[parent_id]
+            if view_dict.get('children'):
+                view_dict['children'] = [new_ids[child_id] for child_id in view_dict['children'] if keep[child_id]]
+        self.views = views
 
     
 
@@ -1405,28 +1675,37 @@ class MyDeviceState(object):
             resource_id: 要查找的资源ID字符串，例如"com.example:id/button"
         
         返回:
-            匹配的视图节点(dict)，如果未找到则返回None
-        """
-        def find_view_in_tree(node):
-            # 处理单个节点
-            if isinstance(node, dict):
-                if node.get('resource_id') == resource_id:
-                    return node
-                # 递归搜索子节点
-                for child in node.get('children', []):
-                    result = find_view_in_tree(child)
-                    if result is not None:
-                        return result
-            # 处理节点列表
-            elif isinstance(node, list):
-                for item in node:
-                    result = find_view_in_tree(item)
-                    if result is not None:
-                        return result
+            匹配的视图节点(dict)，即view_tree中以该视图为根的子树，如果未找到则返回None
+        """
+        # views are in pre-order, the first one is the node a search of view_tree would find
+        view_ids = self.get_view_ids('resource_id', resource_id)
+        if not view_ids:
             return None
-        
-        # 从view_tree开始搜索
-        return find_view_in_tree(self.view_tree)
+        return self.__assemble_view_tree(self.bk_views, view_ids[0])
+
+    def get_view_index(self, key):
+        """
+        get the index of the views by the value of a key, e.g. resource_id, class or text
+        the index is built on first use for each key
+        :return: dict, value -> list of view ids in order
+        """
+        index = self.__view_indexes.get(key)
+        if index is None:
+            index = {}
+            for view_dict in self.views:
+                value = view_dict.get(key)
+                if isinstance(value, list):
+                    continue
+                index.setdefault(value, []).append(view_dict['temp_id'])
+            self.__view_indexes[key] = index
+        return index
+
+    def get_view_ids(self, key, value):
+        """
+        get the ids of the views whose key equals value
+        :return: list of view ids in order
+        """
+        return self.get_view_index(key).get(value, [])
     
     def is_current_activity(self, activity_name):
         """
@@ -1465,18 +1744,15 @@ class MyDeviceState(object):
         available_actions = []
 
         # Step 1: 找到所有匹配指定 class 的父 view
-        target_view_ids = [
-            view['temp_id']
-            for view in self.views
-            if self.__safe_dict_get(view, 'class') == target_class
-        ]
+        target_view_ids = self.get_view_ids('class', target_class)
 
         # Step 2: 找出所有 parent 属于 target_view_ids 的子 view
+        target_child_ids = sorted(child_id for view_id in target_view_ids
+                                  for child_id in self._subtree_children[view_id])
         target_child_views = [
-            view for view in self.views
-            if self.__safe_dict_get(view, 'parent') in target_view_ids and
-            self.__safe_dict_get(view, 'visible') and
-            self.__safe_dict_get(view, 'resource_id') not in [
+            self.views[child_id] for child_id in target_child_ids
+            if self.__safe_dict_get(self.views[child_id], 'visible') and
+            self.__safe_dict_get(self.views[child_id], 'resource_id') not in [
                 'android:id/navigationBarBackground',
                 'android:id/statusBarBackground'
             ]
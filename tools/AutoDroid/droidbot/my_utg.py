@@ -3,8 +3,18 @@ import json
 import os
 import random
 import datetime
+import threading
 import networkx as nx
 
+from .nav_index import NavigationIndex
+from .explored_index import ExploredEventIndex
+from .utg_store import UTGStore, GRAPH_STATE, GRAPH_STRUCTURE
+
+UTG_DB_NAME = "my_utg.db"
+# seconds from a change of the UTG to the rewrite of my_utg.js, later changes are written together
+UTG_OUTPUT_DELAY = 5
+UTG_FILE_NAME = "my_utg.js"
+
 
 class MyUTG(object):
     """
@@ -17,13 +27,24 @@ class MyUTG(object):
         self.app = app
         self.random_input = random_input
 
+        # the states are kept in the database, the nodes of G2 only refer to them by state_str,
+        # with a few light attributes, see store.get_stats() for the use of the state cache
+        self.store = UTGStore(device,
+                              os.path.join(device.output_dir, UTG_DB_NAME) if device.output_dir else None,
+                              resume=device.resume_utg, cache_budget=device.utg_cache_budget)
+
         self.G = nx.DiGraph()
         self.G2 = nx.DiGraph()  # graph with same-structure states clustered
+        # cached shortest paths of G and G2, edges are added to and removed from both graphs and indexes
+        self.G_nav_index = NavigationIndex(self.G)
+        self.G2_nav_index = NavigationIndex(self.G2)
 
-        self.transitions = []
+        self.transition_count = 0
         self.effective_event_strs = set()
         self.ineffective_event_strs = set()
         self.explored_state_strs = set()
+        # explored event strs are the effective and ineffective ones, counted per state
+        self.explored_event_index = ExploredEventIndex()
         self.reached_state_strs = set()
         self.reached_activities = set()
 
@@ -32,6 +53,16 @@ class MyUTG(object):
 
         self.start_time = datetime.datetime.now()
 
+        # nodes and edges in the format of my_utg.js, updated on each change, see __output_utg
+        self.utg_nodes = {}
+        self.utg_edges = {}
+        self.__device_info = None
+        self.__output_lock = threading.RLock()
+        self.__output_timer = None
+
+        if device.resume_utg:
+            self.__resume()
+
     @property
     def first_state_str(self):
         return self.first_state.structure_str if self.first_state else None
@@ -46,7 +77,53 @@ class MyUTG(object):
 
     @property
     def num_transitions(self):
-        return len(self.transitions)
+        return self.transition_count
+
+    def get_state(self, state_str):
+        return self.store.get_state(state_str)
+
+    def __resume(self):
+        """
+        rebuild the graph and the explored events from the database of a previous run
+        """
+        for structure_str, state_str, state_function in self.store.get_structures():
+            self.G2.add_node(structure_str, state_str=state_str, function=state_function)
+        for state_str, structure_str, foreground_activity, num_views in self.store.get_states():
+            if self.G2.nodes[structure_str]['state_str'] == state_str:
+                self.G2.nodes[structure_str].update(activity=foreground_activity, num_views=num_views)
+            if foreground_activity.startswith(self.app.package_name):
+                self.reached_activities.add(foreground_activity)
+
+        for src, dst, event_str, event_id, event, reverse_event in self.store.get_edge_events(GRAPH_STRUCTURE):
+            if (src, dst) not in self.G2.edges():
+                self.G2.add_edge(src, dst, events={})
+                self.G2_nav_index.add_edge(src, dst)
+            self.G2[src][dst]["events"][event_str] = {
+                "event": event,
+                "id": event_id,
+                "reverse_event": reverse_event
+            }
+
+        self.effective_event_strs, self.ineffective_event_strs = self.store.get_event_strs()
+        for event_str in self.effective_event_strs | self.ineffective_event_strs:
+            self.explored_event_index.mark_explored(event_str)
+        first_state_str = self.store.get_info("first_state_str")
+        last_state_str = self.store.get_info("last_state_str")
+        self.first_state = self.get_state(first_state_str) if first_state_str else None
+        self.last_state = self.get_state(last_state_str) if last_state_str else None
+        self.transition_count = self.store.get_info("num_transitions", 0)
+
+        for structure_str in self.G2.nodes():
+            self.__output_utg(node=structure_str)
+        for edge in self.G2.edges():
+            self.__output_utg(edge=edge)
+        self.logger.info("Resumed UTG: %d states, %d transitions" % (len(self.G2.nodes()), self.transition_count))
+
+    def __save_info(self):
+        # only the first state of a structure is stored, it stands for the states of the same structure
+        for key, state in [("first_state_str", self.first_state), ("last_state_str", self.last_state)]:
+            self.store.set_info(key, self.G2.nodes[state.structure_str]["state_str"] if state else None)
+        self.store.set_info("num_transitions", self.transition_count)
 
     def add_transition(self, event, old_state, new_state, reverse_event=None):
         self.add_node(old_state, None)
@@ -57,7 +134,7 @@ class MyUTG(object):
             return
 
         event_str = event.get_event_str(old_state)
-        self.transitions.append((old_state, event, new_state))
+        self.transition_count += 1
 
         # if old_state.state_str == new_state.state_str:
         #     self.ineffective_event_strs.add(event_str)
@@ -70,6 +147,8 @@ class MyUTG(object):
         #     return
 
         self.effective_event_strs.add(event_str)
+        self.store.add_event_str(event_str, effective=True)
+        self.explored_event_index.mark_explored(event_str)
 
         # if (old_state.state_str, new_state.state_str) not in self.G.edges():
         #     self.G.add_edge(old_state.state_str, new_state.state_str, events={})
@@ -80,6 +159,7 @@ class MyUTG(object):
 
         if (old_state.structure_str, new_state.structure_str) not in self.G2.edges():
             self.G2.add_edge(old_state.structure_str, new_state.structure_str, events={})
+            self.G2_nav_index.add_edge(old_state.structure_str, new_state.structure_str)
         self.G2[old_state.structure_str][new_state.structure_str]["events"][event_str] = {
             "event": event,
             "id": self.effective_event_count,
@@ -87,10 +167,14 @@ class MyUTG(object):
             # 添加逆事件
             "reverse_event": reverse_event
         }
+        self.store.add_edge_event(GRAPH_STRUCTURE, old_state.structure_str, new_state.structure_str, event_str,
+                                  self.effective_event_count, event, reverse_event)
 
         self.last_state = new_state
+        self.__save_info()
+        self.store.commit()
         self.logger.info("Add transition: %s -> %s", old_state.structure_str, new_state.structure_str)
-        self.__output_utg()
+        self.__output_utg(edge=(old_state.structure_str, new_state.structure_str))
 
     def remove_transition(self, event, old_state, new_state):
         event_str = event.get_event_str(old_state)
@@ -98,24 +182,39 @@ class MyUTG(object):
             events = self.G[old_state.state_str][new_state.state_str]["events"]
             if event_str in events.keys():
                 events.pop(event_str)
+                self.store.remove_edge_event(GRAPH_STATE, old_state.state_str, new_state.state_str, event_str)
             if len(events) == 0:
                 self.G.remove_edge(old_state.state_str, new_state.state_str)
+                self.G_nav_index.remove_edge(old_state.state_str, new_state.state_str)
         if (old_state.structure_str, new_state.structure_str) in self.G2.edges():
             events = self.G2[old_state.structure_str][new_state.structure_str]["events"]
             if event_str in events.keys():
                 events.pop(event_str)
+                self.store.remove_edge_event(GRAPH_STRUCTURE, old_state.structure_str, new_state.structure_str,
+                                             event_str)
             if len(events) == 0:
                 self.G2.remove_edge(old_state.structure_str, new_state.structure_str)
+                self.G2_nav_index.remove_edge(old_state.structure_str, new_state.structure_str)
+            self.store.commit()
+            self.__output_utg(edge=(old_state.structure_str, new_state.structure_str))
 
     def add_node(self, state, state_function):
         if not state:
             return
         
         if state.structure_str not in self.G2.nodes():
-            self.G2.add_node(state.structure_str, state=state, function=state_function)
+            self.store.add_state(state)
+            self.store.add_structure(state.structure_str, state.state_str, state_function)
+            self.store.commit()
+            self.G2.add_node(state.structure_str, state_str=state.state_str, function=state_function,
+                             activity=state.foreground_activity, num_views=len(state.views))
+            self.__output_utg(node=state.structure_str)
         elif self.G2.nodes[state.structure_str].get('function') is None and state_function is not None:
             # 如果节点已存在但function为None，且新传入的state_function不为None，则更新function
             self.G2.nodes[state.structure_str]['function'] = state_function
+            self.store.set_structure_function(state.structure_str, state_function)
+            self.store.commit()
+            self.__output_utg(node=state.structure_str)
 
 
         if state.foreground_activity.startswith(self.app.package_name):
@@ -155,148 +254,174 @@ class MyUTG(object):
             
             # 返回第一个前驱状态对应的具体状态实例
             predecessor_structure = predecessors[0]
-            if self.G2.nodes[predecessor_structure]['state']:
-                return self.G2.nodes[predecessor_structure]['state']
+            if self.G2.nodes[predecessor_structure]['state_str']:
+                return self.get_state(self.G2.nodes[predecessor_structure]['state_str'])
             return None
             
         except Exception as e:
             self.logger.warning(f"Error getting expected state for {current_state.structure_str}: {str(e)}")
             return None
 
-    def __output_utg(self):
+    def __output_utg(self, node=None, edge=None):
         """
-        Output current UTG to a js file
+        record a changed node or edge of G2, and schedule a rewrite of my_utg.js in UTG_OUTPUT_DELAY seconds
+        :param node: structure_str of the changed node
+        :param edge: (from structure_str, to structure_str) of the changed edge
         """
         if not self.device.output_dir:
             return
 
-        def list_to_html_table(dict_data):
-            table = "<table class=\"table\">\n"
-            for (key, value) in dict_data:
-                table += "<tr><th>%s</th><td>%s</td></tr>\n" % (key, value)
-            table += "</table>"
-            return table
-
-        utg_file_path = os.path.join(self.device.output_dir, "my_utg.js")
-        utg_file = open(utg_file_path, "w")
-        utg_nodes = []
-        utg_edges = []
-        for structure_str in self.G2.nodes():
-            # state_structure一样的state我们将其视作一致，因此随意取一个
-            state = self.G2.nodes[structure_str]["state"]
-            state_function = self.G2.nodes[structure_str]["function"]
-            package_name = state.foreground_activity.split("/")[0]
-            activity_name = state.foreground_activity.split("/")[1]
-            short_activity_name = activity_name.split(".")[-1]
-
-            state_desc = list_to_html_table([
-                ("package", package_name),
-                ("activity", activity_name),
-                ("state_str", state.state_str),
-                ("structure_str", state.structure_str)
-            ])
-
-            # utg_node = {
-            #     "id": state_str,
-            #     "shape": "image",
-            #     "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
-            #     "label": short_activity_name,
-            #     # "group": state.foreground_activity,
-            #     "package": package_name,
-            #     "activity": activity_name,
-            #     "state_str": state_str,
-            #     "structure_str": state.structure_str,
-            #     "title": state_desc,
-            #     "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
-            # }
-            
-            utg_node = {
-                "id": structure_str,
-                "function": state_function,
-                "shape": "image",
-                "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
-                "label": state_function,
-                # "group": state.foreground_activity,
-                "package": package_name,
-                "activity": activity_name,
-                "structure_str": structure_str,
-                "title": state_desc,
-                "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
-            }
-
-            if state.structure_str == self.first_state_str:
-                utg_node["label"] += "\n<FIRST>"
-                utg_node["font"] = "14px Arial red"
-            if state.structure_str == self.last_state_str:
-                utg_node["label"] += "\n<LAST>"
-                utg_node["font"] = "14px Arial red"
-
-            utg_nodes.append(utg_node)
-
-        for state_transition in self.G2.edges():
-            from_state = state_transition[0]
-            to_state = state_transition[1]
-
-            events = self.G2[from_state][to_state]["events"]
-            event_short_descs = []
-            event_list = []
-
-            for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
-                event_short_descs.append((event_info["id"], event_str))
-                # if self.device.adapters[self.device.minicap]:
-                #     view_images = ["views/view_" + view["view_str"] + ".jpg"
-                #                    for view in event_info["event"].get_views()]
-                # else:
-                #     view_images = ["views/view_" + view["view_str"] + ".png"
-                #                    for view in event_info["event"].get_views()]
-                # event_list.append({
-                #     "event_str": event_str,
-                #     "event_id": event_info["id"],
-                #     "event_type": event_info["event"].event_type,
-                #     "view_images": view_images
-                # })
-
-            utg_edge = {
-                "from": from_state,
-                "to": to_state,
-                "id": from_state + "-->" + to_state,
-                "title": list_to_html_table(event_short_descs),
-                "label": ", ".join([str(x["event_id"]) for x in event_list]),
-                "events": event_list
-            }
-
-            # # Highlight last transition
-            # if state_transition == self.last_transition:
-            #     utg_edge["color"] = "red"
-
-            utg_edges.append(utg_edge)
+        with self.__output_lock:
+            if node is not None:
+                self.utg_nodes[node] = self.__get_utg_node(node)
+            if edge is not None:
+                if edge in self.G2.edges():
+                    self.utg_edges[edge] = self.__get_utg_edge(*edge)
+                else:
+                    self.utg_edges.pop(edge, None)
+
+            if self.__output_timer is None:
+                # a daemon thread, the pending rewrite at the end of the exploration is done by close()
+                self.__output_timer = threading.Timer(UTG_OUTPUT_DELAY, self.flush)
+                self.__output_timer.daemon = True
+                self.__output_timer.start()
+
+    @staticmethod
+    def __list_to_html_table(dict_data):
+        table = "<table class=\"table\">\n"
+        for (key, value) in dict_data:
+            table += "<tr><th>%s</th><td>%s</td></tr>\n" % (key, value)
+        table += "</table>"
+        return table
+
+    def __get_utg_node(self, structure_str):
+        # state_structure一样的state我们将其视作一致，因此随意取一个
+        state = self.get_state(self.G2.nodes[structure_str]["state_str"])
+        state_function = self.G2.nodes[structure_str]["function"]
+        package_name = state.foreground_activity.split("/")[0]
+        activity_name = state.foreground_activity.split("/")[1]
+
+        state_desc = MyUTG.__list_to_html_table([
+            ("package", package_name),
+            ("activity", activity_name),
+            ("state_str", state.state_str),
+            ("structure_str", state.structure_str)
+        ])
+
+        return {
+            "id": structure_str,
+            "function": state_function,
+            "shape": "image",
+            "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
+            "label": state_function,
+            # "group": state.foreground_activity,
+            "package": package_name,
+            "activity": activity_name,
+            "structure_str": structure_str,
+            "title": state_desc,
+            "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
+        }
 
-        utg = {
-            "nodes": utg_nodes,
-            "edges": utg_edges,
+    def __get_utg_edge(self, from_state, to_state):
+        events = self.G2[from_state][to_state]["events"]
+        event_short_descs = []
+        event_list = []
+
+        for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
+            event_short_descs.append((event_info["id"], event_str))
+            # if self.device.adapters[self.device.minicap]:
+            #     view_images = ["views/view_" + view["view_str"] + ".jpg"
+            #                    for view in event_info["event"].get_views()]
+            # else:
+            #     view_images = ["views/view_" + view["view_str"] + ".png"
+            #                    for view in event_info["event"].get_views()]
+            # event_list.append({
+            #     "event_str": event_str,
+            #     "event_id": event_info["id"],
+            #     "event_type": event_info["event"].event_type,
+            #     "view_images": view_images
+            # })
+
+        return {
+            "from": from_state,
+            "to": to_state,
+            "id": from_state + "-->" + to_state,
+            "title": MyUTG.__list_to_html_table(event_short_descs),
+            "label": ", ".join([str(x["event_id"]) for x in event_list]),
+            "events": event_list
+        }
 
-            "num_nodes": len(utg_nodes),
-            "num_edges": len(utg_edges),
-            "num_effective_events": len(self.effective_event_strs),
-            "num_reached_activities": len(self.reached_activities),
-            "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "time_spent": (datetime.datetime.now() - self.start_time).total_seconds(),
-            "num_transitions": self.num_transitions,
+    def flush(self):
+        """
+        Output current UTG to a js file, from the recorded nodes and edges
+        """
+        if not self.device.output_dir:
+            return
 
-            "device_serial": self.device.serial,
-            "device_model_number": self.device.get_model_number(),
-            "device_sdk_version": self.device.get_sdk_version(),
+        with self.__output_lock:
+            if self.__output_timer is not None:
+                self.__output_timer.cancel()
+                self.__output_timer = None
+
+            if self.__device_info is None:
+                # adb round trips, the values do not change during a run
+                self.__device_info = {
+                    "device_serial": self.device.serial,
+                    "device_model_number": self.device.get_model_number(),
+                    "device_sdk_version": self.device.get_sdk_version()
+                }
+
+            utg_nodes = []
+            for structure_str, utg_node in self.utg_nodes.items():
+                if structure_str in (self.first_state_str, self.last_state_str):
+                    utg_node = dict(utg_node)
+                    if structure_str == self.first_state_str:
+                        utg_node["label"] += "\n<FIRST>"
+                        utg_node["font"] = "14px Arial red"
+                    if structure_str == self.last_state_str:
+                        utg_node["label"] += "\n<LAST>"
+                        utg_node["font"] = "14px Arial red"
+                utg_nodes.append(utg_node)
+            utg_edges = list(self.utg_edges.values())
+
+            utg = {
+                "nodes": utg_nodes,
+                "edges": utg_edges,
+
+                "num_nodes": len(utg_nodes),
+                "num_edges": len(utg_edges),
+                "num_effective_events": len(self.effective_event_strs),
+                "num_reached_activities": len(self.reached_activities),
+                "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                "time_spent": (datetime.datetime.now() - self.start_time).total_seconds(),
+                "num_transitions": self.num_transitions,
+                "state_cache": self.store.get_stats(),
+
+                "device_serial": self.__device_info["device_serial"],
+                "device_model_number": self.__device_info["device_model_number"],
+                "device_sdk_version": self.__device_info["device_sdk_version"],
+
+                "app_sha256": self.app.hashes[2],
+                "app_package": self.app.package_name,
+                "app_main_activity": self.app.main_activity,
+                "app_num_total_activities": len(self.app.activities),
+            }
 
-            "app_sha256": self.app.hashes[2],
-            "app_package": self.app.package_name,
-            "app_main_activity": self.app.main_activity,
-            "app_num_total_activities": len(self.app.activities),
-        }
+            # write to a temporary file first, so that the viewer never reads a partial file
+            utg_file_path = os.path.join(self.device.output_dir, UTG_FILE_NAME)
+            utg_json = json.dumps(utg, indent=2)
+            with open(utg_file_path + ".tmp", "w") as utg_file:
+                utg_file.write("var utg = \n")
+                utg_file.write(utg_json)
+            os.replace(utg_file_path + ".tmp", utg_file_path)
 
-        utg_json = json.dumps(utg, indent=2)
-        utg_file.write("var utg = \n")
-        utg_file.write(utg_json)
-        utg_file.close()
+    def close(self):
+        """
+        write the pending changes to my_utg.js and close the database, at the end of the exploration
+        """
+        self.flush()
+        self.logger.info("UTG state cache: %s" % json.dumps(self.store.get_stats()))
+        self.store.close()
 
     def is_event_explored(self, event, state):
         event_str = event.get_event_str(state)
@@ -307,25 +432,40 @@ class MyUTG(object):
 
         return event_str in self.effective_event_strs or event_str in self.ineffective_event_strs
 
+    def __register_state(self, state):
+        if not self.explored_event_index.is_registered(state.state_str):
+            self.explored_event_index.register_state(
+                state.state_str, [possible_event.get_event_str(state) for possible_event in state.get_possible_input()])
+
     def is_state_explored(self, state):
         if state.state_str in self.explored_state_strs:
             return True
-        for possible_event in state.get_possible_input():
-            if not self.is_event_explored(possible_event, state):
-                return False
+        self.__register_state(state)
+        if not self.explored_event_index.is_state_explored(state.state_str):
+            return False
         self.explored_state_strs.add(state.state_str)
         return True
 
+    def get_next_unexplored_event_str(self, state):
+        """
+        :return: the event str of the first unexplored event in the possible input of the state, None if none
+        """
+        self.__register_state(state)
+        return self.explored_event_index.get_next_unexplored_event_str(state.state_str)
+
     def is_state_reached(self, state):
         if state.state_str in self.reached_state_strs:
             return True
         self.reached_state_strs.add(state.state_str)
         return False
 
+    def get_reachable_state_strs(self, current_state):
+        return list(self.G_nav_index.descendants(current_state.state_str))
+
     def get_reachable_states(self, current_state):
         reachable_states = []
-        for target_state_str in nx.descendants(self.G, current_state.state_str):
-            target_state = self.G.nodes[target_state_str]["state"]
+        for target_state_str in self.get_reachable_state_strs(current_state):
+            target_state = self.get_state(target_state_str)
             reachable_states.append(target_state)
         return reachable_states
 
@@ -336,7 +476,7 @@ class MyUTG(object):
             steps = []
             from_state_str = from_state.state_str
             to_state_str = to_state.state_str
-            state_strs = nx.shortest_path(G=self.G, source=from_state_str, target=to_state_str)
+            state_strs = self.G_nav_index.shortest_path(from_state_str, to_state_str)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
                 self.logger.warning(f"Error getting path from {from_state_str} to {to_state_str}")
             start_state_str = state_strs[0]
@@ -345,7 +485,7 @@ class MyUTG(object):
                 edge_event_strs = list(edge["events"].keys())
                 if self.random_input:
                     random.shuffle(edge_event_strs)
-                start_state = self.G.nodes[start_state_str]['state']
+                start_state = self.get_state(start_state_str)
                 event = edge["events"][edge_event_strs[0]]["event"]
                 steps.append((start_state, event))
                 start_state_str = state_str
@@ -375,7 +515,7 @@ class MyUTG(object):
         to_state_str = to_state.structure_str
         try:
             nav_steps = []
-            state_strs = nx.shortest_path(G=self.G2, source=from_state_str, target=to_state_str)
+            state_strs = self.G2_nav_index.shortest_path(from_state_str, to_state_str)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
                 return None
             start_state_str = state_strs[0]
@@ -0,0 +1,106 @@
+# Cached shortest paths and reachability over a UTG graph
+from collections import OrderedDict, deque
+
+import networkx as nx
+
+# number of sources whose BFS tree is kept, the least recently queried trees are dropped first
+NAV_INDEX_MAX_TREES = 128
+
+
+class NavigationIndex(object):
+    """
+    answers shortest path and reachability queries on a nx.DiGraph with BFS trees cached per source
+    the owner of the graph reports each added and removed edge, a cached tree is repaired for an added edge,
+    and dropped when a removed edge is on the tree
+    """
+
+    def __init__(self, graph, max_trees=NAV_INDEX_MAX_TREES):
+        """
+        :param graph: nx.DiGraph, the graph to index
+        :param max_trees: int, maximum number of cached BFS trees
+        """
+        self.graph = graph
+        self.max_trees = max_trees
+        # source -> (dict of node -> distance, dict of node -> predecessor on a shortest path)
+        self.__trees = OrderedDict()
+
+    def __get_tree(self, source):
+        tree = self.__trees.get(source)
+        if tree is not None:
+            self.__trees.move_to_end(source)
+            return tree
+        # the adjacency dict of the graph, graph.successors() costs more than the search itself
+        successors = self.graph._succ
+        distances = {source: 0}
+        predecessors = {}
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            for successor in successors[node]:
+                if successor not in distances:
+                    distances[successor] = distances[node] + 1
+                    predecessors[successor] = node
+                    queue.append(successor)
+        tree = (distances, predecessors)
+        self.__trees[source] = tree
+        if len(self.__trees) > self.max_trees:
+            self.__trees.popitem(last=False)
+        return tree
+
+    def add_edge(self, u, v):
+        """
+        update the cached trees after the edge u -> v was added to the graph
+        """
+        successors = self.graph._succ
+        for distances, predecessors in self.__trees.values():
+            if u not in distances or distances[u] + 1 >= distances.get(v, float("inf")):
+                continue
+            # the edge shortens the paths to v, and to the nodes reached through v
+            distances[v] = distances[u] + 1
+            predecessors[v] = u
+            queue = deque([v])
+            while queue:
+                node = queue.popleft()
+                for successor in successors[node]:
+                    if distances[node] + 1 < distances.get(successor, float("inf")):
+                        distances[successor] = distances[node] + 1
+                        predecessors[successor] = node
+                        queue.append(successor)
+
+    def remove_edge(self, u, v):
+        """
+        update the cached trees after the edge u -> v was removed from the graph
+        """
+        for source in [source for source, (_, predecessors) in self.__trees.items() if predecessors.get(v) == u]:
+            del self.__trees[source]
+
+    def clear(self):
+        self.__trees.clear()
+
+    def shortest_path(self, source, target):
+        """
+        same as nx.shortest_path(graph, source, target), one of the shortest paths if there are several
+        :return: list of nodes from source to target
+        """
+        if source not in self.graph:
+            raise nx.NodeNotFound("Source {} is not in G".format(source))
+        if target not in self.graph:
+            raise nx.NodeNotFound("Target {} is not in G".format(target))
+        distances, predecessors = self.__get_tree(source)
+        if target not in distances:
+            raise nx.NetworkXNoPath("No path between {} and {}.".format(source, target))
+        path = [target]
+        while path[-1] != source:
+            path.append(predecessors[path[-1]])
+        path.reverse()
+        return path
+
+    def descendants(self, source):
+        """
+        same as nx.descendants(graph, source)
+        :return: set of the nodes reachable from source
+        """
+        if source not in self.graph:
+            raise nx.NetworkXError("The node {} is not in the graph.".format(source))
+        distances, _ = self.__get_tree(source)
+        return set(distances) - {source}
@@ -0,0 +1,35 @@
+# In-memory screenshot
+import io
+import threading
+
+
+class Screenshot(object):
+    """
+    a screenshot kept in memory as encoded image bytes
+    the file at `path` is written in background, use `image` to access the pixels without reading it back
+    """
+
+    def __init__(self, data, image_format, path=None):
+        """
+        :param data: bytes, the encoded image
+        :param image_format: str, "png" (screencap) or "jpg" (minicap)
+        :param path: str, where the image is (or will be) written
+        """
+        self.data = data
+        self.format = image_format
+        self.path = path
+        self.__image = None
+        self.__lock = threading.Lock()
+
+    @property
+    def image(self):
+        """
+        the decoded PIL image, decoded at most once
+        """
+        with self.__lock:
+            if self.__image is None:
+                from PIL import Image
+                image = Image.open(io.BytesIO(self.data))
+                image.load()
+                self.__image = image
+            return self.__image
@@ -4,6 +4,9 @@ import argparse
 from . import input_manager
 from . import input_policy
 from . import env_manager
+from .adapter import adb
+from .adapter import sendevent
+from . import utg_store
 from .droidbot import DroidBot
 from .droidmaster import DroidMaster
 
@@ -89,6 +92,26 @@ def parse_args():
                         help="Ignore Ad views by checking resource_id.")
     parser.add_argument("-replay_output", action="store", dest="replay_output",
                         help="The droidbot output directory being replayed.")
+    parser.add_argument("-adb_transport", action="store", dest="adb_transport",
+                        default=adb.ADB_TRANSPORT_SUBPROCESS, choices=adb.ADB_TRANSPORTS,
+                        help="How to send adb commands. Default: %s.\n"
+                             "  \"subprocess\" -- run an adb client process per command;\n"
+                             "  \"socket\" -- talk to the adb server directly over pooled sockets."
+                             % adb.ADB_TRANSPORT_SUBPROCESS)
+    parser.add_argument("-input_backend", action="store", dest="input_backend",
+                        default=sendevent.INPUT_BACKEND_ADB, choices=sendevent.INPUT_BACKENDS,
+                        help="How to inject touches and key presses. Default: %s.\n"
+                             "  \"adb\" -- run `input tap/swipe/keyevent` per event;\n"
+                             "  \"sendevent\" -- stream raw input events through a persistent shell."
+                             % sendevent.INPUT_BACKEND_ADB)
+    parser.add_argument("-resume_utg", action="store_true", dest="resume_utg",
+                        help="Continue the UTG saved in the output dir by a previous run, "
+                             "with the states and the explored events of that run.")
+    parser.add_argument("-utg_cache_budget", action="store", dest="utg_cache_budget", type=int,
+                        default=utg_store.STATE_CACHE_BUDGET // (1024 * 1024),
+                        help="Memory budget in MB of the states the UTG keeps in memory, the others are "
+                             "loaded from the UTG database when needed. Default: %d."
+                             % (utg_store.STATE_CACHE_BUDGET // (1024 * 1024)))
     options = parser.parse_args()
     # print options
     return options
@@ -106,6 +129,8 @@ def main():
         return
     if not opts.output_dir and opts.cv_mode:
         print("To run in CV mode, you need to specify an output dir (using -o option).")
+    if not opts.output_dir and opts.resume_utg:
+        print("To resume the UTG, you need to specify the output dir of the previous run (using -o option).")
 
     if opts.distributed:
         if opts.distributed == "master":
@@ -165,7 +190,11 @@ def main():
             master=opts.master,
             humanoid=opts.humanoid,
             ignore_ad=opts.ignore_ad,
-            replay_output=opts.replay_output)
+            replay_output=opts.replay_output,
+            adb_transport=opts.adb_transport,
+            input_backend=opts.input_backend,
+            resume_utg=opts.resume_utg,
+            utg_cache_budget=opts.utg_cache_budget * 1024 * 1024)
         droidbot.start()
     return
 
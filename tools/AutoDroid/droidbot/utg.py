@@ -5,6 +5,11 @@ import random
 import datetime
 import networkx as nx
 
+from .nav_index import NavigationIndex
+from .utg_store import UTGStore, GRAPH_STATE, GRAPH_STRUCTURE
+
+UTG_DB_NAME = "utg.db"
+
 
 class UTG(object):
     """
@@ -17,10 +22,19 @@ class UTG(object):
         self.app = app
         self.random_input = random_input
 
+        # the states are kept in the database, the nodes of G and G2 only refer to them by state_str,
+        # with a few light attributes, see store.get_stats() for the use of the state cache
+        self.store = UTGStore(device,
+                              os.path.join(device.output_dir, UTG_DB_NAME) if device.output_dir else None,
+                              resume=device.resume_utg, cache_budget=device.utg_cache_budget)
+
         self.G = nx.DiGraph()
         self.G2 = nx.DiGraph()  # graph with same-structure states clustered
+        # cached shortest paths of G and G2, edges are added to and removed from both graphs and indexes
+        self.G_nav_index = NavigationIndex(self.G)
+        self.G2_nav_index = NavigationIndex(self.G2)
 
-        self.transitions = []
+        self.transition_count = 0
         self.effective_event_strs = set()
         self.ineffective_event_strs = set()
         self.explored_state_strs = set()
@@ -32,6 +46,12 @@ class UTG(object):
 
         self.start_time = datetime.datetime.now()
 
+        # nodes of utg.js, built when the state is added
+        self.utg_nodes = {}
+
+        if device.resume_utg:
+            self.__resume()
+
     @property
     def first_state_str(self):
         return self.first_state.state_str if self.first_state else None
@@ -46,7 +66,49 @@ class UTG(object):
 
     @property
     def num_transitions(self):
-        return len(self.transitions)
+        return self.transition_count
+
+    def get_state(self, state_str):
+        return self.store.get_state(state_str)
+
+    def __resume(self):
+        """
+        rebuild the graphs and the explored events from the database of a previous run
+        """
+        for state_str, structure_str, foreground_activity, num_views in self.store.get_states():
+            self.G.add_node(state_str, structure_str=structure_str, activity=foreground_activity,
+                            num_views=num_views)
+            if structure_str not in self.G2.nodes():
+                self.G2.add_node(structure_str, state_strs=[])
+            self.G2.nodes[structure_str]['state_strs'].append(state_str)
+            if foreground_activity.startswith(self.app.package_name):
+                self.reached_activities.add(foreground_activity)
+            if self.device.output_dir:
+                self.utg_nodes[state_str] = self.__get_utg_node(self.get_state(state_str))
+
+        for graph_name, graph, nav_index in [(GRAPH_STATE, self.G, self.G_nav_index),
+                                             (GRAPH_STRUCTURE, self.G2, self.G2_nav_index)]:
+            for src, dst, event_str, event_id, event, _ in self.store.get_edge_events(graph_name):
+                if (src, dst) not in graph.edges():
+                    graph.add_edge(src, dst, events={})
+                    nav_index.add_edge(src, dst)
+                graph[src][dst]["events"][event_str] = {
+                    "event": event,
+                    "id": event_id
+                }
+
+        self.effective_event_strs, self.ineffective_event_strs = self.store.get_event_strs()
+        first_state_str = self.store.get_info("first_state_str")
+        last_state_str = self.store.get_info("last_state_str")
+        self.first_state = self.get_state(first_state_str) if first_state_str else None
+        self.last_state = self.get_state(last_state_str) if last_state_str else None
+        self.transition_count = self.store.get_info("num_transitions", 0)
+        self.logger.info("Resumed UTG: %d states, %d transitions" % (len(self.G.nodes()), self.transition_count))
+
+    def __save_info(self):
+        self.store.set_info("first_state_str", self.first_state_str)
+        self.store.set_info("last_state_str", self.last_state_str)
+        self.store.set_info("num_transitions", self.transition_count)
 
     def add_transition(self, event, old_state, new_state):
         self.add_node(old_state)
@@ -57,35 +119,49 @@ class UTG(object):
             return
 
         event_str = event.get_event_str(old_state)
-        self.transitions.append((old_state, event, new_state))
+        self.transition_count += 1
 
         if old_state.state_str == new_state.state_str:
             self.ineffective_event_strs.add(event_str)
+            self.store.add_event_str(event_str, effective=False)
             # delete the transitions including the event from utg
             for new_state_str in self.G[old_state.state_str]:
                 if event_str in self.G[old_state.state_str][new_state_str]["events"]:
                     self.G[old_state.state_str][new_state_str]["events"].pop(event_str)
+                    self.store.remove_edge_event(GRAPH_STATE, old_state.state_str, new_state_str, event_str)
             if event_str in self.effective_event_strs:
                 self.effective_event_strs.remove(event_str)
+                self.store.remove_event_str(event_str, effective=True)
+            self.__save_info()
+            self.store.commit()
             return
 
         self.effective_event_strs.add(event_str)
+        self.store.add_event_str(event_str, effective=True)
 
         if (old_state.state_str, new_state.state_str) not in self.G.edges():
             self.G.add_edge(old_state.state_str, new_state.state_str, events={})
+            self.G_nav_index.add_edge(old_state.state_str, new_state.state_str)
         self.G[old_state.state_str][new_state.state_str]["events"][event_str] = {
             "event": event,
             "id": self.effective_event_count
         }
+        self.store.add_edge_event(GRAPH_STATE, old_state.state_str, new_state.state_str, event_str,
+                                  self.effective_event_count, event)
 
         if (old_state.structure_str, new_state.structure_str) not in self.G2.edges():
             self.G2.add_edge(old_state.structure_str, new_state.structure_str, events={})
+            self.G2_nav_index.add_edge(old_state.structure_str, new_state.structure_str)
         self.G2[old_state.structure_str][new_state.structure_str]["events"][event_str] = {
             "event": event,
             "id": self.effective_event_count
         }
+        self.store.add_edge_event(GRAPH_STRUCTURE, old_state.structure_str, new_state.structure_str, event_str,
+                                  self.effective_event_count, event)
 
         self.last_state = new_state
+        self.__save_info()
+        self.store.commit()
         self.__output_utg()
 
     def remove_transition(self, event, old_state, new_state):
@@ -94,30 +170,75 @@ class UTG(object):
             events = self.G[old_state.state_str][new_state.state_str]["events"]
             if event_str in events.keys():
                 events.pop(event_str)
+                self.store.remove_edge_event(GRAPH_STATE, old_state.state_str, new_state.state_str, event_str)
             if len(events) == 0:
                 self.G.remove_edge(old_state.state_str, new_state.state_str)
+                self.G_nav_index.remove_edge(old_state.state_str, new_state.state_str)
         if (old_state.structure_str, new_state.structure_str) in self.G2.edges():
             events = self.G2[old_state.structure_str][new_state.structure_str]["events"]
             if event_str in events.keys():
                 events.pop(event_str)
+                self.store.remove_edge_event(GRAPH_STRUCTURE, old_state.structure_str, new_state.structure_str,
+                                             event_str)
             if len(events) == 0:
                 self.G2.remove_edge(old_state.structure_str, new_state.structure_str)
+                self.G2_nav_index.remove_edge(old_state.structure_str, new_state.structure_str)
+        self.store.commit()
 
     def add_node(self, state):
         if not state:
             return
         if state.state_str not in self.G.nodes():
             state.save2dir()
-            self.G.add_node(state.state_str, state=state)
+            self.store.add_state(state)
+            self.G.add_node(state.state_str, structure_str=state.structure_str, activity=state.foreground_activity,
+                            num_views=len(state.views))
+            if self.device.output_dir:
+                self.utg_nodes[state.state_str] = self.__get_utg_node(state)
             if self.first_state is None:
                 self.first_state = state
 
         if state.structure_str not in self.G2.nodes():
-            self.G2.add_node(state.structure_str, states=[])
-        self.G2.nodes[state.structure_str]['states'].append(state)
+            self.G2.add_node(state.structure_str, state_strs=[])
+        self.G2.nodes[state.structure_str]['state_strs'].append(state.state_str)
 
         if state.foreground_activity.startswith(self.app.package_name):
             self.reached_activities.add(state.foreground_activity)
+        self.store.commit()
+
+    @staticmethod
+    def __list_to_html_table(dict_data):
+        table = "<table class=\"table\">\n"
+        for (key, value) in dict_data:
+            table += "<tr><th>%s</th><td>%s</td></tr>\n" % (key, value)
+        table += "</table>"
+        return table
+
+    def __get_utg_node(self, state):
+        package_name = state.foreground_activity.split("/")[0]
+        activity_name = state.foreground_activity.split("/")[1]
+        short_activity_name = activity_name.split(".")[-1]
+
+        state_desc = UTG.__list_to_html_table([
+            ("package", package_name),
+            ("activity", activity_name),
+            ("state_str", state.state_str),
+            ("structure_str", state.structure_str)
+        ])
+
+        return {
+            "id": state.state_str,
+            "shape": "image",
+            "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
+            "label": short_activity_name,
+            # "group": state.foreground_activity,
+            "package": package_name,
+            "activity": activity_name,
+            "state_str": state.state_str,
+            "structure_str": state.structure_str,
+            "title": state_desc,
+            "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
+        }
 
     def __output_utg(self):
         """
@@ -126,48 +247,17 @@ class UTG(object):
         if not self.device.output_dir:
             return
 
-        def list_to_html_table(dict_data):
-            table = "<table class=\"table\">\n"
-            for (key, value) in dict_data:
-                table += "<tr><th>%s</th><td>%s</td></tr>\n" % (key, value)
-            table += "</table>"
-            return table
-
         utg_file_path = os.path.join(self.device.output_dir, "utg.js")
         utg_file = open(utg_file_path, "w")
         utg_nodes = []
         utg_edges = []
-        for state_str in self.G.nodes():
-            state = self.G.nodes[state_str]["state"]
-            package_name = state.foreground_activity.split("/")[0]
-            activity_name = state.foreground_activity.split("/")[1]
-            short_activity_name = activity_name.split(".")[-1]
-
-            state_desc = list_to_html_table([
-                ("package", package_name),
-                ("activity", activity_name),
-                ("state_str", state.state_str),
-                ("structure_str", state.structure_str)
-            ])
-
-            utg_node = {
-                "id": state_str,
-                "shape": "image",
-                "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
-                "label": short_activity_name,
-                # "group": state.foreground_activity,
-                "package": package_name,
-                "activity": activity_name,
-                "state_str": state_str,
-                "structure_str": state.structure_str,
-                "title": state_desc,
-                "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
-            }
-
-            if state.state_str == self.first_state_str:
+        for state_str, utg_node in self.utg_nodes.items():
+            if state_str in (self.first_state_str, self.last_state_str):
+                utg_node = dict(utg_node)
+            if state_str == self.first_state_str:
                 utg_node["label"] += "\n<FIRST>"
                 utg_node["font"] = "14px Arial red"
-            if state.state_str == self.last_state_str:
+            if state_str == self.last_state_str:
                 utg_node["label"] += "\n<LAST>"
                 utg_node["font"] = "14px Arial red"
 
@@ -201,7 +291,7 @@ class UTG(object):
                 "from": from_state,
                 "to": to_state,
                 "id": from_state + "-->" + to_state,
-                "title": list_to_html_table(event_short_descs),
+                "title": UTG.__list_to_html_table(event_short_descs),
                 "label": ", ".join([str(x["event_id"]) for x in event_list]),
                 "events": event_list
             }
@@ -223,6 +313,7 @@ class UTG(object):
             "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
             "time_spent": (datetime.datetime.now() - self.start_time).total_seconds(),
             "num_transitions": self.num_transitions,
+            "state_cache": self.store.get_stats(),
 
             "device_serial": self.device.serial,
             "device_model_number": self.device.get_model_number(),
@@ -239,6 +330,13 @@ class UTG(object):
         utg_file.write(utg_json)
         utg_file.close()
 
+    def close(self):
+        """
+        close the database at the end of the exploration, utg.js is already written on each change
+        """
+        self.logger.info("UTG state cache: %s" % json.dumps(self.store.get_stats()))
+        self.store.close()
+
     def is_event_explored(self, event, state):
         return False
         # event_str = event.get_event_str(state)
@@ -259,10 +357,13 @@ class UTG(object):
         self.reached_state_strs.add(state.state_str)
         return False
 
+    def get_reachable_state_strs(self, current_state):
+        return list(self.G_nav_index.descendants(current_state.state_str))
+
     def get_reachable_states(self, current_state):
         reachable_states = []
-        for target_state_str in nx.descendants(self.G, current_state.state_str):
-            target_state = self.G.nodes[target_state_str]["state"]
+        for target_state_str in self.get_reachable_state_strs(current_state):
+            target_state = self.get_state(target_state_str)
             reachable_states.append(target_state)
         return reachable_states
 
@@ -273,7 +374,7 @@ class UTG(object):
             steps = []
             from_state_str = from_state.state_str
             to_state_str = to_state.state_str
-            state_strs = nx.shortest_path(G=self.G, source=from_state_str, target=to_state_str)
+            state_strs = self.G_nav_index.shortest_path(from_state_str, to_state_str)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
                 self.logger.warning(f"Error getting path from {from_state_str} to {to_state_str}")
             start_state_str = state_strs[0]
@@ -282,7 +383,7 @@ class UTG(object):
                 edge_event_strs = list(edge["events"].keys())
                 if self.random_input:
                     random.shuffle(edge_event_strs)
-                start_state = self.G.nodes[start_state_str]['state']
+                start_state = self.get_state(start_state_str)
                 event = edge["events"][edge_event_strs[0]]["event"]
                 steps.append((start_state, event))
                 start_state_str = state_str
@@ -312,14 +413,14 @@ class UTG(object):
         to_state_str = to_state.structure_str
         try:
             nav_steps = []
-            state_strs = nx.shortest_path(G=self.G2, source=from_state_str, target=to_state_str)
+            state_strs = self.G2_nav_index.shortest_path(from_state_str, to_state_str)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
                 return None
             start_state_str = state_strs[0]
             for state_str in state_strs[1:]:
                 edge = self.G2[start_state_str][state_str]
                 edge_event_strs = list(edge["events"].keys())
-                start_state = random.choice(self.G2.nodes[start_state_str]['states'])
+                start_state = self.get_state(random.choice(self.G2.nodes[start_state_str]['state_strs']))
                 event_str = random.choice(edge_event_strs)
                 event = edge["events"][event_str]["event"]
                 nav_steps.append((start_state, event))
@@ -0,0 +1,265 @@
+# Persistent storage of a UTG in a SQLite database
+import json
+import logging
+import os
+import sqlite3
+import zlib
+from collections import OrderedDict
+
+from .device_state import DeviceState
+from .input_event import InputEvent
+
+# memory budget in bytes of the states kept in memory, the other states are loaded from the database when needed
+STATE_CACHE_BUDGET = 256 * 1024 * 1024
+# a state (views, view store, indexes) takes about this many times the length of its json in memory
+STATE_SIZE_FACTOR = 3
+# graph of an edge in the edges table
+GRAPH_STATE = "G"
+GRAPH_STRUCTURE = "G2"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS states (
+    state_str TEXT PRIMARY KEY,
+    structure_str TEXT NOT NULL,
+    foreground_activity TEXT,
+    num_views INTEGER NOT NULL,
+    screenshot_path TEXT,
+    -- the zlib compressed json of the state
+    state_blob BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS states_structure_str ON states (structure_str);
+CREATE TABLE IF NOT EXISTS structures (
+    structure_str TEXT PRIMARY KEY,
+    state_str TEXT NOT NULL,
+    function TEXT
+);
+-- the primary key also serves the lookups by (graph, src, dst)
+CREATE TABLE IF NOT EXISTS edges (
+    graph TEXT NOT NULL,
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    event_str TEXT NOT NULL,
+    event_id INTEGER NOT NULL,
+    event_json TEXT NOT NULL,
+    reverse_event_json TEXT,
+    PRIMARY KEY (graph, src, dst, event_str)
+);
+-- an event str may be both effective and ineffective, as in UTG.effective_event_strs and ineffective_event_strs
+CREATE TABLE IF NOT EXISTS event_strs (
+    event_str TEXT NOT NULL,
+    effective INTEGER NOT NULL,
+    PRIMARY KEY (event_str, effective)
+);
+CREATE TABLE IF NOT EXISTS utg_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UTGStore(object):
+    """
+    the states, structures, edges and event strings of a UTG in a SQLite database,
+    so that an exploration can be resumed, and so that the states do not have to stay in memory
+    the recently used states are cached within a memory budget, the least recently used are dropped first
+    writes are grouped in a transaction until commit()
+    """
+
+    def __init__(self, device, db_path=None, resume=False, cache_budget=None):
+        """
+        :param device: instance of Device, the device of the loaded states
+        :param db_path: path of the database file, None for an in-memory database
+        :param resume: keep the content of an existing database file, otherwise the file is recreated
+        :param cache_budget: int, bytes of the cached states, estimated with STATE_SIZE_FACTOR,
+            None for STATE_CACHE_BUDGET
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.device = device
+        self.db_path = db_path
+        if db_path is None:
+            db_path = ":memory:"
+        elif not resume:
+            for path in (db_path, db_path + "-wal", db_path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.conn = sqlite3.connect(db_path)
+        # write-ahead logging: a commit appends to the log, and a crash loses at most the open transaction
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        # counted here as states are added, so that get_stats does not need the database
+        self.num_stored, stored_size = self.conn.execute("SELECT COUNT(*), TOTAL(LENGTH(state_blob)) "
+                                                         "FROM states").fetchone()
+        self.stored_size = int(stored_size)
+        # state_str -> (state, estimated size)
+        self.state_cache = OrderedDict()
+        self.cache_budget = cache_budget if cache_budget is not None else STATE_CACHE_BUDGET
+        self.cached_size = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        """
+        commit and close the database, a checkpoint moves the write-ahead log into the database file
+        """
+        if self.conn is None:
+            return
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+    def add_state(self, state):
+        state_dict = state.to_dict()
+        # restored with the state instead of recomputed, see DeviceState(restored=...)
+        state_dict["subtree_hashes"] = state.subtree_hashes
+        state_json = json.dumps(state_dict)
+        state_blob = zlib.compress(state_json.encode("utf-8"))
+        cursor = self.conn.execute("INSERT OR IGNORE INTO states VALUES (?, ?, ?, ?, ?, ?)",
+                                   (state.state_str, state.structure_str, state.foreground_activity,
+                                    len(state.views), self.__get_output_path(state.screenshot_path), state_blob))
+        if cursor.rowcount == 1:
+            self.num_stored += 1
+            self.stored_size += len(state_blob)
+        self.__cache_state(state, len(state_json) * STATE_SIZE_FACTOR)
+
+    def __get_output_path(self, path):
+        """
+        :return: path if it is in the output directory, None otherwise,
+            e.g. for a screenshot in the temp directory, which is deleted when the device disconnects
+        """
+        output_dir = self.device.output_dir
+        if not path or not output_dir:
+            return None
+        output_dir = os.path.abspath(output_dir)
+        if os.path.commonpath([output_dir, os.path.abspath(path)]) != output_dir:
+            return None
+        return path
+
+    def __cache_state(self, state, size):
+        if state.state_str in self.state_cache:
+            self.cached_size -= self.state_cache.pop(state.state_str)[1]
+        self.state_cache[state.state_str] = (state, size)
+        self.cached_size += size
+        # the state just added is kept even if it is over the budget alone
+        while self.cached_size > self.cache_budget and len(self.state_cache) > 1:
+            _, (_, evicted_size) = self.state_cache.popitem(last=False)
+            self.cached_size -= evicted_size
+            self.num_evictions += 1
+
+    def get_state(self, state_str):
+        """
+        get a state from the cache, or restore it from the database
+        :return: DeviceState, None if there is no such state
+        """
+        cached = self.state_cache.get(state_str)
+        if cached is not None:
+            self.state_cache.move_to_end(state_str)
+            self.num_hits += 1
+            return cached[0]
+        row = self.conn.execute("SELECT screenshot_path, state_blob FROM states WHERE state_str = ?",
+                                (state_str,)).fetchone()
+        if row is None:
+            return None
+        self.num_misses += 1
+        screenshot_path, state_blob = row
+        state_json = zlib.decompress(state_blob).decode("utf-8")
+        state_dict = json.loads(state_json)
+        state = DeviceState(self.device,
+                            views=state_dict["views"],
+                            foreground_activity=state_dict["foreground_activity"],
+                            activity_stack=state_dict["activity_stack"],
+                            background_services=state_dict["background_services"],
+                            tag=state_dict["tag"],
+                            screenshot_path=screenshot_path,
+                            restored=state_dict)
+        self.__cache_state(state, len(state_json) * STATE_SIZE_FACTOR)
+        return state
+
+    def get_states(self):
+        """
+        :return: list of (state_str, structure_str, foreground_activity, num_views), in insertion order
+        """
+        return self.conn.execute("SELECT state_str, structure_str, foreground_activity, num_views FROM states "
+                                 "ORDER BY rowid").fetchall()
+
+    def get_stats(self):
+        """
+        :return: dict, the use of the state cache, and the size of the stored states,
+            without a database query, so it can be called from any thread
+        """
+        return {
+            "cache_budget": self.cache_budget,
+            "cached_states": len(self.state_cache),
+            "cached_size": self.cached_size,
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "evictions": self.num_evictions,
+            "stored_states": self.num_stored,
+            "stored_size": self.stored_size
+        }
+
+    def add_structure(self, structure_str, state_str, function=None):
+        self.conn.execute("INSERT OR IGNORE INTO structures VALUES (?, ?, ?)", (structure_str, state_str, function))
+
+    def set_structure_function(self, structure_str, function):
+        self.conn.execute("UPDATE structures SET function = ? WHERE structure_str = ?", (function, structure_str))
+
+    def get_structures(self):
+        """
+        :return: list of (structure_str, state_str, function), in insertion order
+        """
+        return self.conn.execute("SELECT structure_str, state_str, function FROM structures "
+                                 "ORDER BY rowid").fetchall()
+
+    def add_edge_event(self, graph, src, dst, event_str, event_id, event, reverse_event=None):
+        self.conn.execute("INSERT OR REPLACE INTO edges VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (graph, src, dst, event_str, event_id, json.dumps(event.to_dict()),
+                           json.dumps(reverse_event.to_dict()) if reverse_event is not None else None))
+
+    def remove_edge_event(self, graph, src, dst, event_str):
+        self.conn.execute("DELETE FROM edges WHERE graph = ? AND src = ? AND dst = ? AND event_str = ?",
+                          (graph, src, dst, event_str))
+
+    def get_edge_events(self, graph):
+        """
+        :return: list of (src, dst, event_str, event_id, event, reverse_event), in insertion order,
+            without the events which can not be rebuilt, so that an edge is only restored with events
+        """
+        edge_events = []
+        for src, dst, event_str, event_id, event_json, reverse_event_json in self.conn.execute(
+                "SELECT src, dst, event_str, event_id, event_json, reverse_event_json FROM edges "
+                "WHERE graph = ? ORDER BY rowid", (graph,)):
+            event = InputEvent.from_dict(json.loads(event_json))
+            if event is None:
+                self.logger.warning("Skipped the stored event %s, it can not be rebuilt" % event_str)
+                continue
+            reverse_event = InputEvent.from_dict(json.loads(reverse_event_json)) if reverse_event_json else None
+            edge_events.append((src, dst, event_str, event_id, event, reverse_event))
+        return edge_events
+
+    def add_event_str(self, event_str, effective):
+        self.conn.execute("INSERT OR IGNORE INTO event_strs VALUES (?, ?)", (event_str, int(effective)))
+
+    def remove_event_str(self, event_str, effective):
+        self.conn.execute("DELETE FROM event_strs WHERE event_str = ? AND effective = ?", (event_str, int(effective)))
+
+    def get_event_strs(self):
+        """
+        :return: (set of effective event strs, set of ineffective event strs)
+        """
+        effective_event_strs = set()
+        ineffective_event_strs = set()
+        for event_str, effective in self.conn.execute("SELECT event_str, effective FROM event_strs"):
+            (effective_event_strs if effective else ineffective_event_strs).add(event_str)
+        return effective_event_strs, ineffective_event_strs
+
+    def set_info(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO utg_info VALUES (?, ?)", (key, json.dumps(value)))
+
+    def get_info(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM utg_info WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
@@ -0,0 +1,174 @@
+# Compact, read-only storage of the views of a state
+import sys
+from array import array
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# boolean attributes, kept as bits
+FLAG_KEYS = ["visible", "checkable", "checked", "clickable", "editable", "enabled", "focusable", "focused",
+             "is_password", "long_clickable", "scrollable", "selected"]
+# string attributes, interned so that equal strings are shared by all views and states
+STRING_KEYS = ["package", "class", "resource_id", "text", "content_description", "size",
+               "signature", "content_free_signature", "view_str"]
+INT_KEYS = ["temp_id", "parent", "child_count"]
+# the keys of a view in iteration order, any other key is kept in a per-view dict
+VIEW_KEYS = FLAG_KEYS + STRING_KEYS + INT_KEYS + ["bounds", "children"]
+KEY_BITS = dict((key, 1 << i) for i, key in enumerate(VIEW_KEYS))
+
+
+def _is_bounds(value):
+    return isinstance(value, list) and len(value) == 2 \
+        and all(isinstance(point, list) and len(point) == 2 for point in value) \
+        and all(type(xy) is int for point in value for xy in point)
+
+
+class ViewStore(object):
+    """
+    the views of a state as a struct of arrays: bits for the flags, int arrays for the bounds, ids and children,
+    interned strings for the texts
+    views are accessed with ViewProxy, a read-only dict-like view of one row
+    """
+
+    def __init__(self, views):
+        """
+        :param views: list of dict, the views of a state
+        """
+        num_views = len(views)
+        self.present = array('I', [0]) * num_views
+        self.flags = array('I', [0]) * num_views
+        self.strings = dict((key, [None] * num_views) for key in STRING_KEYS)
+        self.ints = dict((key, array('i', [0]) * num_views) for key in INT_KEYS)
+        # x1, y1, x2, y2 of each view
+        self.bounds = array('i', [0]) * (4 * num_views)
+        # the children of view i are child_ids[child_offsets[i]:child_offsets[i + 1]]
+        self.child_offsets = array('I', [0]) * (num_views + 1)
+        self.child_ids = array('i')
+        # view index -> dict of the other keys, and of values not fitting their column
+        self.extras = {}
+
+        for index, view in enumerate(views):
+            present = 0
+            flags = 0
+            extra = {}
+            for key, value in view.items():
+                bit = KEY_BITS.get(key)
+                if bit is None:
+                    extra[key] = value
+                elif key in self.strings:
+                    if value is not None and not isinstance(value, str):
+                        extra[key] = value
+                        continue
+                    self.strings[key][index] = sys.intern(value) if value is not None else None
+                    present |= bit
+                elif key in self.ints:
+                    if type(value) is not int:
+                        extra[key] = value
+                        continue
+                    self.ints[key][index] = value
+                    present |= bit
+                elif key == "bounds":
+                    if not _is_bounds(value):
+                        extra[key] = value
+                        continue
+                    (x1, y1), (x2, y2) = value
+                    self.bounds[4 * index:4 * index + 4] = array('i', [x1, y1, x2, y2])
+                    present |= bit
+                elif key == "children":
+                    if not isinstance(value, list) or not all(type(child) is int for child in value):
+                        extra[key] = value
+                        continue
+                    self.child_ids.extend(value)
+                    present |= bit
+                elif isinstance(value, bool):
+                    if value:
+                        flags |= bit
+                    present |= bit
+                else:
+                    extra[key] = value
+            self.present[index] = present
+            self.flags[index] = flags
+            self.child_offsets[index + 1] = len(self.child_ids)
+            if extra:
+                self.extras[index] = extra
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ViewProxy(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("view index out of range")
+        return ViewProxy(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield ViewProxy(self, index)
+
+    def get_value(self, index, key):
+        """
+        get an attribute of a view
+        :raise KeyError: if the view does not have the attribute
+        """
+        extra = self.extras.get(index)
+        if extra is not None and key in extra:
+            return extra[key]
+        bit = KEY_BITS.get(key)
+        if bit is None or not self.present[index] & bit:
+            raise KeyError(key)
+        if key in self.strings:
+            return self.strings[key][index]
+        if key in self.ints:
+            return self.ints[key][index]
+        if key == "bounds":
+            x1, y1, x2, y2 = self.bounds[4 * index:4 * index + 4]
+            return [[x1, y1], [x2, y2]]
+        if key == "children":
+            return self.child_ids[self.child_offsets[index]:self.child_offsets[index + 1]].tolist()
+        return bool(self.flags[index] & bit)
+
+    def get_keys(self, index):
+        present = self.present[index]
+        keys = [key for key in VIEW_KEYS if present & KEY_BITS[key]]
+        extra = self.extras.get(index)
+        if extra:
+            keys += [key for key in extra if key not in KEY_BITS or not present & KEY_BITS[key]]
+        return keys
+
+    def to_dicts(self):
+        """
+        :return: list of dict, the views as plain dicts
+        """
+        return [dict(view) for view in self]
+
+
+class ViewProxy(Mapping):
+    """
+    a read-only, dict-like view of a row in a ViewStore
+    values are built on access, mutable values (bounds, children) are new lists on every access
+    """
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._store.get_value(self._index, key)
+
+    def __iter__(self):
+        return iter(self._store.get_keys(self._index))
+
+    def __len__(self):
+        return len(self._store.get_keys(self._index))
+
+    def __repr__(self):
+        return "ViewProxy(%r)" % self.to_dict()
+
+    def to_dict(self):
+        return dict(self)